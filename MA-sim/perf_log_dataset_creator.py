@@ -15,6 +15,8 @@ except ImportError:
     print("Lỗi: Không thể import config/utils.")
     sys.exit(1)
 
+from engine import redis_pool
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%H:%M:%S")
 
 # --- CẤU HÌNH ---
@@ -155,7 +157,7 @@ def process_logs():
     # Kết nối Redis an toàn (Soft connect)
     redis_client = None
     try:
-        redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+        redis_client = redis_pool.get_redis()
         redis_client.ping()
         
         # [FIX] Tự động tắt lỗi BGSAVE để tránh crash khi chạy lâu
@@ -389,13 +391,12 @@ def process_logs():
                             redis_status = "✅"
                         except Exception as e:
                             logging.error(f"Redis Push Failed: {e}")
-                            # Thử kết nối lại cho lần sau
-                            try: redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
-                            except: pass
+                            # Bỏ kết nối hỏng trong pool, lần sau dùng kết nối mới
+                            redis_pool.reset_pool()
+                            redis_client = redis_pool.get_redis()
                     else:
                         # Thử kết nối lại cho lần sau
-                        try: redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
-                        except: pass
+                        redis_client = redis_pool.get_redis()
 
                     # BƯỚC C: Cập nhật State (Chỉ khi CSV đã ghi thành công)
                     last_ts = batch_max
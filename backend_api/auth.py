@@ -8,6 +8,7 @@ from fastapi import Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from . import models
 from .models import SessionLocal
+from .db_access import run_read
 import os
 from dotenv import load_dotenv
 
@@ -52,7 +53,7 @@ def get_db():
     try: yield db
     finally: db.close()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -66,7 +67,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
         
-    user = db.query(models.User).filter(models.User.username == username).first()
+    # Không chạy query sync trên event loop (mọi request có xác thực đều đi qua đây)
+    user = await run_read(lambda db: db.query(models.User).filter(models.User.username == username).first())
     if user is None:
         raise credentials_exception
     return user
\ No newline at end of file
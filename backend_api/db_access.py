@@ -0,0 +1,172 @@
+# backend_api/db_access.py
+"""
+Truy cập DB cho các endpoint đọc nhiều + đo thời gian DB theo endpoint.
+
+- run_read(fn, ...): chạy fn(session, ...) không chặn event loop:
+    DB_ASYNC_READS=1 và có asyncpg -> AsyncSession.run_sync trên async engine (pool riêng);
+    ngược lại -> threadpool + SessionLocal (như endpoint sync cũ).
+- db_timing_middleware: cộng thời gian mọi câu SQL của request (event before/after_cursor_execute),
+  trả header Server-Timing và ghi vào `metrics` (GET /api/system/db-metrics).
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from typing import Any, Callable, Dict
+
+import numpy as np
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+from .models import DATABASE_URL, SessionLocal, engine, pool_options
+
+try:
+    import asyncpg  # noqa: F401
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    ASYNCPG_AVAILABLE = True
+except ImportError:
+    ASYNCPG_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DB_ASYNC_READS = os.getenv("DB_ASYNC_READS", "0") == "1"
+# Số request gần nhất giữ lại cho mỗi endpoint (tính p50 / p95)
+DB_METRICS_WINDOW = int(os.getenv("DB_METRICS_WINDOW", "500"))
+
+
+def _async_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    return f"postgresql+asyncpg://{rest}" if scheme.startswith("postgresql") else url
+
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC_READS:
+    if not ASYNCPG_AVAILABLE:
+        logger.warning("DB_ASYNC_READS=1 but asyncpg is not installed; using the threadpool path.")
+    elif not DATABASE_URL.startswith("postgresql"):
+        logger.warning("DB_ASYNC_READS=1 requires PostgreSQL; using the threadpool path.")
+    else:
+        async_engine = create_async_engine(_async_url(DATABASE_URL), **pool_options(async_driver=True))
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+async def run_read(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """fn(session, *args, **kwargs) trên async engine hoặc trong threadpool; session đóng sau khi xong."""
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
+    def call():
+        with SessionLocal() as session:
+            return fn(session, *args, **kwargs)
+    return await run_in_threadpool(call)
+
+
+# ==============================================================================
+# DB TIME THEO REQUEST / ENDPOINT
+# ==============================================================================
+
+class _RequestDBTime:
+    __slots__ = ("db_ms", "queries")
+
+    def __init__(self):
+        self.db_ms = 0.0
+        self.queries = 0
+
+
+# Context được copy sang threadpool / greenlet của SQLAlchemy -> cùng một object cho cả request
+_request_db_time: contextvars.ContextVar = contextvars.ContextVar("request_db_time", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    timer = _request_db_time.get()
+    if timer is not None:
+        timer.db_ms += (time.perf_counter() - started) * 1000
+        timer.queries += 1
+
+
+def _handle_error(exception_context):
+    # Câu lệnh lỗi không gọi after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+def instrument(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+instrument(engine)
+if async_engine is not None:
+    instrument(async_engine.sync_engine)
+
+
+class EndpointMetrics:
+    def __init__(self, window: int = DB_METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+
+    def record(self, endpoint: str, total_ms: float, db_ms: float, queries: int):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append((total_ms, db_ms, queries))
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            data = {k: np.array(v, dtype=float) for k, v in self._samples.items()}
+            counts = dict(self._counts)
+        out = {}
+        for endpoint, arr in sorted(data.items()):
+            total, db, queries = arr[:, 0], arr[:, 1], arr[:, 2]
+            out[endpoint] = {
+                "requests": counts[endpoint],
+                "total_p50_ms": round(float(np.percentile(total, 50)), 2),
+                "total_p95_ms": round(float(np.percentile(total, 95)), 2),
+                "db_p50_ms": round(float(np.percentile(db, 50)), 2),
+                "db_p95_ms": round(float(np.percentile(db, 95)), 2),
+                "db_share": round(float(db.sum() / total.sum()), 3) if total.sum() else 0.0,
+                "queries_avg": round(float(queries.mean()), 2),
+            }
+        return out
+
+
+metrics = EndpointMetrics()
+
+
+async def db_timing_middleware(request, call_next):
+    timer = _RequestDBTime()
+    token = _request_db_time.set(timer)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _request_db_time.reset(token)
+    total_ms = (time.perf_counter() - started) * 1000
+    # Khóa theo route template (VD /api/anomalies/{anomaly_id}) để không phình theo URL
+    route = request.scope.get("route")
+    endpoint = f"{request.method} {route.path}" if route is not None else "unmatched"
+    metrics.record(endpoint, total_ms, timer.db_ms, timer.queries)
+    response.headers["Server-Timing"] = f"db;dur={timer.db_ms:.1f}, app;dur={total_ms:.1f}"
+    return response
+
+
+def pool_status() -> Dict[str, Any]:
+    status = {"sync": engine.pool.status()}
+    if async_engine is not None:
+        status["async"] = async_engine.pool.status()
+    return status
@@ -1,12 +1,16 @@
 # backend_api/main_api.py
-from fastapi import FastAPI, Depends, HTTPException, status, Security
+from fastapi import FastAPI, Depends, HTTPException, status, Security, Response
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
-from sqlalchemy import func, or_, text, cast, Text
+from sqlalchemy import func, or_, text, cast, Text, tuple_
 import re 
+import json
+import base64
+import heapq
+from itertools import islice
 from pathlib import Path
 from deep_translator import GoogleTranslator
 
@@ -16,6 +20,8 @@ from . import self_monitoring_api
 # Import các thành phần từ các file trong cùng thư mục
 from . import models, schemas
 from .models import SessionLocal, engine
+from .text_search import apply_search
+from .db_access import run_read, db_timing_middleware, metrics as db_metrics, pool_status
 
 # Import engine và trình quản lý config
 import sys
@@ -62,8 +68,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing"],  # frontend khác origin đọc cursor trang kế tiếp
 )
 
+# Thời gian DB theo endpoint (header Server-Timing + /api/system/db-metrics)
+app.middleware("http")(db_timing_middleware)
+
 ENGINE_START_TIME = datetime.now()
 
 # --- Dependency Injection: Cung cấp DB Session cho các endpoint ---
@@ -177,50 +187,72 @@ def _apply_common_filters(q, user: Optional[str], anomaly_type: Optional[str],
             q = q.filter(models.Anomaly.timestamp <= dtt)
     return q
 
+# --- Rollup helpers (engine/rollups.py): dashboard không quét bảng gốc ---
+CRITICAL_GROUPS = ['TECHNICAL_ATTACK', 'DATA_DESTRUCTION', 'SQL Injection']
+
+# time_range -> (khoảng thời gian, kiểu nhãn chart, granularity rollup dùng cho chart)
+STATS_TIME_RANGES = {
+    "D": (timedelta(hours=24), "hour", "minute"),
+    "W": (timedelta(days=7), "day", "hour"),
+    "M": (timedelta(days=30), "day", "hour"),
+    "6M": (timedelta(days=180), "month", "day"),
+    "Y": (timedelta(days=365), "month", "day"),
+}
+
+def _floor_bucket(ts: datetime, granularity: str) -> datetime:
+    ts = ts.replace(second=0, microsecond=0)
+    if granularity in ("hour", "day"):
+        ts = ts.replace(minute=0)
+    if granularity == "day":
+        ts = ts.replace(hour=0)
+    return ts
+
+def _day_rollups(db: Session, *columns, source: Optional[str] = None):
+    """Query trên anomaly_rollups mức 'day' (giữ vĩnh viễn -> dùng cho số liệu toàn thời gian)."""
+    R = models.AnomalyRollup
+    q = db.query(*columns).filter(R.granularity == "day")
+    if source:
+        q = q.filter(R.source == source)
+    return q
+
 @app.get("/api/anomalies/stats", response_model=Dict[str, Any], tags=["Anomalies"])
-def anomaly_stats(
+async def anomaly_stats(
     time_range: str = "D",
-    db: Session = Depends(get_db), 
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    # 1. Xử lý thời gian lọc (Giữ nguyên logic cũ)
+    return await run_read(_anomaly_stats, time_range)
+
+def _anomaly_stats(db: Session, time_range: str = "D"):
+    R = models.AnomalyRollup
+    L = models.LogRollup
+
+    # 1. Xử lý thời gian lọc
     now = datetime.now()
-    if time_range == "W":
-        start_date = now - timedelta(days=7)
-        group_mode = "day"
-    elif time_range == "M":
-        start_date = now - timedelta(days=30)
-        group_mode = "day"
-    elif time_range == "6M":
-        start_date = now - timedelta(days=180)
-        group_mode = "month"
-    elif time_range == "Y":
-        start_date = now - timedelta(days=365)
-        group_mode = "month"
-    else: # Default 24h
-        start_date = now - timedelta(hours=24)
-        group_mode = "hour"
-
-    # 2. KPI Tổng quan (Giữ nguyên)
-    total_scanned = db.query(func.count(models.AllLogs.id)).scalar() or 0
-    event_count = db.query(func.count(models.Anomaly.id)).scalar() or 0
-    agg_count = db.query(func.count(models.AggregateAnomaly.id)).scalar() or 0
-    total_anomalies = int(event_count + agg_count)
-    
-    crit_events = db.query(func.count(models.Anomaly.id)).filter(
-        or_(
-            # models.Anomaly.score >= 0.9, 
-            models.Anomaly.behavior_group.in_(['TECHNICAL_ATTACK', 'DATA_DESTRUCTION', 'SQL Injection'])
-        )
-    ).scalar() or 0
-    crit_aggs = db.query(func.count(models.AggregateAnomaly.id)).filter(models.AggregateAnomaly.anomaly_type.in_(['TECHNICAL_ATTACK', 'DATA_DESTRUCTION', 'SQL Injection'])).scalar() or 0
-    critical_alerts = int(crit_events + crit_aggs)
+    span, group_mode, chart_granularity = STATS_TIME_RANGES.get(time_range, STATS_TIME_RANGES["D"])
+    start_date = now - span
 
-    # 3. Chart Data (Giữ nguyên logic cũ)
-    event_query = db.query(models.Anomaly).filter(models.Anomaly.timestamp >= start_date).all()
-    agg_query = db.query(models.AggregateAnomaly).filter(models.AggregateAnomaly.created_at >= start_date).all()
+    # 2. KPI Tổng quan (từ rollup mức day)
+    total_scanned = int(db.query(func.coalesce(func.sum(L.log_count), 0)).filter(L.granularity == "day").scalar())
+    source_counts = dict(_day_rollups(db, R.source, func.sum(R.anomaly_count)).group_by(R.source).all())
+    event_count = int(source_counts.get("event") or 0)
+    agg_count = int(source_counts.get("aggregate") or 0)
+    total_anomalies = event_count + agg_count
 
-    chart_query = event_query + agg_query
+    critical_alerts = int(_day_rollups(db, func.coalesce(func.sum(R.anomaly_count), 0)).filter(
+        or_(
+            (R.source == "event") & R.behavior_group.in_(CRITICAL_GROUPS),
+            (R.source == "aggregate") & R.anomaly_type.in_(CRITICAL_GROUPS),
+        )
+    ).scalar())
+
+    # 3. Chart Data: bucket rollup (minute / hour / day) -> nhãn giờ / ngày / tháng
+    chart_rows = (
+        db.query(R.bucket_start, func.sum(R.anomaly_count))
+        .filter(R.granularity == chart_granularity,
+                R.bucket_start >= _floor_bucket(start_date, chart_granularity))
+        .group_by(R.bucket_start)
+        .all()
+    )
 
     data_map = {}
     if group_mode == "hour":
@@ -243,45 +275,37 @@ def anomaly_stats(
         for i in range(days):
             d = (start_date + timedelta(days=i)).strftime("%d/%m")
             data_map[d] = 0
-            
-    for log in chart_query:
-        # Lấy thời gian an toàn: Ưu tiên timestamp -> created_at
-        log_time = getattr(log, 'timestamp', getattr(log, 'created_at', None))
-        
-        if not log_time: continue # Bỏ qua nếu lỗi dữ liệu
 
+    for bucket_start, count in chart_rows:
         if group_mode == "hour":
-            key = f"{log_time.hour}:00"
+            key = f"{bucket_start.hour}:00"
         elif group_mode == "month":
-            key = log_time.strftime("%m/%Y")
+            key = bucket_start.strftime("%m/%Y")
         else:
-            key = log_time.strftime("%d/%m")
-        
-        if key in data_map: 
-            data_map[key] += 1
-            
+            key = bucket_start.strftime("%d/%m")
+
+        if key in data_map:
+            data_map[key] += int(count or 0)
+
     chart_data = [{"name": k, "anomalies": v} for k, v in data_map.items()]
 
-    # 4. Top Risky Users (Giữ nguyên)
+    # 4. Top Risky Users
     risky_users_query = (
-        db.query(
-            models.Anomaly.user, 
-            func.sum(models.Anomaly.score).label("total_score"),
-            func.count(models.Anomaly.id).label("violation_count")
-        )
-        .filter(models.Anomaly.user.isnot(None))
-        .group_by(models.Anomaly.user)
+        _day_rollups(db, R.user, func.sum(R.score_sum).label("total_score"),
+                     func.sum(R.anomaly_count).label("violation_count"), source="event")
+        .filter(R.user != "")
+        .group_by(R.user)
         .order_by(text("total_score DESC"))
         .limit(10)
         .all()
     )
-    top_risky_users = [{"user": u, "score": float(s or 0), "count": c} for u, s, c in risky_users_query]
+    top_risky_users = [{"user": u, "score": float(s or 0), "count": int(c)} for u, s, c in risky_users_query]
 
-    # 5. Detection Stats (CẬP NHẬT MAPPING MỚI)
+    # 5. Detection Stats
     group_counts = (
-        db.query(models.Anomaly.behavior_group, func.count(models.Anomaly.id))
-        .filter(models.Anomaly.behavior_group.isnot(None))
-        .group_by(models.Anomaly.behavior_group)
+        _day_rollups(db, R.behavior_group, func.sum(R.anomaly_count), source="event")
+        .filter(R.behavior_group != "")
+        .group_by(R.behavior_group)
         .all()
     )
 
@@ -304,12 +328,11 @@ def anomaly_stats(
         
         detection_stats.append({
             "name": config["label"],
-            "value": count,
+            "value": int(count),
             "color": config["color"]
         })
 
     # Cộng thêm Aggregate Anomalies vào nhóm Multi-table cho biểu đồ (nếu chưa có)
-    agg_count = db.query(func.count(models.AggregateAnomaly.id)).scalar() or 0
     if agg_count > 0:
         found = False
         for item in detection_stats:
@@ -326,16 +349,16 @@ def anomaly_stats(
 
     detection_stats.sort(key=lambda x: x['value'], reverse=True)
 
-    # 6. Targeted DBs & Latest Feed (Giữ nguyên)
+    # 6. Targeted DBs (rollup) & Latest Feed (index trên timestamp, LIMIT 10)
     targeted_dbs_query = (
-        db.query(models.Anomaly.database, func.count(models.Anomaly.id))
-        .filter(models.Anomaly.database.isnot(None))
-        .group_by(models.Anomaly.database)
-        .order_by(func.count(models.Anomaly.id).desc())
+        _day_rollups(db, R.database, func.sum(R.anomaly_count).label("hits"), source="event")
+        .filter(R.database != "")
+        .group_by(R.database)
+        .order_by(text("hits DESC"))
         .limit(5)
         .all()
     )
-    targeted_entities = [{"name": db_name, "value": count} for db_name, count in targeted_dbs_query]
+    targeted_entities = [{"name": db_name, "value": int(count)} for db_name, count in targeted_dbs_query]
 
     latest_events = (
         db.query(models.Anomaly)
@@ -381,28 +404,36 @@ def anomaly_stats(
 
 
 @app.get("/api/anomalies/kpis", response_model=schemas.AnomalyKpis, tags=["Anomalies"])
-def anomaly_kpis(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def anomaly_kpis(current_user: models.User = Depends(auth.get_current_user)):
+    return await run_read(_anomaly_kpis)
+
+def _anomaly_kpis(db: Session):
     """
     Thống kê KPI theo Nhóm Hành Vi (Behavior Group) được định nghĩa trong Data Processor.
+    Đọc từ anomaly_rollups (mức day), không đếm trên bảng anomalies.
     """
-    
-    # 1. Query Group-by trên bảng Anomaly để lấy số lượng từng nhóm
-    # Kết quả trả về dạng: [('ACCESS_ANOMALY', 5), ('TECHNICAL_ATTACK', 10), ...]
-    group_counts = (
-        db.query(models.Anomaly.behavior_group, func.count(models.Anomaly.id))
-        .group_by(models.Anomaly.behavior_group)
+    R = models.AnomalyRollup
+
+    # 1. Số lượng từng nhóm (event) + tổng aggregate, trong một query
+    # Kết quả trả về dạng: [('event', 'ACCESS_ANOMALY', 5), ('aggregate', '', 3), ...]
+    rows = (
+        _day_rollups(db, R.source, R.behavior_group, func.sum(R.anomaly_count))
+        .group_by(R.source, R.behavior_group)
         .all()
     )
-    
-    # Chuyển list tuple thành dict cho dễ truy xuất: {'ACCESS_ANOMALY': 5, ...}
-    # Sử dụng (g or 'UNKNOWN') để tránh lỗi nếu behavior_group bị null
-    counts_map = { (g or 'UNKNOWN'): c for g, c in group_counts }
 
-    # 2. Đếm Aggregate Anomaly (Thường là Multi-table sessions)
-    # Bảng AggregateAnomaly không có behavior_group, nhưng bản chất nó là MULTI_TABLE_ACCESS
-    agg_count = db.query(func.count(models.AggregateAnomaly.id)).scalar() or 0
+    # Chiều rỗng ('') tương ứng behavior_group NULL -> 'UNKNOWN'
+    counts_map: Dict[str, int] = {}
+    agg_count = 0
+    for source, group, count in rows:
+        if source == "aggregate":
+            # Bảng AggregateAnomaly không có behavior_group, nhưng bản chất nó là MULTI_TABLE_ACCESS
+            agg_count += int(count)
+        else:
+            key = group or "UNKNOWN"
+            counts_map[key] = counts_map.get(key, 0) + int(count)
 
-    # 3. Tổng hợp số liệu vào Schema
+    # 2. Tổng hợp số liệu vào Schema
     # Lưu ý: 'UNUSUAL_BEHAVIOR' trong DB tương ứng với 'behavioral_profile' hiển thị
     
     stats = {
@@ -420,18 +451,19 @@ def anomaly_kpis(db: Session = Depends(get_db), current_user: models.User = Depe
     }
 
     # Tính tổng Total
-    total_events = db.query(func.count(models.Anomaly.id)).scalar() or 0
-    stats["total"] = total_events + agg_count
+    stats["total"] = sum(counts_map.values()) + agg_count
 
     return stats
 
 # ===== NEW: Facets (users/types) tính trên TOÀN BỘ dataset =====
 @app.get("/api/anomalies/facets", tags=["Anomalies"])
-def anomaly_facets(
+async def anomaly_facets(
     behavior_group: Optional[str] = None, # [NEW] Thêm tham số này
-    db: Session = Depends(get_db), 
     current_user: models.User = Depends(auth.get_current_user)
 ):
+    return await run_read(_anomaly_facets, behavior_group)
+
+def _anomaly_facets(db: Session, behavior_group: Optional[str] = None):
     """
     Trả về danh sách Users và Types (Rules) có dữ liệu thực tế.
     Nếu có behavior_group, chỉ trả về users/types thuộc nhóm đó.
@@ -475,76 +507,141 @@ def anomaly_facets(
     }
 
 
+# ===== Keyset pagination cho danh sách hợp nhất (event + aggregate) =====
+# Thứ tự: (timestamp, source, id) giảm dần; cùng timestamp thì event đứng trước aggregate.
+# Mỗi bảng chỉ đọc `limit + 1` dòng theo index (timestamp, id), rồi merge k-way ở API,
+# nên trang sâu (cursor) tốn như trang đầu. `skip` vẫn được hỗ trợ cho client cũ.
+_SOURCE_RANK = {"aggregate": 0, "event": 1}
+
+def _agg_sort_ts():
+    """Thời điểm hiển thị / sắp xếp của aggregate anomaly (khớp Index ix_aggregate_anomalies_sort_ts)."""
+    A = models.AggregateAnomaly
+    return func.coalesce(A.start_time, A.end_time, A.created_at)
+
+def _encode_cursor(ts: datetime, source: str, row_id: int) -> str:
+    raw = json.dumps([ts.isoformat(), source, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        ts, source, row_id = json.loads(raw)
+        if source not in _SOURCE_RANK:
+            raise ValueError(source)
+        return datetime.fromisoformat(ts), source, int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _keyset_rows(q, ts_col, id_col, source: str, cursor, n: int):
+    """n dòng tiếp theo của một bảng sau cursor, theo (ts_col, id_col) giảm dần."""
+    if cursor:
+        c_ts, c_source, c_id = cursor
+        rank, c_rank = _SOURCE_RANK[source], _SOURCE_RANK[c_source]
+        if rank < c_rank:
+            q = q.filter(ts_col <= c_ts)
+        elif rank > c_rank:
+            q = q.filter(ts_col < c_ts)
+        else:
+            q = q.filter(tuple_(ts_col, id_col) < tuple_(c_ts, c_id))
+    return q.order_by(ts_col.desc(), id_col.desc()).limit(n).all()
+
+def _event_item(r) -> schemas.UnifiedAnomaly:
+    return schemas.UnifiedAnomaly(
+        id=f"event-{r.id}", source="event",
+        anomaly_type=r.anomaly_type, behavior_group=r.behavior_group, timestamp=r.timestamp,
+        user=r.user, client_ip=r.client_ip, database=r.database, query=r.query,
+        reason=r.reason, score=r.score, scope="log", details=None, ai_analysis=r.ai_analysis
+    )
+
+def _agg_item(r) -> schemas.UnifiedAnomaly:
+    return schemas.UnifiedAnomaly(
+        id=f"agg-{r.id}", source="aggregate",
+        anomaly_type=r.anomaly_type,
+        behavior_group="MULTI_TABLE_ACCESS",
+        timestamp=r.start_time or r.end_time or r.created_at,
+        user=r.user, client_ip=getattr(r, 'client_ip', None), database=r.database, query=None,
+        reason=r.reason, score=r.severity, scope=r.scope, details=r.details, ai_analysis=r.ai_analysis
+    )
+
+def _unified_page(q_ev, q_ag, skip: int, limit: int, cursor: Optional[str]):
+    """
+    Một trang của danh sách hợp nhất + cursor trang kế tiếp (None nếu hết).
+    q_ev / q_ag: query đã lọc trên Anomaly / AggregateAnomaly (None = bỏ qua bảng đó).
+    """
+    position = _decode_cursor(cursor) if cursor else None
+    offset = 0 if position else max(skip, 0)
+    n = offset + limit + 1
+
+    streams = []
+    if q_ev is not None:
+        rows = _keyset_rows(q_ev, models.Anomaly.timestamp, models.Anomaly.id, "event", position, n)
+        streams.append(((r.timestamp, _SOURCE_RANK["event"], r.id, "event", r) for r in rows))
+    if q_ag is not None:
+        sort_ts = _agg_sort_ts()
+        rows = _keyset_rows(q_ag.add_columns(sort_ts.label("sort_ts")), sort_ts,
+                            models.AggregateAnomaly.id, "aggregate", position, n)
+        streams.append(((ts, _SOURCE_RANK["aggregate"], r.id, "aggregate", r) for r, ts in rows))
+
+    merged = heapq.merge(*streams, key=lambda k: k[:3], reverse=True)
+    page = list(islice(merged, offset, offset + limit + 1))
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    items = [_event_item(r) if source == "event" else _agg_item(r) for _, _, _, source, r in page]
+    next_cursor = None
+    if has_more and page:
+        ts, _, row_id, source, _ = page[-1]
+        next_cursor = _encode_cursor(ts, source, row_id)
+    return items, next_cursor
+
 # ===== NEW: Search gộp (event + aggregate) + phân trang server-side =====
 @app.get("/api/anomalies/search", tags=["Anomalies"])
-def anomaly_search(
+async def anomaly_search(
     skip: int = 0,
     limit: int = 20,
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     user: Optional[str] = None,
     anomaly_type: Optional[str] = None,
     behavior_group: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    db: Session = Depends(get_db),
     current_user: models.User = Depends(auth.get_current_user),
 ):
+    return await run_read(_anomaly_search, skip=skip, limit=limit, cursor=cursor, search=search, user=user,
+                          anomaly_type=anomaly_type, behavior_group=behavior_group,
+                          date_from=date_from, date_to=date_to)
+
+def _anomaly_search(db: Session, skip: int = 0, limit: int = 20, cursor: Optional[str] = None,
+                    search: Optional[str] = None, user: Optional[str] = None,
+                    anomaly_type: Optional[str] = None, behavior_group: Optional[str] = None,
+                    date_from: Optional[str] = None, date_to: Optional[str] = None):
+    """
+    Trả về {"items", "total", "next_cursor"}. Truyền next_cursor vào `cursor` để lấy trang sau
+    (khi có cursor thì `skip` bị bỏ qua).
+    """
     # Event
-    q_ev = db.query(models.Anomaly)
-    if search:
-        q_ev = q_ev.filter(or_(models.Anomaly.query.ilike(f"%{search}%"),
-                               models.Anomaly.reason.ilike(f"%{search}%")))
+    q_ev = apply_search(db.query(models.Anomaly), [models.Anomaly.query, models.Anomaly.reason], search)
     if behavior_group:
         q_ev = q_ev.filter(models.Anomaly.behavior_group == behavior_group)
     q_ev = _apply_common_filters(q_ev, user, anomaly_type, date_from, date_to, is_aggregate=False)
     ev_total = q_ev.count()
-    ev_rows = (q_ev.order_by(models.Anomaly.timestamp.desc())
-                  .offset(skip).limit(limit).all())
 
     # Aggregate
-    q_ag = db.query(models.AggregateAnomaly)
-    if search:
-        q_ag = q_ag.filter(or_(
-            models.AggregateAnomaly.reason.ilike(f"%{search}%"),
-            models.AggregateAnomaly.details.cast(Text).ilike(f"%{search}%")
-        ))
-    if behavior_group:
-        if behavior_group == "MULTI_TABLE_ACCESS":
-             # Lấy tất cả aggregate vì hiện tại aggregate chỉ dùng cho multi-table
-             pass 
-        else:
-             # Nếu lọc nhóm khác thì aggregate = 0 (vì aggregate hiện tại chỉ là multi-table)
-             q_ag = q_ag.filter(text("1=0"))
-    q_ag = _apply_common_filters(q_ag, user, anomaly_type, date_from, date_to, is_aggregate=True)
-    ag_total = q_ag.count()
-    ag_rows = (q_ag.order_by(models.AggregateAnomaly.start_time.desc().nullslast(),
-                             models.AggregateAnomaly.created_at.desc())
-                  .offset(skip).limit(limit).all())
-
-    # Hợp nhất + sort thời gian
-    items = []
-    for r in ev_rows:
-        items.append(schemas.UnifiedAnomaly(
-            id=f"event-{r.id}", source="event",
-            anomaly_type=r.anomaly_type, behavior_group=r.behavior_group, timestamp=r.timestamp,
-            user=r.user, client_ip=r.client_ip, database=r.database, query=r.query,
-            reason=r.reason, score=r.score, scope="log", details=None, ai_analysis=r.ai_analysis
-        ))
-    for r in ag_rows:
-        items.append(schemas.UnifiedAnomaly(
-            id=f"agg-{r.id}", source="aggregate",
-            anomaly_type=r.anomaly_type,
-            behavior_group="MULTI_TABLE_ACCESS",
-            timestamp=r.start_time or r.end_time or r.created_at,
-            user=r.user, client_ip=getattr(r, 'client_ip', None), database=r.database, query=None,
-            reason=r.reason, score=r.severity, scope=r.scope, details=r.details, ai_analysis=r.ai_analysis
-        ))
-
-    items.sort(key=lambda x: x.timestamp or datetime.min, reverse=True)
-
-    paginated_items = items[:limit]
-
-    return {"items": paginated_items, "total": int(ev_total + ag_total)}
+    q_ag = apply_search(db.query(models.AggregateAnomaly),
+                        [models.AggregateAnomaly.reason, models.AggregateAnomaly.details.cast(Text)], search)
+    if behavior_group and behavior_group != "MULTI_TABLE_ACCESS":
+        # Nếu lọc nhóm khác thì aggregate = 0 (vì aggregate hiện tại chỉ là multi-table)
+        q_ag = None
+    ag_total = 0
+    if q_ag is not None:
+        q_ag = _apply_common_filters(q_ag, user, anomaly_type, date_from, date_to, is_aggregate=True)
+        ag_total = q_ag.count()
+
+    # Hợp nhất theo thời gian (k-way merge, mỗi bảng tối đa skip + limit + 1 dòng)
+    items, next_cursor = _unified_page(q_ev, q_ag, skip, limit, cursor)
+
+    return {"items": items, "total": int(ev_total + ag_total), "next_cursor": next_cursor}
 
 
 
@@ -558,10 +655,7 @@ def list_event_anomalies(skip: int = 0, limit: int = 100,
                          date_to: Optional[str] = None,
                          db: Session = Depends(get_db),
                          current_user: models.User = Depends(auth.get_current_user)):
-    q = db.query(models.Anomaly)
-    if search:
-        q = q.filter(or_(models.Anomaly.query.ilike(f"%{search}%"),
-                         models.Anomaly.reason.ilike(f"%{search}%")))
+    q = apply_search(db.query(models.Anomaly), [models.Anomaly.query, models.Anomaly.reason], search)
     q = _apply_common_filters(q, user, anomaly_type, date_from, date_to, is_aggregate=False)
     rows = (q.order_by(models.Anomaly.timestamp.desc())
               .offset(skip).limit(limit).all())
@@ -591,13 +685,9 @@ def list_aggregate_anomalies(skip: int = 0, limit: int = 100,
                              date_to: Optional[str] = None,
                              db: Session = Depends(get_db),
                              current_user: models.User = Depends(auth.get_current_user)):
-    q = db.query(models.AggregateAnomaly)
-    if search:
-        # tìm trong reason hoặc details (cast text)
-        q = q.filter(or_(
-            models.AggregateAnomaly.reason.ilike(f"%{search}%"),
-            cast(models.AggregateAnomaly.details, Text).ilike(f"%{search}%")
-        ))
+    # tìm trong reason hoặc details (cast text)
+    q = apply_search(db.query(models.AggregateAnomaly),
+                     [models.AggregateAnomaly.reason, cast(models.AggregateAnomaly.details, Text)], search)
     q = _apply_common_filters(q, user, anomaly_type, date_from, date_to, is_aggregate=True)
     rows = (q.order_by(models.AggregateAnomaly.start_time.desc().nullslast(),
                        models.AggregateAnomaly.created_at.desc())
@@ -618,76 +708,19 @@ def list_aggregate_anomalies(skip: int = 0, limit: int = 100,
     ) for r in rows]
 
 @app.get("/api/anomalies/",response_model=List[schemas.UnifiedAnomaly],tags=["Anomalies"])
-def read_unified_anomalies(skip: int = 0,limit: int = 100,db: Session = Depends(get_db),current_user: models.User = Depends(auth.get_current_user)):
+async def read_unified_anomalies(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+                                 current_user: models.User = Depends(auth.get_current_user)):
     """
     Lấy danh sách tất cả bất thường (event-level + aggregate),
-    trả về ở dạng unified cho frontend.
+    trả về ở dạng unified cho frontend, mới nhất trước.
+    Cursor trang kế tiếp nằm trong header X-Next-Cursor (truyền lại qua `cursor`).
     """
-    # 1) Lấy event-level anomalies từ bảng anomalies
-    event_q = (
-        db.query(models.Anomaly)
-        .order_by(models.Anomaly.timestamp.desc())
-    )
-    event_rows = event_q.all()
-
-    unified: List[schemas.UnifiedAnomaly] = []
-
-    for a in event_rows:
-        unified.append(
-            schemas.UnifiedAnomaly(
-                id=f"event-{a.id}",
-                source="event",
-                anomaly_type=a.anomaly_type,
-                behavior_group=a.behavior_group,
-                timestamp=a.timestamp,
-                user=a.user,
-                database=a.database,
-                query=a.query,
-                reason=a.reason,
-                score=a.score,
-                scope="log",
-                details=None,
-                ai_analysis=a.ai_analysis
-            )
-        )
-
-    # 2) Lấy aggregate anomalies (multi_table / session-level)
-    agg_q = (
-        db.query(models.AggregateAnomaly)
-        .order_by(
-            models.AggregateAnomaly.start_time.desc().nullslast(),
-            models.AggregateAnomaly.created_at.desc()
-        )
+    items, next_cursor = await run_read(
+        lambda db: _unified_page(db.query(models.Anomaly), db.query(models.AggregateAnomaly), skip, limit, cursor)
     )
-    agg_rows = agg_q.all()
-
-    for a in agg_rows:
-        unified.append(
-            schemas.UnifiedAnomaly(
-                id=f"agg-{a.id}",
-                source="aggregate",
-                anomaly_type=a.anomaly_type,
-                behavior_group="MULTI_TABLE_ACCESS",
-                timestamp=a.start_time or a.end_time or a.created_at,
-                user=a.user,
-                database=a.database,
-                query=None,
-                reason=a.reason,
-                score=a.severity,
-                scope=a.scope,
-                details=a.details,
-                ai_analysis=a.ai_analysis
-            )
-        )
-
-    # 3) Sort chung theo thời gian mới nhất
-    def sort_key(item: schemas.UnifiedAnomaly):
-        return item.timestamp or datetime.min
-
-    unified.sort(key=sort_key, reverse=True)
-
-    # 4) Áp dụng skip/limit ở unified list
-    return unified[skip : skip + limit]
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
 
 @app.get("/api/anomalies/{anomaly_id}", response_model=schemas.Anomaly, tags=["Anomalies"])
 def read_anomaly_by_id(anomaly_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
@@ -902,10 +935,9 @@ def submit_feedback(feedback: schemas.FeedbackCreate, current_user: models.User
     
 # === API MỚI CHO LOG EXPLORER ===
 @app.get("/api/logs/", response_model=List[schemas.AllLogs], tags=["Log Explorer"])
-def read_all_logs(
+async def read_all_logs(
     skip: int = 0, 
     limit: int = 100, 
-    db: Session = Depends(get_db), 
     current_user: models.User = Depends(auth.get_current_user),
     search: str = None, # Thêm bộ lọc
     user: str = None,   # Thêm bộ lọc
@@ -917,21 +949,29 @@ def read_all_logs(
     Lấy ra TẤT CẢ các log đã được xử lý (bình thường + bất thường).
     Hỗ trợ phân trang.
     """
-    query = db.query(models.AllLogs)
+    def fetch(db: Session):
+        # search: prefix / trigram / full-text tùy chuỗi nhập (xem text_search.plan_search)
+        query = apply_search(db.query(models.AllLogs), [models.AllLogs.query], search)
     
-    if search:
-        query = query.filter(models.AllLogs.query.ilike(f"%{search}%"))
-    if user:
-        query = query.filter(models.AllLogs.user == user)
-    if behavior_group:
-        query = query.filter(models.AllLogs.behavior_group == behavior_group)
-    if date_from:
-        query = query.filter(models.AllLogs.timestamp >= date_from)
-    if date_to:
-        query = query.filter(models.AllLogs.timestamp <= date_to)
+        if user:
+            query = query.filter(models.AllLogs.user == user)
+        if behavior_group:
+            query = query.filter(models.AllLogs.behavior_group == behavior_group)
+        if date_from:
+            query = query.filter(models.AllLogs.timestamp >= date_from)
+        if date_to:
+            query = query.filter(models.AllLogs.timestamp <= date_to)
         
-    logs = query.order_by(models.AllLogs.timestamp.desc()).offset(skip).limit(limit).all()
-    return logs
+        logs = query.order_by(models.AllLogs.timestamp.desc()).offset(skip).limit(limit).all()
+        return logs
+
+    return await run_read(fetch)
+
+
+@app.get("/api/system/db-metrics", tags=["System"])
+def get_db_metrics(current_user: models.User = Depends(auth.get_current_user)):
+    """Thời gian DB / request theo endpoint (p50, p95) và trạng thái connection pool."""
+    return {"endpoints": db_metrics.snapshot(), "pool": pool_status()}
 
 
 @app.get("/api/system/audit-logs", response_model=List[schemas.AuditLogEntry], tags=["System"])
@@ -0,0 +1,149 @@
+# backend_api/text_search.py
+"""
+Tìm kiếm văn bản có index cho /api/anomalies/search và Log Explorer (/api/logs/).
+
+Planner chọn chế độ theo chuỗi nhập:
+- "cụm chính xác" hoặc chuỗi có ký tự đặc biệt (VD `select * from`, `users.id`)
+                 -> trigram: ILIKE '%...%' (GIN gin_trgm_ops, giữ nguyên ngữ nghĩa cũ)
+- nhiều từ rời (VD `drop table users`)
+                 -> fulltext: to_tsvector('simple', col) @@ plainto_tsquery(...)
+- kết thúc bằng `*` (VD `passw*`) hoặc ngắn hơn 3 ký tự (trigram không dùng được index)
+                 -> prefix: to_tsquery('simple', 'passw:*')
+CSDL khác PostgreSQL (SQLite khi dev) luôn dùng ILIKE.
+
+Index được tạo bởi backend_api.models.run_migrations (python -m backend_api.models).
+Benchmark (PostgreSQL, sinh dữ liệu vào DATABASE_URL - chỉ dùng DB thử nghiệm):
+    python -m backend_api.text_search --rows 1000000
+"""
+import re
+import time
+import logging
+import argparse
+from typing import NamedTuple, Optional, Sequence
+
+from sqlalchemy import or_, func, literal_column, text
+
+from .models import SEARCH_TS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+TRGM_MIN_LENGTH = 3
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Cấu hình tsvector dạng literal để biểu thức khớp index (kể cả khi driver bind tham số phía server)
+_TS_CONFIG = literal_column(f"'{SEARCH_TS_CONFIG}'")
+
+
+class SearchPlan(NamedTuple):
+    mode: str   # 'prefix' | 'trigram' | 'fulltext'
+    query: str  # tsquery (prefix), chuỗi từ (fulltext) hoặc chuỗi con (trigram)
+    like: str   # chuỗi con dùng cho ILIKE (trigram / CSDL không phải PostgreSQL)
+
+
+def plan_search(raw: Optional[str]) -> Optional[SearchPlan]:
+    term = (raw or "").strip()
+    if not term:
+        return None
+    if len(term) >= 2 and term[0] == term[-1] == '"':
+        phrase = term[1:-1]
+        return SearchPlan("trigram", phrase, phrase) if phrase else None
+
+    tokens = _TOKEN_RE.findall(term)
+    if term.endswith("*") and tokens:
+        return SearchPlan("prefix", " & ".join(tokens[:-1] + [f"{tokens[-1]}:*"]), term.rstrip("*"))
+    if len(term) < TRGM_MIN_LENGTH and tokens:
+        return SearchPlan("prefix", f"{tokens[0]}:*", term)
+    if len(tokens) > 1 and tokens == term.split():
+        return SearchPlan("fulltext", term, term)
+    return SearchPlan("trigram", term, term)
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+
+
+def search_condition(columns: Sequence, raw: Optional[str], dialect_name: str):
+    """Điều kiện OR trên các cột (None nếu không có gì để tìm)."""
+    plan = plan_search(raw)
+    if plan is None:
+        return None
+    if dialect_name != "postgresql" or plan.mode == "trigram":
+        pattern = _like_pattern(plan.like)
+        return or_(*[col.ilike(pattern, escape="\\") for col in columns])
+    if plan.mode == "fulltext":
+        tsquery = func.plainto_tsquery(_TS_CONFIG, plan.query)
+    else:
+        tsquery = func.to_tsquery(_TS_CONFIG, plan.query)
+    return or_(*[func.to_tsvector(_TS_CONFIG, col).op("@@")(tsquery) for col in columns])
+
+
+def apply_search(q, columns: Sequence, raw: Optional[str]):
+    """q.filter(search_condition(...)) theo dialect của session."""
+    condition = search_condition(columns, raw, q.session.get_bind().dialect.name)
+    return q if condition is None else q.filter(condition)
+
+
+# ==============================================================================
+# BENCHMARK (POSTGRESQL)
+# ==============================================================================
+
+BENCH_TERMS = ["drop table", "5f3a", "select * from orders", "passw*", "id", "admin_audit"]
+
+
+def _seed(engine, rows: int):
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO all_logs (timestamp, "user", client_ip, query, is_anomaly)
+            SELECT now() - (random() * interval '90 days'), 'user' || (i % 500), '10.0.0.' || (i % 250),
+                   (ARRAY['SELECT * FROM orders WHERE id = ', 'UPDATE accounts SET password = ''',
+                          'DROP TABLE tmp_', 'SELECT email FROM admin_audit WHERE note = ''',
+                          'INSERT INTO events VALUES (''])[1 + i % 5] || md5(i::text) || ''';',
+                   (i % 100) = 0
+            FROM generate_series(1, :n) AS s(i)
+        """), {"n": rows})
+        conn.execute(text("ANALYZE all_logs"))
+
+
+def benchmark(rows: int = 1_000_000, repeat: int = 10, seed: bool = True):
+    """p50/p95 (ms) của một trang Log Explorer: ILIKE (không index tìm kiếm) vs planner."""
+    import numpy as np
+    from . import models
+
+    engine = models.engine
+    if engine.dialect.name != "postgresql":
+        raise NotImplementedError("benchmark requires PostgreSQL")
+    models.run_migrations(engine)
+    if seed:
+        logger.info(f"Seeding {rows} all_logs rows ...")
+        _seed(engine, rows)
+
+    col = models.AllLogs.query
+    results = {}
+    for term in BENCH_TERMS:
+        legacy = models.AllLogs.__table__.select().where(col.ilike(f"%{term}%"))
+        planned = models.AllLogs.__table__.select().where(search_condition([col], term, "postgresql"))
+        for name, stmt, bitmap in (("ilike", legacy, "off"), ("planned", planned, "on")):
+            stmt = stmt.order_by(models.AllLogs.timestamp.desc()).limit(100)
+            samples = []
+            with engine.connect() as conn:
+                # Tắt bitmap scan = ILIKE không dùng được GIN index (giống trước khi có index tìm kiếm)
+                conn.execute(text(f"SET enable_bitmapscan = {bitmap}"))
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    n = len(conn.execute(stmt).fetchall())
+                    samples.append((time.perf_counter() - started) * 1000)
+                conn.rollback()
+            results[f"{term!r} {name} ({plan_search(term).mode if name == 'planned' else 'seq'})"] = (
+                f"p50={np.percentile(samples, 50):.1f}ms p95={np.percentile(samples, 95):.1f}ms rows={n}"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [TextSearch] - %(message)s")
+    parser = argparse.ArgumentParser(description="Indexed search benchmark (PostgreSQL)")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--no-seed", action="store_true")
+    args = parser.parse_args()
+    for key, value in benchmark(args.rows, args.repeat, seed=not args.no_seed).items():
+        logger.info(f"{key}: {value}")
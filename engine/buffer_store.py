@@ -0,0 +1,265 @@
+# engine/buffer_store.py
+"""
+================================================================================
+TRAINING BUFFER STORE (APPEND-ONLY ARROW SEGMENTS)
+================================================================================
+Lưu bộ đệm huấn luyện ra đĩa dưới dạng các segment Arrow IPC (không nén):
+
+    <BUFFER_STORE_DIR>/seg_<start>_<end>.arrow
+
+- append(df): chỉ ghi các dòng mới thành một segment (tmp + os.replace).
+- Schema cố định theo segment đầu tiên; cột mới được thêm vào cuối schema,
+  không ép toàn bộ cột sang str như file parquet cũ.
+- Cột không còn vừa kiểu cũ (VD int64 nhưng batch mới có 1.5) được nới rộng
+  (int -> float64, còn lại -> string) và các segment cũ được ghi lại theo schema mới.
+- load(capacity): memory-map các segment cuối, chỉ đọc đủ `capacity` dòng mới nhất.
+- Compaction: khi số dòng trên đĩa > COMPACT_FACTOR x capacity hoặc quá nhiều
+  segment, gộp `capacity` dòng mới nhất thành một segment và xóa phần còn lại.
+  Nếu tiến trình chết giữa lúc ghi segment gộp và xóa segment cũ, các segment chồng
+  khoảng [start, end) được xử lý khi đọc: phần đã có trong segment mới hơn bị bỏ qua,
+  segment bị che hoàn toàn được xóa ở lần append / load sau.
+"""
+
+import os
+import glob
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# Gộp segment khi tổng số dòng trên đĩa vượt hệ số này x capacity
+BUFFER_STORE_COMPACT_FACTOR = float(os.getenv("BUFFER_STORE_COMPACT_FACTOR", "2.0"))
+# ... hoặc khi số segment vượt ngưỡng này
+BUFFER_STORE_MAX_SEGMENTS = int(os.getenv("BUFFER_STORE_MAX_SEGMENTS", "64"))
+
+SEGMENT_PREFIX = "seg_"
+SEGMENT_SUFFIX = ".arrow"
+
+
+def _segment_bounds(path: str) -> Tuple[int, int]:
+    """seg_<start>_<end>.arrow -> (start, end)."""
+    name = os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+    start, end = name.split("_")
+    return int(start), int(end)
+
+
+def _resolve_overlaps(segments: List[str]) -> Tuple[List[Tuple[str, int]], List[str]]:
+    """
+    ([(path, số dòng đầu còn dùng)] theo thứ tự cũ -> mới, [segment bị che hoàn toàn]).
+    Đi từ segment có `end` lớn nhất (cùng end: segment rộng hơn trước), chỉ giữ phần
+    dòng chưa nằm trong khoảng của một segment mới hơn.
+    """
+    live, stale = [], []
+    covered_from = None
+    for path in sorted(segments, key=lambda p: (_segment_bounds(p)[1], -_segment_bounds(p)[0]), reverse=True):
+        start, end = _segment_bounds(path)
+        if covered_from is not None and start >= covered_from:
+            stale.append(path)
+            continue
+        live.append((path, (end if covered_from is None else min(end, covered_from)) - start))
+        covered_from = start
+    live.reverse()
+    return live, stale
+
+
+def _stringify(series: pd.Series) -> pd.Series:
+    """Chỉ dùng cho cột object lẫn kiểu (VD str + int): giữ nguyên str/None, đổi phần còn lại sang str."""
+    return series.map(lambda v: v if v is None or isinstance(v, str) or v != v else str(v))
+
+
+def _column_array(series: pd.Series, arrow_type: Optional[pa.DataType] = None) -> pa.Array:
+    try:
+        return pa.Array.from_pandas(series, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+        if arrow_type is None or pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+            return pa.Array.from_pandas(_stringify(series), type=arrow_type or pa.string())
+        if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+            # VD int64 nhưng batch mới có NaN -> ghi null thay vì lỗi
+            numeric = pd.to_numeric(series, errors="coerce")
+            if numeric.isna().sum() > series.isna().sum():
+                raise  # có giá trị không phải số: để _to_table nới kiểu thay vì mất dữ liệu
+            return pa.Array.from_pandas(numeric, type=arrow_type)
+        raise
+
+
+def _infer_array(series: pd.Series) -> pa.Array:
+    arr = _column_array(series)
+    return arr.cast(pa.string()) if pa.types.is_null(arr.type) else arr
+
+
+def frame_to_table(df: pd.DataFrame) -> pa.Table:
+    """DataFrame -> Table, kiểu Arrow suy riêng cho từng cột (không theo schema của store)."""
+    return pa.Table.from_arrays([_infer_array(df[col]) for col in df.columns],
+                                names=[str(col) for col in df.columns])
+
+
+_CONVERT_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError)
+
+
+def _widened_type(arrow_type: pa.DataType, series: pd.Series) -> pa.DataType:
+    """Kiểu chứa được cả dữ liệu cũ lẫn `series`: int -> float64 nếu giá trị mới là số, còn lại -> string."""
+    if pa.types.is_integer(arrow_type):
+        try:
+            pa.Array.from_pandas(series, type=pa.float64())
+            return pa.float64()
+        except _CONVERT_ERRORS:
+            pass
+    return pa.string()
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Ép table (segment cũ) về schema: cột thiếu -> null, cột nới kiểu -> cast."""
+    arrays = []
+    for f in schema:
+        if f.name not in table.column_names:
+            arrays.append(pa.nulls(table.num_rows, type=f.type))
+            continue
+        col = table.column(f.name)
+        if col.type != f.type:
+            try:
+                col = col.cast(f.type)
+            except _CONVERT_ERRORS as e:
+                logger.warning(f"Cannot cast buffer column {f.name} {col.type} -> {f.type} ({e}); using nulls.")
+                col = pa.nulls(table.num_rows, type=f.type)
+        arrays.append(col)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class TrainingBufferStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.schema: Optional[pa.Schema] = None
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    # ------------------------------------------------------------------
+    def segments(self) -> List[str]:
+        """Các segment theo thứ tự cũ -> mới."""
+        paths = glob.glob(os.path.join(self.root, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"))
+        return sorted(paths, key=_segment_bounds)
+
+    def _next_seq(self, segments: List[str]) -> int:
+        return max(_segment_bounds(p)[1] for p in segments) if segments else 0
+
+    def _to_table(self, df: pd.DataFrame) -> Tuple[pa.Table, bool]:
+        """
+        DataFrame -> (Table theo schema cố định, schema có bị nới kiểu không).
+        Cột mới được nối vào cuối schema; cột không còn vừa kiểu cũ được nới rộng.
+        """
+        schema = self.schema
+        arrays, fields = [], []
+        widened = False
+        known = set(schema.names) if schema is not None else set()
+        if schema is not None:
+            for f in schema:
+                if f.name in df.columns:
+                    try:
+                        arrays.append(_column_array(df[f.name], f.type))
+                    except _CONVERT_ERRORS:
+                        f = f.with_type(_widened_type(f.type, df[f.name]))
+                        arrays.append(_column_array(df[f.name], f.type))
+                        widened = True
+                        logger.info(f"Training buffer store: widened column {f.name} to {f.type}.")
+                else:
+                    arrays.append(pa.nulls(len(df), type=f.type))
+                fields.append(f)
+        for col in df.columns:
+            if col not in known:
+                arr = _infer_array(df[col])
+                arrays.append(arr)
+                fields.append(pa.field(str(col), arr.type))
+        self.schema = pa.schema(fields)
+        return pa.Table.from_arrays(arrays, schema=self.schema), widened
+
+    def _write_segment(self, table: pa.Table, start: int) -> str:
+        end = start + table.num_rows
+        path = os.path.join(self.root, f"{SEGMENT_PREFIX}{start:012d}_{end:012d}{SEGMENT_SUFFIX}")
+        tmp = f"{path}.tmp"
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+        return path
+
+    def _drop_stale(self, segments: List[str]) -> List[str]:
+        """Xóa segment bị che hoàn toàn (sót lại sau compaction bị ngắt); trả về các segment còn lại."""
+        _, stale = _resolve_overlaps(segments)
+        for path in stale:
+            try:
+                os.remove(path)
+                logger.info(f"Removed overlapping buffer segment left by an interrupted compaction: {path}")
+            except OSError as e:
+                logger.warning(f"Cannot remove stale segment {path}: {e}")
+        return [path for path in segments if path not in stale]
+
+    def _read_tail(self, segments: List[str], rows: int, schema: Optional[pa.Schema] = None) -> Optional[pa.Table]:
+        """
+        `rows` dòng mới nhất (memory-map, chỉ mở các segment cần thiết), theo `schema`
+        (mặc định: schema của segment mới nhất, luôn là schema rộng nhất).
+        Dòng trùng khoảng với segment mới hơn không được đọc lại.
+        """
+        live, _ = _resolve_overlaps(segments)
+        tables, total = [], 0
+        for path, keep_rows in reversed(live):
+            with pa.memory_map(path, "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+            if keep_rows < table.num_rows:
+                table = table.slice(0, keep_rows)
+            tables.append(table)
+            total += table.num_rows
+            if total >= rows:
+                break
+        if not tables:
+            return None
+        schema = schema or tables[0].schema
+        table = pa.concat_tables([_conform(t, schema) for t in reversed(tables)])
+        return table.slice(max(0, table.num_rows - rows))
+
+    # ------------------------------------------------------------------
+    def append(self, df: pd.DataFrame, capacity: int):
+        """Ghi các dòng mới thành một segment; compaction khi cần."""
+        if df is None or df.empty:
+            return
+        with self._lock:
+            segments = self._drop_stale(self.segments())
+            if self.schema is None and segments:
+                with pa.memory_map(segments[-1], "r") as source:
+                    self.schema = pa.ipc.open_file(source).schema
+            table, widened = self._to_table(df.iloc[-capacity:])
+            segments.append(self._write_segment(table, self._next_seq(segments)))
+            # Schema bị nới: ghi lại các segment cũ theo schema mới (qua compaction)
+            self._maybe_compact(segments, capacity, force=widened and len(segments) > 1)
+
+    def _maybe_compact(self, segments: List[str], capacity: int, force: bool = False):
+        on_disk = self._next_seq(segments) - _segment_bounds(segments[0])[0]
+        if not force and on_disk <= capacity * BUFFER_STORE_COMPACT_FACTOR \
+                and len(segments) <= BUFFER_STORE_MAX_SEGMENTS:
+            return
+        tail = self._read_tail(segments, capacity, self.schema)
+        end = self._next_seq(segments)
+        new_path = self._write_segment(tail, end - tail.num_rows)
+        for path in segments:
+            if path != new_path:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Cannot remove compacted segment {path}: {e}")
+        logger.info(f"Training buffer store compacted: {len(segments)} segments -> 1 ({tail.num_rows} rows).")
+
+    def load(self, capacity: int) -> pd.DataFrame:
+        """`capacity` dòng mới nhất trên đĩa (DataFrame rỗng nếu chưa có segment)."""
+        with self._lock:
+            segments = self._drop_stale(self.segments())
+            if not segments:
+                return pd.DataFrame()
+            table = self._read_tail(segments, capacity)
+            self.schema = table.schema
+            return table.to_pandas()
+
+    @property
+    def nbytes(self) -> int:
+        return int(sum(os.path.getsize(p) for p in self.segments()))
@@ -18,18 +18,17 @@ import pandas as pd
 import numpy as np
 import lightgbm as lgb
 import time
-import hashlib
+import copy
 import json
 import threading
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from redis import Redis
 
 # --- Import PyTorch ---
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 
 # --- Tắt log rác ---
 logging.getLogger('sqlglot').setLevel(logging.ERROR)
@@ -40,11 +39,20 @@ from sklearn.preprocessing import StandardScaler
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import MODELS_DIR, USER_MODELS_DIR, REDIS_URL
 from engine.features import enhance_features_batch
+from engine.feature_state import UserBaselineStore
+from engine.training_buffer import TrainingRingBuffer
+from engine.buffer_store import TrainingBufferStore
+from engine.model_registry import ModelRegistry, ModelBundle, make_version
+from engine.lgb_scorer import score_batch, encode_frame
 from engine.config_manager import load_config
+from engine.sql_analysis import get_analysis_cache_stats
+from engine.redis_pool import get_redis
+from engine import training_feed
 from utils import (
     get_normalized_query,
     check_access_anomalies, check_insider_threats, check_technical_attacks,
-    check_data_destruction, check_multi_table_anomalies,
+    check_data_destruction, check_multi_table_anomalies, match_signatures,
+    extract_table_lists, explode_tables, time_windows,
     update_behavior_redis, check_behavior_redis
 )
 
@@ -54,12 +62,65 @@ logger = logging.getLogger(__name__)
 
 # --- Constants & Configs ---
 PROD_MODEL_PATH = os.path.join(MODELS_DIR, "lgb_uba_production.joblib")
-FALLBACK_MODEL_PATH = os.path.join(MODELS_DIR, "lgb_uba_fallback.joblib")
+# File parquet cũ (chỉ còn dùng để migrate sang BUFFER_STORE_DIR)
 BUFFER_FILE_PATH = os.path.join(MODELS_DIR, "training_buffer_cache.parquet")
+# Bộ đệm huấn luyện trên đĩa: các segment Arrow append-only (engine/buffer_store.py)
+BUFFER_STORE_DIR = os.path.join(MODELS_DIR, "training_buffer")
 CAT_MAP_PATH = os.path.join(MODELS_DIR, "cat_features_map.joblib")
+# Chế độ đa worker (engine/engine_supervisor.py): user được chia theo hash(user),
+# nên baseline theo user được checkpoint riêng cho từng worker
+WORKER_ID = os.getenv("UBA_WORKER_ID", "")
+BASELINE_FILE_PATH = os.path.join(
+    MODELS_DIR, f"user_baselines_w{WORKER_ID}.parquet" if WORKER_ID else "user_baselines.parquet")
+# Chỉ một worker được buffer + retrain model (tránh nhiều tiến trình cùng ghi file model)
+TRAINING_ENABLED = os.getenv("UBA_TRAINING_ENABLED", "1") == "1"
+# Đa worker: worker không train chuyển dữ liệu huấn luyện cho worker train (engine/training_feed.py),
+# để model dùng chung học trên mọi user chứ không chỉ ~1/N user của phân vùng worker train
+TRAINING_FEED_ENABLED = os.getenv("UBA_TRAINING_FEED", "1" if WORKER_ID else "0") == "1"
+# Hệ số suy giảm baseline theo user mỗi batch (1.0 = giữ toàn bộ lịch sử)
+BASELINE_DECAY = float(os.getenv("UBA_BASELINE_DECAY", "1.0"))
+# Lịch sử chi phí mỗi chu kỳ retrain (JSON lines)
+TRAINING_METRICS_PATH = os.path.join(MODELS_DIR, "training_metrics.jsonl")
+# Số cửa sổ LSTM chấm điểm mỗi lượt (giới hạn bộ nhớ đỉnh khi tính ngưỡng AE)
+AE_INFERENCE_BATCH_SIZE = int(os.getenv("AE_INFERENCE_BATCH_SIZE", "1024"))
+# Số thread intra-op của PyTorch cho AE (0 = mặc định của torch)
+AE_NUM_THREADS = int(os.getenv("AE_NUM_THREADS", "0"))
+# Chu kỳ kiểm tra phiên bản model mới trong registry (worker không train tự hot-swap)
+MODEL_RELOAD_INTERVAL_SEC = float(os.getenv("MODEL_RELOAD_INTERVAL_SEC", "30"))
 
 os.makedirs(MODELS_DIR, exist_ok=True)
 
+
+def _process_memory_mb():
+    """RSS hiện tại của tiến trình (MB), None nếu không đo được."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_memory_mb():
+    """RSS đỉnh của tiến trình (MB, Unix), None nếu không có module resource."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    except ImportError:
+        return None
+
+
+def _configure_torch_threads(num_threads=None):
+    """Đặt số thread intra-op của torch (AE_NUM_THREADS); chỉ gọi set khi giá trị đổi."""
+    n = AE_NUM_THREADS if num_threads is None else num_threads
+    if n > 0 and torch.get_num_threads() != n:
+        torch.set_num_threads(n)
+
 # ==============================================================================
 # 1. CLASSES LSTM AUTOENCODER (PYTORCH)
 # ==============================================================================
@@ -89,12 +150,14 @@ class DeepLSTMAutoEncoder:
     Wrapper class để giả lập hành vi giống PyOD (fit, predict, labels_)
     nhưng chạy bằng PyTorch LSTM bên dưới.
     """
-    def __init__(self, sequence_length=5, hidden_dim=64, epochs=10, contamination=0.05, batch_size=64):
+    def __init__(self, sequence_length=5, hidden_dim=64, epochs=10, contamination=0.05, batch_size=64,
+                 inference_batch_size=None):
         self.seq_len = sequence_length
         self.hidden_dim = hidden_dim
         self.epochs = epochs
         self.contamination = contamination
         self.batch_size = batch_size
+        self.inference_batch_size = max(1, inference_batch_size or AE_INFERENCE_BATCH_SIZE)
         self.model = None
         self.labels_ = None # Sẽ chứa 0 (bình thường) hoặc 1 (bất thường)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -103,54 +166,94 @@ class DeepLSTMAutoEncoder:
     def _create_sequences(self, X):
         """
         Chuyển đổi dữ liệu 2D (Sample, Feat) thành 3D (Sample, Seq, Feat)
-        Sử dụng Sliding Window tối ưu tốc độ bằng numpy strides.
+        Sử dụng Sliding Window bằng numpy strides.
+        Trả về VIEW chỉ đọc (không copy): từng mini-batch được gom ra buffer dựng sẵn
+        khi train/chấm điểm, nên bộ nhớ không tăng theo seq_len x số dòng.
         """
         if len(X) <= self.seq_len:
-            return np.array([])
-        
+            return np.empty((0, self.seq_len, X.shape[1] if np.ndim(X) == 2 else 0), dtype=np.float32)
+
         # Đảm bảo dữ liệu liên tục trong bộ nhớ để tránh lỗi as_strided
-        X = np.ascontiguousarray(X)
+        X = np.ascontiguousarray(X, dtype=np.float32)
 
         num_samples = len(X) - self.seq_len + 1
         sub_shape = (num_samples, self.seq_len, X.shape[1])
         sub_strides = (X.strides[0], X.strides[0], X.strides[1])
-        
-        Xs = np.lib.stride_tricks.as_strided(
+
+        return np.lib.stride_tricks.as_strided(
             X,
             shape=sub_shape,
             strides=sub_strides,
             writeable=False
         )
-        
-        # Copy ra mảng mới để tách biệt bộ nhớ, tránh side-effect khi convert sang Tensor
-        return Xs.copy()
 
-    def fit(self, X):
+    def _batch_buffer(self, X_seq, batch_size):
+        """Buffer float32 (batch, seq, feat) cấp phát một lần và dùng lại cho mọi mini-batch."""
+        return np.empty((min(batch_size, len(X_seq)), self.seq_len, X_seq.shape[2]), dtype=np.float32)
+
+    def reconstruction_errors(self, X_seq):
+        """
+        MSE tái tạo của từng cửa sổ, chấm theo mini-batch cố định dưới torch.inference_mode.
+        Bộ nhớ đỉnh ~ inference_batch_size cửa sổ, không phụ thuộc kích thước buffer.
+        """
+        n = len(X_seq)
+        errors = np.empty(n, dtype=np.float32)
+        if n == 0:
+            return errors
+        _configure_torch_threads()
+        bs = self.inference_batch_size
+        buf = self._batch_buffer(X_seq, bs)
+
+        self.model.eval()
+        with torch.inference_mode():
+            for start in range(0, n, bs):
+                end = min(start + bs, n)
+                chunk = buf[:end - start]
+                np.copyto(chunk, X_seq[start:end])
+                batch_x = torch.from_numpy(chunk).to(self.device)
+                reconstructions = self.model(batch_x)
+                # MSE cho từng mẫu (giảm chiều seq và feat)
+                errors[start:end] = torch.mean((batch_x - reconstructions) ** 2, dim=[1, 2]).cpu().numpy()
+        return errors
+
+    def fit(self, X, warm_start=False, epochs=None):
+        """
+        warm_start=True: tiếp tục huấn luyện từ trọng số hiện tại (chỉ trên dữ liệu mới)
+        với `epochs` vòng thay vì khởi tạo lại model.
+        """
         # 1. Chuẩn bị dữ liệu chuỗi
         # X ở đây kỳ vọng đã được sort theo User & Time bên ngoài
         X_seq = self._create_sequences(X)
-        
+
         if len(X_seq) == 0:
             # Fallback nếu dữ liệu quá ít: Gán nhãn 0 hết
             self.labels_ = np.zeros(len(X))
             return self
 
+        resume = warm_start and self.model is not None and getattr(self, "input_dim", None) == X_seq.shape[2]
         self.input_dim = X_seq.shape[2]
-        
-        # Chuyển sang Tensor
-        dataset = TensorDataset(torch.tensor(X_seq, dtype=torch.float32).to(self.device))
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-
-        # 2. Khởi tạo Model
-        self.model = LSTMAE_Module(self.input_dim, self.hidden_dim).to(self.device)
-        optimizer = optim.Adam(self.model.parameters(), lr=0.001)
+        _configure_torch_threads()
+
+        # 2. Khởi tạo Model (hoặc giữ model + optimizer cũ khi warm start)
+        if not resume:
+            self.model = LSTMAE_Module(self.input_dim, self.hidden_dim).to(self.device)
+        if not resume or getattr(self, "optimizer", None) is None:
+            self.optimizer = optim.Adam(self.model.parameters(), lr=0.001)
+        optimizer = self.optimizer
         criterion = nn.MSELoss()
 
-        # 3. Training Loop
+        # 3. Training Loop: xáo chỉ số cửa sổ mỗi epoch, gom từng mini-batch từ view
+        # vào buffer dựng sẵn (thay cho TensorDataset chứa bản copy toàn bộ cửa sổ)
+        n = len(X_seq)
+        buf = self._batch_buffer(X_seq, self.batch_size)
         self.model.train()
-        for epoch in range(self.epochs):
-            for batch in dataloader:
-                batch_x = batch[0]
+        for epoch in range(epochs or self.epochs):
+            order = np.random.permutation(n)
+            for start in range(0, n, self.batch_size):
+                idx = order[start:start + self.batch_size]
+                chunk = buf[:len(idx)]
+                np.take(X_seq, idx, axis=0, out=chunk)
+                batch_x = torch.from_numpy(chunk).to(self.device)
                 optimizer.zero_grad()
                 output = self.model(batch_x)
                 loss = criterion(output, batch_x)
@@ -158,15 +261,8 @@ class DeepLSTMAutoEncoder:
                 optimizer.step()
 
         # 4. Tính toán Threshold (Ngưỡng) sau khi train
-        self.model.eval()
-        with torch.no_grad():
-            X_tensor = torch.tensor(X_seq, dtype=torch.float32).to(self.device)
-            reconstructions = self.model(X_tensor)
-            
-            # Tính MSE cho từng mẫu (giảm chiều seq và feat)
-            # loss shape: (batch_size, )
-            loss = torch.mean((X_tensor - reconstructions) ** 2, dim=[1, 2]).cpu().numpy()
-        
+        loss = self.reconstruction_errors(X_seq)
+
         # Xác định ngưỡng dựa trên contamination (ví dụ top 5% lỗi cao nhất là bất thường)
         if len(loss) > 0:
             self.threshold_ = np.percentile(loss, 100 * (1 - self.contamination))
@@ -174,15 +270,42 @@ class DeepLSTMAutoEncoder:
         else:
             self.threshold_ = 0
             seq_labels = np.array([])
-        
+
         # 5. Gán nhãn (Labels)
         # Vì tạo sequence làm mất (seq_len - 1) dòng đầu, ta cần pad thêm 0 vào đầu
         # để độ dài labels_ khớp với độ dài X ban đầu.
         padding = np.zeros(self.seq_len - 1, dtype=int)
         self.labels_ = np.concatenate([padding, seq_labels])
-        
+
         return self
 
+    def get_state(self):
+        """Trạng thái để lưu vào model registry (trọng số copy ra CPU)."""
+        if self.model is None:
+            return None
+        return {
+            "sequence_length": self.seq_len,
+            "hidden_dim": self.hidden_dim,
+            "epochs": self.epochs,
+            "contamination": self.contamination,
+            "batch_size": self.batch_size,
+            "inference_batch_size": self.inference_batch_size,
+            "input_dim": self.input_dim,
+            "threshold": float(self.threshold_),
+            "state_dict": {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()},
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        ae = cls(sequence_length=state["sequence_length"], hidden_dim=state["hidden_dim"],
+                 epochs=state["epochs"], contamination=state["contamination"], batch_size=state["batch_size"],
+                 inference_batch_size=state.get("inference_batch_size"))
+        ae.input_dim = state["input_dim"]
+        ae.threshold_ = state["threshold"]
+        ae.model = LSTMAE_Module(ae.input_dim, ae.hidden_dim).to(ae.device)
+        ae.model.load_state_dict(state["state_dict"])
+        return ae
+
 # ==============================================================================
 # 2. CONFIGURATION
 # ==============================================================================
@@ -197,6 +320,8 @@ DEFAULT_ML_CONFIG = {
     "ae_contamination": 0.039,
     "ae_epochs": 20,
     "ae_batch_size": 64,
+    # Mini-batch khi chấm điểm AE (tính ngưỡng) - giới hạn bộ nhớ đỉnh
+    "ae_inference_batch_size": AE_INFERENCE_BATCH_SIZE,
     
     # [FIX] Số nguyên (int) thay vì list, khớp với LSTMAE_Module
     "ae_hidden_dim": 64,       
@@ -214,7 +339,15 @@ DEFAULT_ML_CONFIG = {
     "lgb_scale_pos_weight": 30.03,
 
     "inference_quantile_threshold": 0.99,
-    "inference_min_threshold": 0.75
+    "inference_min_threshold": 0.75,
+
+    # --- Huấn luyện tăng dần ---
+    # Bật: AE train tiếp từ trọng số cũ, LightGBM boost thêm cây (init_model) chỉ trên dữ liệu mới
+    "incremental_training": True,
+    "incremental_min_rows": 100,      # Số dòng mới tối thiểu để chạy một chu kỳ tăng dần
+    "ae_incremental_epochs": 3,
+    "lgb_incremental_estimators": 50,
+    "lgb_max_trees": 1000             # Vượt ngưỡng -> full retrain để model không phình mãi
 }
 
 # ==============================================================================
@@ -225,16 +358,26 @@ class ProductionUBAEngine:
     def __init__(self, config=None):
         self.config = config if config else DEFAULT_ML_CONFIG
 
-        self.model = None
-        self.fallback_model = None
-        self.features = None
-        self.model_version = "unknown"
+        # Bundle bất biến (model + features + cat_mapping + scaler + AE state) dùng cho inference.
+        # Chỉ được thay bằng một phép gán tham chiếu khi có phiên bản mới.
+        self.bundle = None
+        self.registry = ModelRegistry()
         self.last_trained = None
-        self.cat_mapping = {}
+        self._last_reload_check = time.time()
+        self._reloading = False
+        self._failed_version = None
 
         self.MIN_TRAIN_SIZE = self.config["min_train_size"]
         self.MAX_BUFFER_SIZE = self.config["max_buffer_size"]
         self.SAVE_INTERVAL_SEC = self.config["save_interval_sec"]
+        self.INCREMENTAL = self.config.get("incremental_training", False)
+        self.INCREMENTAL_MIN_ROWS = self.config.get("incremental_min_rows", self.MIN_TRAIN_SIZE)
+
+        # Trạng thái cho huấn luyện tăng dần (AE + scaler giữ trong bộ nhớ)
+        self.ae = None
+        self.scaler = None
+        self.trained_seq = 0   # mốc buffer (total_appended) đã được huấn luyện tới
+        self.training_history = deque(maxlen=100)
 
         self.last_save_time = time.time()
 
@@ -242,19 +385,33 @@ class ProductionUBAEngine:
         self.train_lock = threading.Lock()
         self.is_training = False
 
-        # Khởi tạo Buffer
-        self.training_buffer = self._load_buffer_from_disk()
+        # Khởi tạo Buffer (ring buffer NumPy; worker không train thì không cần buffer)
+        self.buffer_store = TrainingBufferStore(BUFFER_STORE_DIR) if TRAINING_ENABLED else None
+        restored, on_disk = self._load_buffer_from_disk() if TRAINING_ENABLED else (None, True)
+        self.training_buffer = TrainingRingBuffer.from_frame(restored, self.MAX_BUFFER_SIZE)
+        # Mốc buffer (total_appended) đã ghi ra đĩa; buffer migrate từ parquet cũ sẽ được ghi lại toàn bộ
+        self.persisted_seq = self.training_buffer.total_appended if on_disk else 0
+        self.training_feed = (training_feed.TrainingFeedConsumer(f"trainer-w{WORKER_ID}")
+                              if TRAINING_ENABLED and TRAINING_FEED_ENABLED else None)
         self.load_models()
 
-    def _load_buffer_from_disk(self) -> pd.DataFrame:
+    def _load_buffer_from_disk(self):
+        """(DataFrame, đã nằm trong buffer store hay chưa)."""
+        try:
+            df = self.buffer_store.load(self.MAX_BUFFER_SIZE)
+            if not df.empty:
+                logger.info(f"🔄 Restored training buffer: {len(df)} rows.")
+                return df, True
+        except Exception as e:
+            logger.error(f"Failed to load buffer store: {e}")
         if os.path.exists(BUFFER_FILE_PATH):
             try:
                 df = pd.read_parquet(BUFFER_FILE_PATH)
-                logger.info(f"🔄 Restored training buffer: {len(df)} rows.")
-                return df
+                logger.info(f"🔄 Restored training buffer from legacy parquet: {len(df)} rows.")
+                return df, False
             except Exception as e:
                 logger.error(f"Failed to load buffer: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), True
 
     def _save_buffer_to_disk(self, force=False):
         now = time.time()
@@ -262,89 +419,227 @@ class ProductionUBAEngine:
             return
 
         try:
-            str_cols = ['error_message', 'query', 'normalized_query',
-                        'user', 'database', 'client_ip', 'connection_type', 'command_type',
-                        'event_name', 'suspicious_func_name', 'privilege_cmd_name',
-                        'unusual_activity_reason']
-
-            df_to_save = self.training_buffer.copy()
-            for col in str_cols:
-                if col in df_to_save.columns:
-                    df_to_save[col] = df_to_save[col].astype(str)
-
-            df_to_save.to_parquet(BUFFER_FILE_PATH, index=False)
+            # Chỉ ghi các dòng mới từ lần lưu trước (một segment), không ghi lại cả buffer
+            df_new, mark = self.training_buffer.frame_since(self.persisted_seq)
+            self.buffer_store.append(df_new, self.MAX_BUFFER_SIZE)
+            self.persisted_seq = mark
             self.last_save_time = now
         except Exception as e:
             logger.error(f"Failed to persist buffer: {e}")
 
+    # --- Truy cập nhanh vào bundle hiện tại (mỗi lần đọc có thể thấy bundle khác;
+    #     code inference nên lấy `bundle = uba_engine.bundle` một lần cho cả batch) ---
+    @property
+    def model(self):
+        return self.bundle.model if self.bundle else None
+
+    @property
+    def features(self):
+        return list(self.bundle.features) if self.bundle else None
+
+    @property
+    def cat_mapping(self):
+        return self.bundle.cat_mapping if self.bundle else {}
+
+    @property
+    def model_version(self):
+        return self.bundle.version if self.bundle else "unknown"
+
+    def _load_legacy_model(self):
+        """Model joblib đơn lẻ của bản cũ (trước registry)."""
+        if not os.path.exists(PROD_MODEL_PATH):
+            return None
+        try:
+            data = joblib.load(PROD_MODEL_PATH)
+            cat_mapping = joblib.load(CAT_MAP_PATH) if os.path.exists(CAT_MAP_PATH) else {}
+            return ModelBundle(version=data.get('version', 'v0'), model=data['model'],
+                               features=tuple(data['features']), cat_mapping=cat_mapping,
+                               trained_at=data.get('trained_at', ''))
+        except Exception as e:
+            logger.error(f"Failed load legacy prod model: {e}")
+            return None
+
     def load_models(self):
-        if os.path.exists(PROD_MODEL_PATH):
-            try:
-                data = joblib.load(PROD_MODEL_PATH)
-                self.model = data['model']
-                self.features = data['features']
-                if os.path.exists(CAT_MAP_PATH):
-                    self.cat_mapping = joblib.load(CAT_MAP_PATH)
-                self.model_version = data.get('version', 'v0')
-                logger.info(f"Loaded PRODUCTION model v{self.model_version}")
-                return
-            except Exception as e:
-                logger.error(f"Failed load prod model: {e}")
+        bundle = self.registry.load_latest_valid() or self._load_legacy_model()
+        if bundle is not None:
+            self._restore_training_state(bundle)
+            self.bundle = bundle
+            logger.info(f"Loaded PRODUCTION model {bundle.version}")
+            return
 
-        if not self.training_buffer.empty and len(self.training_buffer) >= self.MIN_TRAIN_SIZE:
+        if len(self.training_buffer) >= self.MIN_TRAIN_SIZE:
             logger.info("No model found. Triggering initial background training...")
             self.train_and_update(pd.DataFrame())
 
-    def save_production_model(self, model, features):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        version_hash = hashlib.md5(str(features).encode()).hexdigest()[:8]
-        version = f"v{timestamp}_{version_hash}"
-
-        data = {
-            'model': model,
-            'features': features,
-            'version': version,
-            'trained_at': datetime.now().isoformat(),
-            'feature_count': len(features)
-        }
-        joblib.dump(data, PROD_MODEL_PATH)
-        joblib.dump(data, FALLBACK_MODEL_PATH)
-        logger.info(f"✅ New PRODUCTION model saved: {version}")
+    def _restore_training_state(self, bundle):
+        """Khôi phục AE + scaler từ bundle để lần train kế tiếp có thể chạy tăng dần."""
+        if not TRAINING_ENABLED or bundle.ae_state is None or bundle.scaler is None:
+            return
+        try:
+            self.ae = DeepLSTMAutoEncoder.from_state(bundle.ae_state)
+            self.scaler = copy.deepcopy(bundle.scaler)
+            # Dữ liệu khôi phục từ đĩa coi như đã được học
+            self.trained_seq = self.training_buffer.total_appended
+        except Exception as e:
+            logger.warning(f"Cannot restore AE state from {bundle.version}: {e}")
+            self.ae, self.scaler = None, None
+
+    def save_production_model(self, model, features, cat_mapping, mode="full"):
+        """Đóng gói model + scaler + AE state thành bundle, publish vào registry rồi hot-swap."""
+        bundle = ModelBundle(
+            version=make_version(features),
+            model=model,
+            features=tuple(features),
+            cat_mapping=cat_mapping,
+            # Bản sao: scaler/AE sống tiếp trong thread train (partial_fit, warm start)
+            scaler=copy.deepcopy(self.scaler),
+            ae_state=self.ae.get_state() if self.ae is not None else None,
+            trained_at=datetime.now().isoformat(),
+            metadata={"mode": mode, "feature_count": len(features)},
+        )
+        try:
+            self.registry.publish(bundle)
+            logger.info(f"✅ New PRODUCTION model saved: {bundle.version}")
+        except Exception as e:
+            logger.error(f"Model registry publish failed ({e}); using {bundle.version} in memory only.")
+        self.bundle = bundle  # Hot-swap: một phép gán tham chiếu
+
+    def maybe_reload(self):
+        """Nạp nền phiên bản mới do tiến trình khác publish (không chặn inference)."""
+        now = time.time()
+        if self._reloading or now - self._last_reload_check < MODEL_RELOAD_INTERVAL_SEC:
+            return
+        self._last_reload_check = now
+        version = self.registry.current_version()
+        if not version or version == self._failed_version or \
+                (self.bundle is not None and self.bundle.version == version):
+            return
+        self._reloading = True
+        threading.Thread(target=self._reload_target, args=(version,), daemon=True).start()
+
+    def _reload_target(self, version):
+        try:
+            bundle = self.registry.load(version)
+            self.bundle = bundle
+            logger.info(f"🔁 Hot-swapped model to {version}")
+        except Exception as e:
+            self._failed_version = version  # Không thử lại phiên bản hỏng ở mỗi chu kỳ
+            logger.error(f"Model reload of {version} failed: {e}")
+        finally:
+            self._reloading = False
 
     def _train_thread_target(self):
         with self.train_lock:
             self.is_training = True
+            started, cpu_started = time.time(), time.thread_time()
+            mem_before = _process_memory_mb()
+            mode, rows = None, 0
             try:
                 logger.info(f"🏋️ Background Training Started... Buffer size: {len(self.training_buffer)}")
-                self._train_core()
+                mode, rows = self._train_core()
                 logger.info("🎉 Background Training Finished.")
             except Exception as e:
                 logger.error(f"⚠️ Background Training Failed: {e}", exc_info=True)
             finally:
                 self.is_training = False
+                if mode:
+                    self._record_training_cycle(mode, rows, time.time() - started,
+                                                time.thread_time() - cpu_started, mem_before)
+
+    def _record_training_cycle(self, mode, rows, wall_sec, cpu_sec, mem_before):
+        """Ghi chi phí một chu kỳ retrain (thời gian + bộ nhớ) để theo dõi theo thời gian."""
+        mem_after = _process_memory_mb()
+        peak = _peak_memory_mb()
+        try:
+            lgb_trees = self.model.booster_.current_iteration() if self.model is not None else 0
+        except Exception:
+            lgb_trees = None
+        stats = {
+            "ts": datetime.now().isoformat(),
+            "mode": mode,
+            "rows": rows,
+            "buffer_rows": len(self.training_buffer),
+            "buffer_mb": round(self.training_buffer.nbytes / 2 ** 20, 2),
+            "wall_sec": round(wall_sec, 3),
+            "cpu_sec": round(cpu_sec, 3),
+            "rss_before_mb": round(mem_before, 1) if mem_before is not None else None,
+            "rss_after_mb": round(mem_after, 1) if mem_after is not None else None,
+            "peak_rss_mb": round(peak, 1) if peak is not None else None,
+            "lgb_trees": lgb_trees,
+        }
+        self.training_history.append(stats)
+        logger.info(f"📈 Training cycle [{mode}]: {rows} rows in {stats['wall_sec']}s "
+                    f"(cpu {stats['cpu_sec']}s), RSS {stats['rss_before_mb']} -> {stats['rss_after_mb']} MB")
+        try:
+            with open(TRAINING_METRICS_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(stats) + "\n")
+        except OSError as e:
+            logger.warning(f"Cannot append training metrics: {e}")
+
+    # Cột không dùng làm feature
+    EXCLUDE_FEATURE_COLS = [
+        'timestamp', 'event_id',
+        'query', 'normalized_query', 'error_message',
+        'is_anomaly', 'ml_anomaly_score', 'unusual_activity_reason', 'analysis_type',
+        'accessed_tables', 'sensitive_access_info', 'tables_touched',
+        'suspicious_func_name', 'privilege_cmd_name', 'error_code', 'behavior_group'
+    ]
+    CAT_COLS = ['user', 'client_ip', 'database', 'command_type']
+
+    def _select_features(self, df):
+        potential_feats = df.select_dtypes(include=[np.number, 'category', 'object']).columns.tolist()
+        return [f for f in potential_feats if f not in self.EXCLUDE_FEATURE_COLS]
+
+    @staticmethod
+    def _category_codes(X):
+        X_ae = X.copy()
+        for col in X_ae.columns:
+            if X_ae[col].dtype.name == 'category':
+                X_ae[col] = X_ae[col].cat.codes
+        return X_ae
+
+    def _new_lgb_model(self, n_estimators):
+        return lgb.LGBMClassifier(
+            n_estimators=n_estimators,
+            learning_rate=self.config["lgb_learning_rate"],
+            num_leaves=self.config["lgb_num_leaves"],
+            scale_pos_weight=self.config["lgb_scale_pos_weight"],
+            random_state=42,
+            n_jobs=-1,
+            verbose=-1
+        )
+
+    def _needs_full_retrain(self):
+        bundle = self.bundle
+        if not self.INCREMENTAL or bundle is None or not bundle.features:
+            return True
+        if self.ae is None or self.ae.model is None or self.scaler is None:
+            return True
+        try:
+            return bundle.model.booster_.current_iteration() >= self.config.get("lgb_max_trees", 1000)
+        except Exception:
+            return True
 
     def _train_core(self):
-        if len(self.training_buffer) < self.MIN_TRAIN_SIZE:
-            return False
+        """Trả về (mode, số dòng đã train) hoặc (None, 0) nếu bỏ qua / lỗi."""
+        if self._needs_full_retrain():
+            return self._train_full()
+        return self._train_incremental()
 
-        exclude_cols = [
-            'timestamp', 'event_id',
-            'query', 'normalized_query', 'error_message',
-            'is_anomaly', 'ml_anomaly_score', 'unusual_activity_reason', 'analysis_type',
-            'accessed_tables', 'sensitive_access_info', 'tables_touched',
-            'suspicious_func_name', 'privilege_cmd_name', 'error_code', 'behavior_group'
-        ]
+    def _train_full(self):
+        df_buffer, mark = self.training_buffer.snapshot()
+        if len(df_buffer) < self.MIN_TRAIN_SIZE:
+            return None, 0
 
-        potential_feats = self.training_buffer.select_dtypes(include=[np.number, 'category', 'object']).columns.tolist()
-        self.features = [f for f in potential_feats if f not in exclude_cols]
+        features = self._select_features(df_buffer)
 
         # [FIX] QUAN TRỌNG: Sắp xếp dữ liệu theo User và Thời gian trước khi train
         # Để LSTM học được chuỗi hành vi liền mạch của từng người
-        df_sorted = self.training_buffer.sort_values(by=['user', 'timestamp']).copy()
+        df_sorted = df_buffer.sort_values(by=['user', 'timestamp'])
 
-        X = df_sorted[self.features].copy()
+        X = df_sorted[features].copy()
 
-        cat_cols = ['user', 'client_ip', 'database', 'command_type']
+        cat_cols = self.CAT_COLS
         current_mapping = {}
 
         for col in X.columns:
@@ -354,14 +649,9 @@ class ProductionUBAEngine:
             else:
                 X[col] = pd.to_numeric(X[col], errors='coerce').fillna(0)
 
-        self.cat_mapping = current_mapping
-        joblib.dump(self.cat_mapping, CAT_MAP_PATH)
 
         try:
-            X_ae = X.copy()
-            for col in X_ae.columns:
-                if X_ae[col].dtype.name == 'category':
-                    X_ae[col] = X_ae[col].cat.codes
+            X_ae = self._category_codes(X)
 
             scaler = StandardScaler()
             # Convert sang float32 để nhẹ gánh cho PyTorch
@@ -373,7 +663,8 @@ class ProductionUBAEngine:
                 hidden_dim=self.config.get("ae_hidden_dim", 64),
                 epochs=self.config.get("ae_epochs", 20),
                 contamination=self.config["ae_contamination"],
-                batch_size=self.config.get("ae_batch_size", 64)
+                batch_size=self.config.get("ae_batch_size", 64),
+                inference_batch_size=self.config.get("ae_inference_batch_size", AE_INFERENCE_BATCH_SIZE)
             )
 
             # Fit mô hình (Hàm này đã tự xử lý chuyển đổi chuỗi 3D bên trong)
@@ -381,79 +672,150 @@ class ProductionUBAEngine:
             pseudo_labels = ae.labels_
             # --- END NEW CODE ---
 
-            lgb_model = lgb.LGBMClassifier(
-                n_estimators=self.config["lgb_n_estimators"],
-                learning_rate=self.config["lgb_learning_rate"],
-                num_leaves=self.config["lgb_num_leaves"],
-                scale_pos_weight=self.config["lgb_scale_pos_weight"],
-                random_state=42,
-                n_jobs=-1,
-                verbose=-1
-            )
+            lgb_model = self._new_lgb_model(self.config["lgb_n_estimators"])
 
             lgb_cat_cols = [c for c in cat_cols if c in X.columns]
             
             # Lưu ý: pseudo_labels được sinh ra từ X đã sort, nên X đưa vào LGBM cũng phải là X (đã sort)
             lgb_model.fit(X, pseudo_labels, categorical_feature=lgb_cat_cols)
 
-            self.save_production_model(lgb_model, self.features)
-            self.model = lgb_model
-            return True
+            self.ae, self.scaler = ae, scaler
+            self.trained_seq = mark
+            self.save_production_model(lgb_model, features, current_mapping, mode="full")
+            return "full", len(df_buffer)
 
         except Exception as e:
             logger.error(f"Training core failed: {e}", exc_info=True)
-            return False
+            return None, 0
 
-    def train_and_update(self, df_enhanced):
-        if not df_enhanced.empty:
-            self.training_buffer = pd.concat([self.training_buffer, df_enhanced], ignore_index=True)
+    def _train_incremental(self):
+        """AE train tiếp từ trọng số hiện tại + LightGBM boost thêm cây, chỉ trên dòng mới từ lần train trước."""
+        df_new, mark = self.training_buffer.frame_since(self.trained_seq)
+        if len(df_new) < self.INCREMENTAL_MIN_ROWS:
+            return None, 0
+
+        bundle = self.bundle
+        features = list(bundle.features)
+        # Tập feature đổi (cột mới/mất cột) -> không boost tiếp được trên model cũ
+        if self._select_features(df_new) != features:
+            logger.info("Feature set changed, falling back to full retrain.")
+            return self._train_full()
+
+        try:
+            df_sorted = df_new.sort_values(by=['user', 'timestamp'])
+            # Mã hóa theo cat_mapping hiện có (giống lúc inference) để cây cũ và cây mới dùng chung mã category
+            X = encode_frame(df_sorted, features, bundle.cat_mapping)
+
+            X_ae = self._category_codes(X)
+            self.scaler.partial_fit(X_ae)
+            X_ae_scaled = self.scaler.transform(X_ae).astype(np.float32)
+
+            self.ae.fit(X_ae_scaled, warm_start=True, epochs=self.config.get("ae_incremental_epochs", 3))
+            pseudo_labels = self.ae.labels_
+            self.trained_seq = mark
 
-            if len(self.training_buffer) > self.MAX_BUFFER_SIZE:
-                self.training_buffer = self.training_buffer.iloc[-self.MAX_BUFFER_SIZE:]
+            if len(np.unique(pseudo_labels)) < 2:
+                logger.info("Incremental batch has a single pseudo-label class; LightGBM update skipped.")
+                return "incremental_ae", len(df_new)
 
+            lgb_model = self._new_lgb_model(self.config.get("lgb_incremental_estimators", 50))
+            lgb_cat_cols = [c for c in self.CAT_COLS if c in X.columns]
+            lgb_model.fit(X, pseudo_labels, categorical_feature=lgb_cat_cols, init_model=bundle.model)
+
+            self.save_production_model(lgb_model, features, bundle.cat_mapping, mode="incremental")
+            return "incremental", len(df_new)
+
+        except Exception as e:
+            logger.error(f"Incremental training failed: {e}", exc_info=True)
+            return None, 0
+
+    def train_and_update(self, df_enhanced):
+        if not TRAINING_ENABLED:
+            if TRAINING_FEED_ENABLED:
+                training_feed.publish(df_enhanced, WORKER_ID)
+            return False
+
+        # Dữ liệu huấn luyện do các worker khác chuyển tới (phân vùng user của chúng)
+        frames = self.training_feed.drain() if self.training_feed is not None else []
+        if not df_enhanced.empty:
+            frames.append(df_enhanced)
+        if frames:
+            # Ghi vòng vào buffer cấp phát sẵn (không concat / cắt đuôi)
+            for frame in frames:
+                self.training_buffer.append(frame)
             self._save_buffer_to_disk(force=False)
 
-        if len(self.training_buffer) >= self.MIN_TRAIN_SIZE:
-            if not self.is_training:
-                t = threading.Thread(target=self._train_thread_target, daemon=True)
-                t.start()
-                return True
-        return False
+        if len(self.training_buffer) < self.MIN_TRAIN_SIZE or self.is_training:
+            return False
+        # Chế độ tăng dần: chỉ train khi đủ dòng mới từ lần train trước
+        if not self._needs_full_retrain() and \
+                self.training_buffer.rows_since(self.trained_seq) < self.INCREMENTAL_MIN_ROWS:
+            return False
+
+        t = threading.Thread(target=self._train_thread_target, daemon=True)
+        t.start()
+        return True
 
 
 # Global instance
 uba_engine = ProductionUBAEngine()
+# Baseline z-score theo user, giữ qua các batch và checkpoint ra đĩa
+user_baseline_store = UserBaselineStore(decay=BASELINE_DECAY, checkpoint_path=BASELINE_FILE_PATH)
+
+
+def rule_hit_table(anomalies_dict):
+    """
+    Dict {RuleName: [indexes]} -> (bảng thưa (row, rule_id) không trùng, danh sách tên rule).
+    rule_id là vị trí của rule trong dict (giữ thứ tự rule khi nối lý do).
+    """
+    rule_names = list(anomalies_dict)
+    lengths = [len(v) for v in anomalies_dict.values()]
+    if not sum(lengths):
+        return pd.DataFrame(columns=['row', 'rule_id']), rule_names
+    rows = np.concatenate([np.asarray(list(v)) for v in anomalies_dict.values() if len(v)])
+    rule_ids = np.repeat(np.arange(len(rule_names)), lengths)
+    return pd.DataFrame({'row': rows, 'rule_id': rule_ids}).drop_duplicates(), rule_names
+
+
+def _rule_patterns(hits):
+    """Mẫu rule của mỗi dòng: bitmask int64 (<= 63 rule), nếu nhiều rule hơn thì tuple rule_id."""
+    if hits['rule_id'].max() < 63:
+        bits = np.left_shift(np.int64(1), hits['rule_id'].to_numpy(dtype=np.int64))
+        # (row, rule_id) không trùng nên tổng = OR các bit
+        return pd.Series(bits, index=hits.index).groupby(hits['row'].to_numpy()).sum()
+    return hits.sort_values('rule_id').groupby('row')['rule_id'].agg(tuple)
 
 
 def process_rule_results(df_logs, anomalies_dict, group_name):
     """
     Chuyển đổi Dict {RuleName: [indexes]} thành DataFrame.
     Gán cột 'specific_rule' để biết chính xác lỗi gì.
+    Chuỗi lý do được dựng một lần cho mỗi mẫu rule khác nhau rồi map ngược về từng dòng.
     """
     if not anomalies_dict:
         return pd.DataFrame()
 
-    all_indices = set()
-    for indices in anomalies_dict.values():
-        all_indices.update(indices)
-
-    if not all_indices:
+    hits, rule_names = rule_hit_table(anomalies_dict)
+    if hits.empty:
         return pd.DataFrame()
 
+    patterns = _rule_patterns(hits)
+
+    def reason(pattern):
+        # Nối tên rule theo thứ tự trong dict (nối chuỗi nếu dính nhiều rule)
+        if isinstance(pattern, tuple):
+            return "; ".join(rule_names[i] for i in pattern)
+        return "; ".join(name for i, name in enumerate(rule_names) if (int(pattern) >> i) & 1)
+
+    codes, unique_patterns = pd.factorize(patterns)
+    reasons = np.array([reason(p) for p in unique_patterns], dtype=object)
+
     # Lấy các dòng vi phạm
-    df_result = df_logs.loc[list(all_indices)].copy()
+    df_result = df_logs.loc[patterns.index].copy()
 
-    # Gán nhãn nhóm
+    # Gán nhãn nhóm + nhãn chi tiết
     df_result['behavior_group'] = group_name
-    df_result['specific_rule'] = ''
-
-    # Gán nhãn chi tiết (nối chuỗi nếu dính nhiều rule)
-    for rule_name, indices in anomalies_dict.items():
-        mask = df_result.index.isin(indices)
-        # Nếu đã có text rồi thì thêm dấu chấm phẩy
-        df_result.loc[mask & (df_result['specific_rule'] != ''), 'specific_rule'] += f"; {rule_name}"
-        # Nếu chưa có thì gán mới
-        df_result.loc[mask & (df_result['specific_rule'] == ''), 'specific_rule'] = rule_name
+    df_result['specific_rule'] = reasons[codes]
 
     return df_result
 
@@ -468,61 +830,53 @@ def load_engine_config_dynamic():
         return {}
 
 
-def _aggregate_multi_table_alerts(df_rule_multi):
+def _aggregate_multi_table_alerts(df_rule_multi, table_lists=None):
     """
     Hàm hỗ trợ: Gom nhóm các log vi phạm Multi-table thành các Session cảnh báo.
-    Input: DataFrame chứa các log vi phạm (df_rule_multi)
+    Input: DataFrame chứa các log vi phạm (df_rule_multi), table_lists: tuple bảng đã
+           trích xuất bởi Rule 30 (index theo log) - không parse lại SQL.
     Output: DataFrame chứa thông tin tổng hợp (Session level)
     """
     if df_rule_multi.empty:
         return pd.DataFrame()
 
-    aggregated_data = []
-
-    # Gom nhóm theo User và cửa sổ thời gian (ví dụ: mỗi 5 phút là 1 session tấn công)
-    # Lưu ý: Cần sort trước khi group
-    df_sorted = df_rule_multi.sort_values('timestamp')
+    if table_lists is None:
+        table_lists = extract_table_lists(df_rule_multi['query'])
 
-    # Sử dụng Grouper 5 phút để tách các đợt tấn công khác nhau của cùng 1 user
-    grouped = df_sorted.groupby(['user', pd.Grouper(key='timestamp', freq='5Min')], observed=False)
+    # Gom nhóm theo User và cửa sổ thời gian (mỗi 5 phút là 1 session tấn công)
+    df_sorted = df_rule_multi.sort_values('timestamp', kind='stable')
+    exploded = explode_tables(df_sorted, table_lists, 5)
 
-    for (user, time_window), group in grouped:
-        
-        client_ip = 'unknown'
-        if 'client_ip' in group.columns and not group['client_ip'].empty:
-            client_ip = group['client_ip'].iloc[0]
-
-        # Lấy danh sách bảng bị truy cập trong session này
-        from engine.utils import get_tables_with_sqlglot  # Import hàm này
-
-        all_tables = set()
-        queries_details = []
-
-        for _, row in group.iterrows():
-            tbls = get_tables_with_sqlglot(row['query'])
-            all_tables.update(tbls)
-
-            queries_details.append({
-                "timestamp": row['timestamp'].isoformat() if pd.notna(row['timestamp']) else "",
-                "query": row['query']
-            })
-
-        if len(all_tables) < 2:
-            continue
+    # Số bảng khác nhau mỗi session: explode + drop_duplicates + groupby (giữ thứ tự xuất hiện)
+    session_tables = exploded.drop_duplicates(['user', 'window', 'table']) \
+        .groupby(['user', 'window'], observed=True)['table'].agg(list)
+    session_tables = session_tables[session_tables.map(len) >= 2]
+    if session_tables.empty:
+        return pd.DataFrame()
 
-        aggregated_data.append({
-            "user": user,
-            "client_ip": client_ip,
-            "start_time": group['timestamp'].min(),
-            "end_time": group['timestamp'].max(),
-            "tables_accessed_in_session": list(all_tables),
-            "distinct_tables_count": len(all_tables),
-            "queries_details": queries_details,
-            "anomaly_type": "multi_table_access",
-            "behavior_group": "MULTI_TABLE_ACCESS"
-        })
+    sessions = df_sorted[['user', 'timestamp']].assign(
+        window=time_windows(df_sorted['timestamp'], 5),
+        client_ip=df_sorted['client_ip'] if 'client_ip' in df_sorted.columns else 'unknown',
+        detail=[{"timestamp": ts.isoformat() if pd.notna(ts) else "", "query": q}
+                for ts, q in zip(df_sorted['timestamp'], df_sorted['query'])],
+    )
+    keys = pd.MultiIndex.from_arrays([sessions['user'], sessions['window']])
+    sessions = sessions[keys.isin(session_tables.index)]
+    agg = sessions.groupby(['user', 'window'], observed=True, sort=True).agg(
+        client_ip=('client_ip', 'first'),
+        start_time=('timestamp', 'min'),
+        end_time=('timestamp', 'max'),
+        queries_details=('detail', list),
+    )
+    agg['tables_accessed_in_session'] = session_tables.reindex(agg.index)
+    agg['distinct_tables_count'] = agg['tables_accessed_in_session'].map(len)
+    agg['anomaly_type'] = "multi_table_access"
+    agg['behavior_group'] = "MULTI_TABLE_ACCESS"
 
-    return pd.DataFrame(aggregated_data)
+    return agg.reset_index(level='user').reset_index(drop=True)[[
+        "user", "client_ip", "start_time", "end_time", "tables_accessed_in_session",
+        "distinct_tables_count", "queries_details", "anomaly_type", "behavior_group"
+    ]]
 
 
 def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
@@ -555,7 +909,7 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
     if df_logs.empty: return {"all_logs": df_logs}
 
     # Feature Extraction
-    df_enhanced, ML_FEATURES = enhance_features_batch(df_logs.copy())
+    df_enhanced, ML_FEATURES = enhance_features_batch(df_logs.copy(), baseline_store=user_baseline_store)
     df_logs = df_enhanced
 
     # ==========================================================================
@@ -564,11 +918,17 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
     logging.info("--- Phase 1: Running Rules ---")
 
     try:
+        # Quét chữ ký một lần cho cả batch, các rule dùng chung ma trận kết quả
+        signature_matches = match_signatures(df_logs, combined_rules_config)
+
         dict_access = check_access_anomalies(df_logs, combined_rules_config)
-        dict_insider = check_insider_threats(df_logs, combined_rules_config)
-        dict_technical = check_technical_attacks(df_logs, combined_rules_config)
-        dict_destruction = check_data_destruction(df_logs, combined_rules_config)
-        dict_multi_table = check_multi_table_anomalies(df_logs, combined_rules_config)
+        dict_insider = check_insider_threats(df_logs, combined_rules_config, signature_matches)
+        dict_technical = check_technical_attacks(df_logs, combined_rules_config, signature_matches)
+        dict_destruction = check_data_destruction(df_logs, combined_rules_config, signature_matches)
+        # Danh sách bảng trích xuất một lần (mỗi query khác nhau), dùng chung cho Rule 30 và bước tổng hợp
+        multi_table_lists = extract_table_lists(df_logs.loc[signature_matches['multi_table_target'], 'query'])
+        dict_multi_table = check_multi_table_anomalies(
+            df_logs, combined_rules_config, signature_matches, table_lists=multi_table_lists)
 
         df_rule_access = process_rule_results(df_logs, dict_access, 'ACCESS_ANOMALY')
         df_rule_insider = process_rule_results(df_logs, dict_insider, 'INSIDER_THREAT')
@@ -578,11 +938,13 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
     except Exception as e:
         logging.error(f"Rule Engine Error: {e}", exc_info=True)
         df_rule_access = df_rule_insider = df_rule_technical = df_rule_destruction = df_rule_multi = pd.DataFrame()
+        multi_table_lists = None
 
     anomalies_user_time = pd.DataFrame()
     # Redis Profiling
     try:
-        redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+        # Client dùng connection pool chung (không mở socket mới mỗi batch)
+        redis_client = get_redis()
         profile_threshold = combined_rules_config.get('thresholds', {}).get('min_occurrences_threshold', 5)
 
         current_indices_to_check = df_logs.index.difference(
@@ -605,7 +967,6 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
         # Learning
         df_to_learn = df_logs[~df_logs.index.isin(df_rule_technical.index)]
         update_behavior_redis(redis_client, df_to_learn)
-        redis_client.close()
         
     except Exception as e:
         logging.error(f"Redis Behavioral Profiling Failed: {e}")
@@ -634,27 +995,14 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
 
         # 1. Train Background
         uba_engine.train_and_update(df_for_ml)
+        uba_engine.maybe_reload()
 
-        # 2. Predict
-        if uba_engine.model and uba_engine.features:
+        # 2. Predict (giữ một tham chiếu bundle cho cả batch: train có swap giữa chừng cũng không lệch)
+        bundle = uba_engine.bundle
+        if bundle is not None and bundle.model and bundle.features:
             try:
-                X = df_for_ml.copy()
-                for f in uba_engine.features:
-                    if f not in X.columns: X[f] = 0
-                X = X[uba_engine.features]
-
-                for col in X.columns:
-                    if col in uba_engine.cat_mapping:
-                        known_cats = uba_engine.cat_mapping[col]
-                        X[col] = X[col].astype(str).astype(pd.CategoricalDtype(categories=known_cats))
-                        if 'unknown' in known_cats:
-                            X[col] = X[col].fillna('unknown')
-                        else:
-                            X[col] = X[col].fillna(known_cats[0])
-                    else:
-                        X[col] = pd.to_numeric(X[col], errors='coerce').fillna(0)
-
-                scores = uba_engine.model.predict_proba(X)[:, 1]
+                # Booster.predict trên ma trận dựng sẵn (tự fallback về predict_proba, có parity check)
+                scores = score_batch(bundle, df_for_ml)
                 df_for_ml['ml_anomaly_score'] = scores
 
                 q_thresh = DEFAULT_ML_CONFIG["inference_quantile_threshold"]
@@ -673,53 +1021,41 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
     # ========================================================
     # AGGREGATE & ACTIVE RESPONSE
     # ========================================================
-    anomalies_multi_table_agg = _aggregate_multi_table_alerts(df_rule_multi)
+    anomalies_multi_table_agg = _aggregate_multi_table_alerts(df_rule_multi, multi_table_lists)
 
     users_to_lock_list = []
-    list_of_violation_dfs = []
     
     ar_config = full_config.get("active_response_config", {})
     threshold = ar_config.get("max_violation_threshold", 3)
 
     violation_sources = [
-        df_rule_access, df_rule_insider, df_rule_technical, df_rule_destruction
+        df_rule_access, df_rule_insider, df_rule_technical, df_rule_destruction, anomalies_multi_table_agg
     ]
+    critical_sources = [df_rule_technical, df_rule_destruction]
 
-    for df in violation_sources:
-        if not df.empty and 'user' in df.columns:
-            cols = ['user']
-            if 'client_ip' in df.columns: cols.append('client_ip')
-            list_of_violation_dfs.append(df[cols].copy())
-
-    if not anomalies_multi_table_agg.empty and 'user' in anomalies_multi_table_agg.columns:
-        temp_df = anomalies_multi_table_agg[['user']].copy()
-        if 'client_ip' not in temp_df.columns: temp_df['client_ip'] = 'unknown'
-        list_of_violation_dfs.append(temp_df)
-
-    critical_users = set()
-    if not df_rule_technical.empty and 'user' in df_rule_technical.columns:
-        critical_users.update(df_rule_technical['user'].unique())
-    if not df_rule_destruction.empty and 'user' in df_rule_destruction.columns:
-        critical_users.update(df_rule_destruction['user'].unique())
-
-    if list_of_violation_dfs:
-        all_violations_df = pd.concat(list_of_violation_dfs, ignore_index=True)
-        user_violation_counts = all_violations_df.groupby('user', observed=False).size().reset_index(
-            name='total_violation_count')
-
-        offenders = user_violation_counts[
-            (user_violation_counts['total_violation_count'] >= threshold) |
-            (user_violation_counts['user'].isin(critical_users))
-            ].copy()
-        
-        def get_lock_reason(row):
-            if row['user'] in critical_users:
-                return f"CRITICAL VIOLATION (Zero Tolerance) - Count: {row['total_violation_count']}"
-            return f"Threshold Exceeded - Count: {row['total_violation_count']}"
+    # Mỗi dòng vi phạm (và mỗi session multi-table) tính là 1 lần; đếm theo user bằng một groupby
+    violation_users = [df['user'] for df in violation_sources if not df.empty and 'user' in df.columns]
+    if violation_users:
+        all_violation_users = pd.concat(violation_users, ignore_index=True)
+        user_violation_counts = all_violation_users.groupby(all_violation_users, observed=False).size()
+
+        critical_users = pd.unique(pd.concat(
+            [df['user'] for df in critical_sources if not df.empty and 'user' in df.columns] or [pd.Series(dtype=object)],
+            ignore_index=True))
+        is_critical = user_violation_counts.index.isin(critical_users)
+        offenders = user_violation_counts[(user_violation_counts >= threshold).to_numpy() | is_critical]
 
         if not offenders.empty:
-            offenders['lock_reason'] = offenders.apply(get_lock_reason, axis=1)
-            users_to_lock_list = offenders.to_dict('records')
+            offender_critical = offenders.index.isin(critical_users)
+            counts_str = offenders.astype(str).to_numpy()
+            lock_reason = np.where(offender_critical,
+                                   "CRITICAL VIOLATION (Zero Tolerance) - Count: " + counts_str,
+                                   "Threshold Exceeded - Count: " + counts_str)
+            users_to_lock_list = pd.DataFrame({
+                'user': offenders.index,
+                'total_violation_count': offenders.to_numpy(),
+                'lock_reason': lock_reason,
+            }).to_dict('records')
 
     # ========================================================
     # UPDATE LOGS & RETURN
@@ -731,21 +1067,25 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
 
     if 'unusual_activity_reason' not in df_logs.columns:
         df_logs['unusual_activity_reason'] = None
-    
+
+    # Gom lý do của mọi nguồn rồi ghi một lần (nguồn sau ghi đè nguồn trước như trước đây)
+    reason_series = []
     for source_df in detection_sources:
         if source_df is not None and not source_df.empty:
-            common_indices = source_df.index.intersection(df_logs.index)
-            
-            if not common_indices.empty:
-                if 'specific_rule' in source_df.columns:
-                    rule_series = source_df.loc[common_indices, 'specific_rule']
-                elif 'behavior_group' in source_df.columns:
-                    rule_series = source_df.loc[common_indices, 'behavior_group']
-                else:
-                    rule_series = pd.Series("Detected by System", index=common_indices)
+            if 'specific_rule' in source_df.columns:
+                reason_series.append(source_df['specific_rule'])
+            elif 'behavior_group' in source_df.columns:
+                reason_series.append(source_df['behavior_group'])
+            else:
+                reason_series.append(pd.Series("Detected by System", index=source_df.index))
 
-                df_logs.loc[common_indices, 'unusual_activity_reason'] = rule_series
-                df_logs.loc[common_indices, 'is_anomaly'] = 1
+    if reason_series:
+        reasons = pd.concat(reason_series)
+        reasons = reasons[reasons.index.isin(df_logs.index)]
+        reasons = reasons[~reasons.index.duplicated(keep='last')]
+        if not reasons.empty:
+            df_logs.loc[reasons.index, 'unusual_activity_reason'] = reasons
+            df_logs.loc[reasons.index, 'is_anomaly'] = 1
 
     all_anomalous_indices = rule_caught_indices.union(set(anomalies_ml.index.tolist()))
     normal_activities = df_logs[~df_logs.index.isin(all_anomalous_indices)].copy()
@@ -764,6 +1104,9 @@ def load_and_process_data(input_df: pd.DataFrame, config_params: dict) -> dict:
     }
 
     logging.info(f"Processing complete. Rules: {len(rule_caught_indices)}, ML: {len(anomalies_ml)}")
+    cache_stats = get_analysis_cache_stats()
+    logging.info(f"SQL analysis cache: size={cache_stats['size']}, hits={cache_stats['hits']}, "
+                 f"misses={cache_stats['misses']}, hit_rate={cache_stats['hit_rate']:.2%}")
     return results
 
 # --------------------------- Model I/O ---------------------------
@@ -1,8 +1,9 @@
 # engine/db_writer.py
+import io
 import logging
 import os
 import sys
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from datetime import datetime
 import pandas as pd
 from sqlalchemy.exc import SQLAlchemyError
@@ -15,7 +16,9 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.append(PROJECT_ROOT)
 
-from backend_api.models import SessionLocal, AllLogs, Anomaly, AggregateAnomaly  # type: ignore
+from backend_api.models import SessionLocal, AllLogs, Anomaly, AggregateAnomaly, engine as db_engine  # type: ignore
+from engine.rollups import anomaly_rollup_rows, log_rollup_rows, apply_rollups
+from engine.partitions import maybe_ensure_partitions
 
 log = logging.getLogger("DBWriter")
 if not log.hasHandlers():
@@ -55,35 +58,7 @@ def save_to_parquet(df: pd.DataFrame, prefix: str):
     except Exception as e:
         log.error(f"Failed to save Parquet file {prefix}: {e}")
 
-# ========= SAFE CONVERSION HELPERS =========
-
-def _safe_int(val):
-    """Chuyển đổi an toàn sang int (xử lý '0.0', NaN, None)"""
-    if val is None: return 0
-    try:
-        # Nếu là float NaN
-        if isinstance(val, (float, np.floating)) and np.isnan(val):
-            return 0
-        # Ép sang float trước để xử lý chuỗi '0.0', sau đó int
-        return int(float(val))
-    except (ValueError, TypeError):
-        return 0
-
-def _safe_float(val):
-    """Chuyển đổi an toàn sang float (xử lý None, string rác)"""
-    if val is None: return 0.0
-    try:
-        if isinstance(val, (float, np.floating)) and np.isnan(val):
-            return 0.0
-        return float(val)
-    except (ValueError, TypeError):
-        return 0.0
-
-def _safe_bool(val):
-    """Chuyển đổi an toàn sang bool (xử lý '0', 'false', 0.0)"""
-    if pd.isna(val) or val is None: return False
-    s_val = str(val).lower().strip()
-    return s_val in ['1', 'true', 't', 'yes', 'y', '1.0', 'on']
+# ========= SERIALIZATION HELPERS =========
 
 def _to_serializable(obj):
     """Chuyển đổi object sang JSON-safe"""
@@ -95,16 +70,252 @@ def _to_serializable(obj):
         return json.dumps(obj, ensure_ascii=False, default=str)
     return str(obj)
 
+# ========= COLUMN DEFINITIONS =========
+
+# Danh sách cột Boolean (Postgres strict)
+BOOL_COLS = {
+    'is_late_night', 'is_work_hours', 'is_select_star', 'has_limit', 
+    'has_order_by', 'has_into_outfile', 'has_load_data', 'has_sleep_benchmark',
+    'is_risky_command', 'is_admin_command', 'is_potential_dump', 
+    'is_suspicious_func', 'is_privilege_change', 'is_system_table',
+    'is_sensitive_access', 'is_system_access', 'has_comment', 'has_hex', 
+    'is_anomaly', 'has_error'
+}
+
+# Danh sách cột Integer (Postgres strict, ko nhận '0.0')
+INT_COLS = {
+    'created_tmp_disk_tables', 'created_tmp_tables', 'select_full_join', 
+    'select_scan', 'sort_merge_passes', 'no_index_used', 'no_good_index_used',
+    'error_count', 'warning_count', 
+    'rows_returned', 'rows_examined', 'rows_affected', 'num_tables',
+    'num_joins', 'num_where_conditions', 'subquery_depth', 'query_length',
+    'accessed_sensitive_tables', 'event_id', 'error_code'
+}
+
+# Danh sách cột Float
+FLOAT_COLS = {
+    'execution_time_ms', 'lock_time_ms', 'query_entropy', 'scan_efficiency',
+    'ml_anomaly_score', 'query_count_5m', 'error_count_5m', 'total_rows_5m',
+    'data_retrieval_speed', 'execution_time_ms_zscore', 'rows_returned_zscore'
+}
+
+# Danh sách cột JSON (JSONB)
+JSON_COLS = {'accessed_tables'}
+
+# Cột DataFrame -> cột all_logs (cùng tên)
+LOG_COLUMNS = [
+    'timestamp', 'user', 'client_ip', 'connection_type', 'database', 'query',
+    'normalized_query', 'event_id', 'event_name', 'command_type',
+    'execution_time_ms', 'lock_time_ms', 'rows_returned', 'rows_examined', 'rows_affected',
+    'scan_efficiency', 'query_length', 'query_entropy', 'ml_anomaly_score', 'analysis_type',
+    'is_system_table', 'is_admin_command', 'is_risky_command', 'has_comment', 'has_hex',
+    'is_select_star', 'has_into_outfile', 'is_anomaly',
+    'created_tmp_disk_tables', 'created_tmp_tables', 'select_full_join', 'select_scan',
+    'sort_merge_passes', 'no_index_used', 'no_good_index_used',
+    'query_count_5m', 'error_count_5m', 'total_rows_5m', 'data_retrieval_speed',
+    'execution_time_ms_zscore', 'rows_returned_zscore',
+    'num_tables', 'num_joins', 'num_where_conditions', 'subquery_depth',
+    'is_sensitive_access', 'is_system_access', 'has_load_data', 'has_sleep_benchmark',
+    'accessed_sensitive_tables', 'accessed_tables', 'unusual_activity_reason',
+    'suspicious_func_name', 'is_suspicious_func', 'is_privilege_change', 'privilege_cmd_name',
+    'is_late_night', 'is_work_hours', 'is_potential_dump', 'has_limit', 'has_order_by',
+    'error_code', 'error_message', 'error_count', 'warning_count', 'has_error'
+]
+
+# Các cờ dùng cho fallback is_anomaly (khi ML chưa set)
+_ANOMALY_FALLBACK_FLAGS = [
+    'is_late_night', 'is_potential_dump', 'is_risky_command',
+    'is_suspicious_func', 'is_privilege_change', 'has_error'
+]
+
+_TRUE_STRINGS = ['1', 'true', 't', 'yes', 'y', '1.0', 'on']
+
+# COPY ... FROM STDIN (nhanh hơn bulk_insert_mappings nhiều lần); tắt = chỉ dùng ORM
+DB_WRITER_USE_COPY = os.getenv("DB_WRITER_USE_COPY", "1") == "1"
+COPY_NULL = '\\N'
+
+# ========= VECTORIZED CASTING (theo nhóm kiểu) =========
+
+def _cast_bool(s: pd.Series) -> pd.Series:
+    """
+    Cột -> bool. Cột bool: NaN -> False; cột số: True chỉ khi == 1; còn lại: True khi
+    chuỗi (strip, lowercase) thuộc _TRUE_STRINGS ('1', 'true', 't', 'yes', 'y', '1.0', 'on').
+    """
+    if pd.api.types.is_bool_dtype(s):
+        return s.fillna(False).astype(bool)
+    if pd.api.types.is_numeric_dtype(s):
+        return (s == 1).fillna(False).astype(bool)
+    return s.notna() & s.astype(str).str.strip().str.lower().isin(_TRUE_STRINGS)
+
+
+def _to_float(s: pd.Series) -> pd.Series:
+    if pd.api.types.is_bool_dtype(s):
+        return s.fillna(False).astype('float64')
+    if s.dtype == object:
+        # Bool lẫn trong cột object -> 0/1 như float(True)
+        s = s.map(lambda v: float(v) if isinstance(v, (bool, np.bool_)) else v)
+    return pd.to_numeric(s, errors='coerce').astype('float64')
+
+
+def _cast_float(s: pd.Series) -> pd.Series:
+    """Cột -> float64: bool -> 0/1, chuỗi số được parse, None / NaN / chuỗi không phải số -> 0.0."""
+    return _to_float(s).fillna(0.0)
+
+
+def _cast_int(s: pd.Series) -> pd.Series:
+    """
+    Cột -> int64: parse như _cast_float rồi cắt phần thập phân về 0 ('2.9' -> 2, '-1.5' -> -1);
+    None / NaN / inf / chuỗi không phải số -> 0.
+    """
+    vals = _to_float(s).replace([np.inf, -np.inf], np.nan).fillna(0.0)
+    return np.trunc(vals).astype('int64')
+
+
+def _cast_str(s: pd.Series) -> pd.Series:
+    """Chuỗi hoặc None (NaN/None -> None)."""
+    out = s.astype(str).astype(object)
+    out[s.isna()] = None
+    return out
+
+
+def _cast_json(s: pd.Series) -> pd.Series:
+    """Giá trị JSON thuần Python (list/dict/str) hoặc None."""
+    def conv(v):
+        if isinstance(v, (list, tuple, set, np.ndarray)):
+            return [x.item() if isinstance(x, np.generic) else x for x in v]
+        if isinstance(v, dict) or v is None:
+            return v
+        return None if pd.isna(v) else str(v)
+    return s.map(conv).astype(object)
+
+
+def _cast_column(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        if col in BOOL_COLS: return pd.Series(False, index=df.index)
+        if col in INT_COLS: return pd.Series(0, index=df.index, dtype='int64')
+        if col in FLOAT_COLS: return pd.Series(0.0, index=df.index)
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+    s = df[col]
+    if col in BOOL_COLS: return _cast_bool(s)
+    if col in INT_COLS: return _cast_int(s)
+    if col in FLOAT_COLS: return _cast_float(s)
+    if col in JSON_COLS: return _cast_json(s)
+    if col == 'timestamp': return pd.to_datetime(s, errors='coerce')
+    return _cast_str(s)
+
+
+def build_all_logs_frame(df_all: pd.DataFrame) -> pd.DataFrame:
+    """Chuẩn hóa batch thành đúng schema bảng all_logs (ép kiểu theo cột, không lặp từng dòng)."""
+    out = pd.DataFrame({col: _cast_column(df_all, col) for col in LOG_COLUMNS}, index=df_all.index)
+
+    # Fallback logic cho is_anomaly (nếu ML chưa set hoặc set sai)
+    fallback = out['ml_anomaly_score'] > 0.7
+    for flag in _ANOMALY_FALLBACK_FLAGS:
+        fallback |= out[flag]
+    out['is_anomaly'] = out['is_anomaly'] | fallback
+
+    return out[out['timestamp'].notna()].reset_index(drop=True)
+
+
+def build_anomalies_frame(df_anomalies: pd.DataFrame) -> pd.DataFrame:
+    """Chuẩn hóa anomaly theo sự kiện thành schema bảng anomalies."""
+    def text(col, default):
+        if col not in df_anomalies.columns:
+            return pd.Series(default, index=df_anomalies.index, dtype=object)
+        return df_anomalies[col].astype(str)
+
+    out = pd.DataFrame({
+        'timestamp': pd.to_datetime(df_anomalies['timestamp'], errors='coerce')
+                     if 'timestamp' in df_anomalies.columns else pd.NaT,
+        'user': _cast_column(df_anomalies, 'user'),
+        'client_ip': _cast_column(df_anomalies, 'client_ip'),
+        'database': _cast_column(df_anomalies, 'database'),
+        'query': text('query', ''),
+        'anomaly_type': text('anomaly_type', 'unknown').str[:100],
+        'behavior_group': text('behavior_group', 'UNKNOWN'),
+        'score': _cast_float(df_anomalies['score']) if 'score' in df_anomalies.columns else 0.0,
+        'reason': text('reason', '').str[:500],
+        'status': 'new',
+        'execution_time_ms': _cast_column(df_anomalies, 'execution_time_ms'),
+        'rows_returned': _cast_column(df_anomalies, 'rows_returned'),
+        'rows_affected': _cast_column(df_anomalies, 'rows_affected'),
+    }, index=df_anomalies.index)
+    return out[out['timestamp'].notna()].reset_index(drop=True)
+
+# ========= WRITERS: COPY (nhanh) + ORM (fallback) =========
+
+def _frame_for_text_export(frame: pd.DataFrame) -> pd.DataFrame:
+    """JSON -> chuỗi JSON (dùng cho COPY CSV và file Parquet)."""
+    out = frame.copy()
+    for col in JSON_COLS.intersection(out.columns):
+        out[col] = out[col].map(lambda v: None if v is None else json.dumps(v, ensure_ascii=False, default=str))
+    return out
+
+
+def _records(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+def _copy_frame(conn, table: str, frame: pd.DataFrame):
+    """Stream DataFrame vào Postgres bằng COPY ... FROM STDIN (CSV) trên transaction đang mở của conn."""
+    buf = io.StringIO()
+    _frame_for_text_export(frame).to_csv(
+        buf, index=False, header=False, na_rep=COPY_NULL,
+        date_format='%Y-%m-%d %H:%M:%S.%f'
+    )
+    buf.seek(0)
+    columns = ", ".join(f'"{c}"' for c in frame.columns)
+    sql = f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(sql, buf)
+
+
+# Bảng ghi bằng COPY (các bảng khác, VD aggregate_anomalies có JSONB lồng nhau, dùng executemany INSERT)
+_COPY_MODELS = (AllLogs, Anomaly)
+
+
+def write_batch(frames: List[tuple], rollups: Optional[Dict[str, list]] = None) -> str:
+    """
+    Ghi nhiều bảng [(model, frame), ...] + rollup trong MỘT transaction: hoặc tất cả commit, hoặc không
+    gì cả, nên write-behind / redelivery có thể thử lại cả batch mà không ghi trùng dòng hay đếm trùng rollup.
+    COPY nếu có thể, lỗi thì rollback và ghi lại toàn bộ bằng ORM. Trả về tên phương thức đã dùng.
+    """
+    frames = [(model, frame) for model, frame in frames if frame is not None and not frame.empty]
+    if DB_WRITER_USE_COPY and db_engine.dialect.name == 'postgresql':
+        try:
+            with db_engine.begin() as conn:
+                for model, frame in frames:
+                    if model in _COPY_MODELS:
+                        _copy_frame(conn, model.__tablename__, frame)
+                    else:
+                        conn.execute(model.__table__.insert(), _records(frame))
+                if rollups:
+                    apply_rollups(conn, **rollups)
+            return 'copy'
+        except Exception as e:
+            log.warning(f"COPY batch failed ({e}), rolled back; retrying the whole batch with ORM insert.")
+    with SessionLocal() as db:
+        for model, frame in frames:
+            db.bulk_insert_mappings(model, _records(frame))
+        if rollups:
+            apply_rollups(db.connection(), **rollups)
+        db.commit()
+    return 'orm'
+
 # ========= MAIN SAVING FUNCTION =========
 
-def save_results_to_db(results: Dict[str, Any]):
-    """Save all logs + all anomaly types to PostgreSQL"""
+def save_results_to_db(results: Dict[str, Any]) -> bool:
+    """
+    Save all logs + all anomaly types to PostgreSQL.
+    Trả về True nếu batch đã commit (dùng để quyết định ACK message). Ba bảng + rollup ghi trong
+    một transaction: False nghĩa là không có gì được ghi, nên thử lại cả batch là an toàn.
+    """
     if not results or "all_logs" not in results:
-        return
+        return True
 
     df_all = results.get("all_logs")
     if df_all is None or df_all.empty:
-        return
+        return True
 
     # Ensure timestamp is naive datetime
     if 'timestamp' in df_all.columns:
@@ -112,168 +323,8 @@ def save_results_to_db(results: Dict[str, Any]):
         df_all['timestamp'] = df_all['timestamp'].dt.tz_localize(None)
 
     # === 1. Save to AllLogs (rich schema) ===
-    all_logs_to_save = df_all.copy()
-
-    # --- DEFINITIONS ---
-    # Danh sách cột Boolean (Postgres strict)
-    BOOL_COLS = {
-        'is_late_night', 'is_work_hours', 'is_select_star', 'has_limit', 
-        'has_order_by', 'has_into_outfile', 'has_load_data', 'has_sleep_benchmark',
-        'is_risky_command', 'is_admin_command', 'is_potential_dump', 
-        'is_suspicious_func', 'is_privilege_change', 'is_system_table',
-        'is_sensitive_access', 'is_system_access', 'has_comment', 'has_hex', 
-        'is_anomaly', 'has_error'
-    }
-
-    # Danh sách cột Integer (Postgres strict, ko nhận '0.0')
-    INT_COLS = {
-        'created_tmp_disk_tables', 'created_tmp_tables', 'select_full_join', 
-        'select_scan', 'sort_merge_passes', 'no_index_used', 'no_good_index_used',
-        'error_count', 'warning_count', 
-        'rows_returned', 'rows_examined', 'rows_affected', 'num_tables',
-        'num_joins', 'num_where_conditions', 'subquery_depth', 'query_length',
-        'accessed_sensitive_tables', 'event_id', 'error_code'
-    }
-
-    # Danh sách cột Float
-    FLOAT_COLS = {
-        'execution_time_ms', 'lock_time_ms', 'query_entropy', 'scan_efficiency',
-        'ml_anomaly_score', 'query_count_5m', 'error_count_5m', 'total_rows_5m',
-        'data_retrieval_speed', 'execution_time_ms_zscore', 'rows_returned_zscore'
-    }
-
-    # Map DataFrame columns -> DB columns
-    log_mapping = {
-        'timestamp': 'timestamp',
-        'user': 'user',
-        'client_ip': 'client_ip',
-        'connection_type': 'connection_type',
-        'database': 'database',
-        'query': 'query',
-        'normalized_query': 'normalized_query',
-        'event_id': 'event_id',
-        'event_name': 'event_name',
-        'command_type': 'command_type',
-        'execution_time_ms': 'execution_time_ms',
-        'lock_time_ms': 'lock_time_ms',
-        'rows_returned': 'rows_returned',
-        'rows_examined': 'rows_examined',
-        'rows_affected': 'rows_affected',
-        'scan_efficiency': 'scan_efficiency',
-        'query_length': 'query_length',
-        'query_entropy': 'query_entropy',
-        'ml_anomaly_score': 'ml_anomaly_score',
-        'analysis_type': 'analysis_type',
-        'is_system_table': 'is_system_table',
-        'is_admin_command': 'is_admin_command',
-        'is_risky_command': 'is_risky_command',
-        'has_comment': 'has_comment',
-        'has_hex': 'has_hex',
-        'is_select_star': 'is_select_star',
-        'has_into_outfile': 'has_into_outfile',
-        'is_anomaly': 'is_anomaly',
-        'created_tmp_disk_tables': 'created_tmp_disk_tables',
-        'created_tmp_tables': 'created_tmp_tables',
-        'select_full_join': 'select_full_join',
-        'select_scan': 'select_scan',
-        'sort_merge_passes': 'sort_merge_passes',
-        'no_index_used': 'no_index_used',
-        'no_good_index_used': 'no_good_index_used',
-        'query_count_5m': 'query_count_5m',
-        'error_count_5m': 'error_count_5m',
-        'total_rows_5m': 'total_rows_5m',
-        'data_retrieval_speed': 'data_retrieval_speed',
-        'execution_time_ms_zscore': 'execution_time_ms_zscore',
-        'rows_returned_zscore': 'rows_returned_zscore',                    
-        'num_tables': 'num_tables',
-        'num_joins': 'num_joins',
-        'num_where_conditions': 'num_where_conditions',
-        'subquery_depth': 'subquery_depth',
-        'is_sensitive_access': 'is_sensitive_access',
-        'is_system_access': 'is_system_access',
-        'has_load_data': 'has_load_data',
-        'has_sleep_benchmark': 'has_sleep_benchmark',
-        'accessed_sensitive_tables': 'accessed_sensitive_tables',
-        'accessed_tables': 'accessed_tables',
-        'unusual_activity_reason': 'unusual_activity_reason',
-        'suspicious_func_name': 'suspicious_func_name',
-        'is_suspicious_func': 'is_suspicious_func',
-        'is_privilege_change': 'is_privilege_change',
-        'privilege_cmd_name': 'privilege_cmd_name',
-        'is_late_night': 'is_late_night',
-        'is_work_hours': 'is_work_hours',
-        'is_potential_dump': 'is_potential_dump',
-        'has_limit': 'has_limit',
-        'has_order_by': 'has_order_by',
-        'error_code': 'error_code',
-        'error_message': 'error_message',
-        'error_count': 'error_count',
-        'warning_count': 'warning_count',
-        'has_error': 'has_error'
-    }
-
-    # Prepare records with STRICT TYPE CASTING
-    records = []
-    for idx in all_logs_to_save.index:
-        row = all_logs_to_save.loc[idx]
-        rec = {}
-        
-        for src_col, dest_col in log_mapping.items():
-            # Lấy giá trị thô
-            val = row.get(src_col) # Dùng .get an toàn hơn
-
-            # --- ÉP KIỂU MẠNH (STRICT CASTING) ---
-            
-            if dest_col in BOOL_COLS:
-                rec[dest_col] = _safe_bool(val)
-            
-            elif dest_col in INT_COLS:
-                rec[dest_col] = _safe_int(val)
-                
-            elif dest_col in FLOAT_COLS:
-                rec[dest_col] = _safe_float(val)
-            
-            elif dest_col == 'timestamp':
-                if isinstance(val, (pd.Timestamp, datetime)):
-                    rec[dest_col] = val.isoformat()
-                else:
-                    rec[dest_col] = val
-            
-            elif isinstance(val, (list, dict, set, np.ndarray)):
-                # JSON columns (accessed_tables...)
-                rec[dest_col] = json.dumps(val, ensure_ascii=False, default=str) if val is not None else None
-            
-            else:
-                # String columns
-                rec[dest_col] = str(val) if pd.notna(val) else None
-
-        # Fallback logic cho is_anomaly (nếu ML chưa set hoặc set sai)
-        if not rec.get('is_anomaly'):
-            score = float(rec.get('ml_anomaly_score') or 0.0)
-            is_bad = (
-                score > 0.7 or
-                rec.get('is_late_night') or
-                rec.get('is_potential_dump') or
-                rec.get('is_risky_command') or
-                rec.get('is_suspicious_func') or
-                rec.get('is_privilege_change') or 
-                rec.get('has_error')
-            )
-            rec['is_anomaly'] = bool(is_bad)
-            
-        records.append(rec)
-
-    if records:
-        # Save to Parquet before PostgreSQL
-        save_to_parquet(pd.DataFrame(records), "AllLogs")
-        
-        try:
-            with SessionLocal() as db:
-                db.bulk_insert_mappings(AllLogs, records)
-                db.commit()
-            log.info(f"Saved {len(records)} logs to AllLogs")
-        except Exception as e:
-            log.error(f"Failed to save AllLogs: {e}", exc_info=True)
+    # Ép kiểu mạnh (strict casting) theo nhóm cột, vector hóa
+    all_logs_frame = build_all_logs_frame(df_all)
 
     # === 2. Save Event-Level Anomalies ===
     anomaly_frames = []
@@ -320,52 +371,22 @@ def save_results_to_db(results: Dict[str, Any]):
         
         anomaly_frames.append(df_anom)
 
+    anomalies_frame = pd.DataFrame()
     if anomaly_frames:
         df_anomalies = pd.concat(anomaly_frames, ignore_index=True)
         # ... xử lý timestamp ...
         if 'timestamp' in df_anomalies.columns:
             df_anomalies['timestamp'] = pd.to_datetime(df_anomalies['timestamp'], utc=True).dt.tz_localize(None)
 
-        anomaly_records = []
-        for _, row in df_anomalies.iterrows():
-            rec = {
-                # ... các trường cũ ...
-                'timestamp': row.get('timestamp'),
-                'user': row.get('user'),
-                'client_ip': row.get('client_ip'),
-                'database': row.get('database'),
-                'query': str(row.get('query', '')),
-                'anomaly_type': str(row.get('anomaly_type', 'unknown'))[:100],
-                
-                # === [THÊM MỚI] Lưu Behavior Group ===
-                'behavior_group': str(row.get('behavior_group', 'UNKNOWN')),
-                
-                'score': _safe_float(row.get('score')),
-                'reason': str(row.get('reason', ''))[:500],
-                'status': 'new',
-                'execution_time_ms': _safe_float(row.get('execution_time_ms')),
-                'rows_returned': _safe_int(row.get('rows_returned')),
-                'rows_affected': _safe_int(row.get('rows_affected')),
-            }
-            if pd.notna(rec['timestamp']):
-                anomaly_records.append(rec)
-
-        if anomaly_records:
-            # Save to Parquet before PostgreSQL
-            save_to_parquet(pd.DataFrame(anomaly_records), "Anomalies")
-            
-            try:
-                with SessionLocal() as db:
-                    db.bulk_insert_mappings(Anomaly, anomaly_records)
-                    db.commit()
-                log.info(f"Saved {len(anomaly_records)} event-level anomalies")
-            except Exception as e:
-                log.error(f"Failed to save Anomalies: {e}", exc_info=True)
+        anomalies_frame = build_anomalies_frame(df_anomalies)
 
     # === 3. Save Session-Level (Aggregate) Anomalies ===
+    agg_frame = pd.DataFrame()
     if "rule_multi_table" in results:
         df_agg = results["rule_multi_table"]
         if not df_agg.empty:
+            # created_at gán tường minh (thay server default) để bucket rollup khớp với dòng đã ghi
+            created_at = datetime.now()
             agg_records = []
             for _, row in df_agg.iterrows():
                 details = {
@@ -384,17 +405,34 @@ def save_results_to_db(results: Dict[str, Any]):
                     'anomaly_type': 'multi_table_access',
                     'severity': float(row.get('distinct_tables_count', 0)),
                     'reason': f"Accessed {row.get('distinct_tables_count', 0)} tables in short window",
-                    'details': details
+                    'details': details,
+                    'created_at': created_at
                 })
 
-            if agg_records:
-                # Save to Parquet before PostgreSQL
-                save_to_parquet(pd.DataFrame(agg_records), "AggregateAnomalies")
-                
-                try:
-                    with SessionLocal() as db:
-                        db.bulk_insert_mappings(AggregateAnomaly, agg_records)
-                        db.commit()
-                    log.info(f"Saved {len(agg_records)} session-level anomalies")
-                except Exception as e:
-                    log.error(f"Failed to save AggregateAnomaly: {e}", exc_info=True)
\ No newline at end of file
+            agg_frame = pd.DataFrame(agg_records)
+
+    # === 4. Ghi cả ba bảng + rollup trong một transaction (retry không ghi trùng) ===
+    rollups = {
+        'log_rows': log_rollup_rows(all_logs_frame) if not all_logs_frame.empty else [],
+        'anomaly_rows': (
+            (anomaly_rollup_rows(anomalies_frame, 'event', 'timestamp', 'score') if not anomalies_frame.empty else [])
+            + (anomaly_rollup_rows(agg_frame, 'aggregate', 'created_at', 'severity') if not agg_frame.empty else [])
+        ),
+    }
+    if not all_logs_frame.empty:
+        # Partition theo thời gian của all_logs được tạo trước (rate-limited)
+        maybe_ensure_partitions(db_engine)
+    try:
+        method = write_batch([(AllLogs, all_logs_frame), (Anomaly, anomalies_frame),
+                              (AggregateAnomaly, agg_frame)], rollups)
+    except Exception as e:
+        log.error(f"Failed to save batch (nothing committed): {e}", exc_info=True)
+        return False
+    log.info(f"Saved {len(all_logs_frame)} logs, {len(anomalies_frame)} event-level anomalies, "
+             f"{len(agg_frame)} session-level anomalies ({method})")
+
+    # Parquet chỉ ghi sau khi commit: batch được thử lại không sinh file trùng
+    save_to_parquet(_frame_for_text_export(all_logs_frame), "AllLogs")
+    save_to_parquet(anomalies_frame, "Anomalies")
+    save_to_parquet(agg_frame, "AggregateAnomalies")
+    return True
\ No newline at end of file
@@ -0,0 +1,366 @@
+# engine/engine_supervisor.py
+"""
+================================================================================
+ENGINE SUPERVISOR (MULTI-PROCESS REALTIME ENGINE)
+================================================================================
+Chạy N tiến trình realtime engine song song nhưng vẫn giữ đúng các phát hiện có
+trạng thái theo user (rolling window, concurrent login, multi-table, baseline):
+
+1. Router (re-partition): đọc stream gốc (STREAMS) bằng group REDIS_GROUP_ROUTER,
+   chuyển nguyên message sang stream phân vùng `<stream>:p<k>` với
+   k = crc32(user) % ENGINE_PARTITIONS, rồi ACK stream gốc trong cùng MULTI/EXEC.
+   Trước khi chuyển message nào, router tạo group REDIS_GROUP_ENGINE (từ "0") trên
+   mọi stream phân vùng, để message đến trước khi worker khởi động xong không bị bỏ qua.
+2. Worker i: consumer `<REDIS_CONSUMER_NAME>-w<i>` của REDIS_GROUP_ENGINE, chỉ đọc
+   các phân vùng k với k % ENGINE_WORKERS == i -> mọi log của một user luôn do
+   cùng một tiến trình xử lý.
+3. Huấn luyện: chỉ worker ENGINE_TRAINING_WORKER buffer + train model dùng chung;
+   các worker khác chuyển dữ liệu huấn luyện của phân vùng mình qua Redis stream
+   (engine/training_feed.py) để model học trên mọi user, không chỉ ~1/N.
+4. Supervisor: dừng đồng loạt qua một multiprocessing.Event (SIGINT/SIGTERM),
+   khởi động lại worker bị chết, và định kỳ log throughput của từng worker
+   (được worker ghi vào Redis hash ENGINE_WORKER_METRICS_KEY).
+
+Publisher không cần thay đổi. Chạy: python engine/engine_supervisor.py
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import signal
+import logging
+import multiprocessing as mp
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import STREAMS, REDIS_CONSUMER_NAME, REDIS_GROUP_ENGINE, ENGINE_BATCH_MAX_MESSAGES, ENGINE_BATCH_MAX_BLOCK_MS
+from engine import redis_pool
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [EngineSupervisor/%(processName)s] - %(message)s")
+logger = logging.getLogger(__name__)
+
+# --- Cấu hình ---
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# Số phân vùng cố định (>= số worker) để có thể đổi số worker mà không xáo trộn user giữa các stream
+ENGINE_PARTITIONS = int(os.getenv("ENGINE_PARTITIONS", str(ENGINE_WORKERS)))
+REDIS_GROUP_ROUTER = os.getenv("REDIS_GROUP_ROUTER", "uba_router")
+ENGINE_WORKER_METRICS_KEY = os.getenv("ENGINE_WORKER_METRICS_KEY", "uba:engine:workers")
+ENGINE_METRICS_LOG_INTERVAL_SEC = float(os.getenv("ENGINE_METRICS_LOG_INTERVAL_SEC", "30"))
+ENGINE_SHUTDOWN_TIMEOUT_SEC = float(os.getenv("ENGINE_SHUTDOWN_TIMEOUT_SEC", "60"))
+# Worker duy nhất được buffer + retrain model
+ENGINE_TRAINING_WORKER = int(os.getenv("ENGINE_TRAINING_WORKER", "0"))
+
+
+# ==============================================================================
+# PHÂN VÙNG THEO USER
+# ==============================================================================
+
+def partition_for_user(user, num_partitions: int = ENGINE_PARTITIONS) -> int:
+    """Phân vùng ổn định giữa các tiến trình (không dùng hash() vì Python salt theo tiến trình)."""
+    if num_partitions <= 1:
+        return 0
+    return zlib.crc32(str(user or "unknown").encode("utf-8")) % num_partitions
+
+
+def partition_stream(stream: str, partition: int) -> str:
+    return f"{stream}:p{partition}"
+
+
+def worker_partitions(worker_id: int, num_workers: int = ENGINE_WORKERS,
+                      num_partitions: int = ENGINE_PARTITIONS) -> List[int]:
+    return [p for p in range(num_partitions) if p % num_workers == worker_id]
+
+
+def worker_streams(worker_id: int, num_workers: int = ENGINE_WORKERS,
+                   num_partitions: int = ENGINE_PARTITIONS) -> List[str]:
+    return [partition_stream(stream, p)
+            for stream in STREAMS
+            for p in worker_partitions(worker_id, num_workers, num_partitions)]
+
+
+def _message_user(fields: Dict[str, str]):
+    # Payload msgpack/Arrow (engine/stream_decoder.py) mang sẵn field "user"
+    if "user" in fields:
+        return fields["user"]
+    try:
+        return json.loads(fields.get("data") or "{}").get("user")
+    except (ValueError, AttributeError):
+        return None
+
+
+def route_messages(client, msgs, num_partitions: int = ENGINE_PARTITIONS,
+                   group: str = REDIS_GROUP_ROUTER) -> int:
+    """
+    Chuyển một lô message (kết quả xreadgroup) sang các stream phân vùng.
+    XADD + XACK chạy trong cùng một MULTI/EXEC: message chỉ rời PEL của router khi đã sang phân vùng.
+    """
+    routed = 0
+    pipe = client.pipeline(transaction=True)
+    for stream, entries in msgs:
+        ack_ids = []
+        for msg_id, fields in entries:
+            if fields:
+                target = partition_stream(stream, partition_for_user(_message_user(fields), num_partitions))
+                pipe.xadd(target, fields)
+                routed += 1
+            ack_ids.append(msg_id)
+        if ack_ids:
+            pipe.xack(stream, group, *ack_ids)
+    if len(pipe):
+        pipe.execute()
+    return routed
+
+
+# ==============================================================================
+# METRICS THEO WORKER
+# ==============================================================================
+
+class WorkerMetrics:
+    """Đếm throughput của một worker và ghi snapshot JSON vào Redis hash (field = tên worker)."""
+
+    def __init__(self, name: str, partitions: List[int], publish_interval_sec: float = 5.0):
+        self.name = name
+        self.partitions = partitions
+        self.publish_interval_sec = publish_interval_sec
+        self.started_at = time.time()
+        self.messages = 0
+        self.batches = 0
+        self.busy_sec = 0.0
+        self.last_batch_rate = 0.0
+        self._last_publish = 0.0
+
+    def record(self, n_records: int, seconds: float):
+        self.messages += n_records
+        self.batches += 1
+        self.busy_sec += seconds
+        self.last_batch_rate = n_records / seconds if seconds > 0 else 0.0
+        if time.time() - self._last_publish >= self.publish_interval_sec:
+            self.publish()
+
+    def snapshot(self) -> Dict:
+        uptime = max(time.time() - self.started_at, 1e-9)
+        return {
+            "worker": self.name,
+            "pid": os.getpid(),
+            "partitions": self.partitions,
+            "messages": self.messages,
+            "batches": self.batches,
+            "msgs_per_sec": round(self.messages / uptime, 2),
+            "busy_msgs_per_sec": round(self.messages / self.busy_sec, 2) if self.busy_sec > 0 else 0.0,
+            "last_batch_msgs_per_sec": round(self.last_batch_rate, 2),
+            "utilization": round(self.busy_sec / uptime, 3),
+            "uptime_sec": round(uptime, 1),
+            "updated_at": time.time(),
+        }
+
+    def publish(self):
+        self._last_publish = time.time()
+        try:
+            redis_pool.get_redis().hset(ENGINE_WORKER_METRICS_KEY, self.name, json.dumps(self.snapshot()))
+        except Exception as e:
+            logger.debug(f"Không ghi được metrics của {self.name}: {e}")
+
+
+def read_worker_metrics(client=None) -> Dict[str, Dict]:
+    client = client or redis_pool.get_redis()
+    raw = client.hgetall(ENGINE_WORKER_METRICS_KEY) or {}
+    return {name: json.loads(value) for name, value in raw.items()}
+
+
+# ==============================================================================
+# TIẾN TRÌNH CON
+# ==============================================================================
+
+def ensure_partition_groups(client, sources: List[str], num_partitions: int):
+    """
+    Group của worker trên mọi stream phân vùng, tạo từ "0" trước khi router chuyển
+    message: router ACK stream gốc ngay khi XADD, nên group tạo muộn bằng "$" (worker
+    còn đang load model, hoặc ENGINE_PARTITIONS vừa tăng) sẽ làm mất các message đó.
+    """
+    for stream in sources:
+        for partition in range(num_partitions):
+            redis_pool.ensure_consumer_group(client, partition_stream(stream, partition),
+                                             REDIS_GROUP_ENGINE, start_id="0")
+
+
+def _ignore_sigint():
+    # Ctrl+C gửi tới cả process group: để supervisor điều phối việc dừng qua stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def router_main(stop_event, num_partitions: int):
+    """Bước re-partition: stream gốc -> stream phân vùng theo hash(user)."""
+    _ignore_sigint()
+    client = redis_pool.connect_redis(configure=True, should_continue=lambda: not stop_event.is_set())
+    if client is None:
+        return
+    sources = list(STREAMS.keys())
+
+    def ensure_groups():
+        ensure_partition_groups(client, sources, num_partitions)
+        for stream in sources:
+            redis_pool.ensure_consumer_group(client, stream, REDIS_GROUP_ROUTER)
+
+    ensure_groups()
+
+    metrics = WorkerMetrics("router", list(range(num_partitions)))
+    consumer = f"{REDIS_CONSUMER_NAME}-router"
+    # Lần đầu đọc "0": chuyển tiếp phần còn treo trong PEL của router (lần chạy trước bị dừng giữa chừng)
+    cursor = "0"
+    logger.info(f"Router started: {sources} -> {num_partitions} partitions.")
+
+    while not stop_event.is_set():
+        try:
+            msgs = client.xreadgroup(
+                groupname=REDIS_GROUP_ROUTER,
+                consumername=consumer,
+                streams={stream: cursor for stream in sources},
+                count=ENGINE_BATCH_MAX_MESSAGES,
+                block=ENGINE_BATCH_MAX_BLOCK_MS,
+            )
+            if cursor == "0" and not any(entries for _, entries in (msgs or [])):
+                cursor = ">"
+                continue
+            if not msgs:
+                continue
+            started = time.time()
+            routed = route_messages(client, msgs, num_partitions)
+            metrics.record(routed, time.time() - started)
+        except Exception as e:
+            logger.error(f"Router error: {e}")
+            time.sleep(1)
+            try:
+                redis_pool.reset_pool()
+                client = redis_pool.get_redis()
+                ensure_groups()
+            except Exception as reconnect_error:
+                logger.error(f"Router reconnect error: {reconnect_error}")
+
+    metrics.publish()
+    logger.info(f"Router stopped. Routed {metrics.messages} messages.")
+
+
+def worker_main(worker_id: int, num_workers: int, num_partitions: int, stop_event):
+    """Một engine worker: chỉ xử lý các phân vùng của mình."""
+    # Phải đặt trước khi import engine: data_processor đọc các biến này lúc import
+    os.environ["UBA_WORKER_ID"] = str(worker_id)
+    os.environ["UBA_TRAINING_ENABLED"] = "1" if worker_id == ENGINE_TRAINING_WORKER else "0"
+
+    from engine import realtime_engine
+    _ignore_sigint()  # realtime_engine tự đăng ký handler lúc import
+
+    partitions = worker_partitions(worker_id, num_workers, num_partitions)
+    name = f"{REDIS_CONSUMER_NAME}-w{worker_id}"
+    metrics = WorkerMetrics(name, partitions)
+    realtime_engine.start_engine(
+        streams=worker_streams(worker_id, num_workers, num_partitions),
+        consumer_name=name,
+        stop_event=stop_event,
+        block_ms=ENGINE_BATCH_MAX_BLOCK_MS,
+        on_batch=metrics.record,
+    )
+    metrics.publish()
+
+
+# ==============================================================================
+# SUPERVISOR
+# ==============================================================================
+
+class EngineSupervisor:
+    def __init__(self, num_workers: int = ENGINE_WORKERS, num_partitions: int = ENGINE_PARTITIONS):
+        if num_partitions < num_workers:
+            logger.warning(f"ENGINE_PARTITIONS={num_partitions} < ENGINE_WORKERS={num_workers}; "
+                           f"dùng {num_workers} phân vùng.")
+            num_partitions = num_workers
+        self.num_workers = num_workers
+        self.num_partitions = num_partitions
+        if num_workers > 1 and os.getenv("UBA_TRAINING_FEED", "1") != "1":
+            logger.warning(f"UBA_TRAINING_FEED=0 với {num_workers} workers: model dùng chung chỉ được train "
+                           f"trên ~1/{num_workers} user (phân vùng của worker {ENGINE_TRAINING_WORKER}).")
+        # spawn: tránh fork tiến trình đang có thread / kết nối Redis
+        self.ctx = mp.get_context("spawn")
+        self.stop_event = self.ctx.Event()
+        self.processes: Dict[str, mp.Process] = {}
+
+    def _spawn(self, name: str):
+        if name == "router":
+            proc = self.ctx.Process(target=router_main, args=(self.stop_event, self.num_partitions),
+                                    name=name, daemon=False)
+        else:
+            worker_id = int(name[1:])
+            proc = self.ctx.Process(target=worker_main,
+                                    args=(worker_id, self.num_workers, self.num_partitions, self.stop_event),
+                                    name=name, daemon=False)
+        proc.start()
+        self.processes[name] = proc
+        logger.info(f"Started {name} (pid={proc.pid}).")
+
+    def request_stop(self, signum=None, frame=None):
+        if not self.stop_event.is_set():
+            logger.info("🛑 Nhận tín hiệu dừng. Đang dừng router và các worker...")
+            self.stop_event.set()
+
+    def log_metrics(self):
+        try:
+            metrics = read_worker_metrics()
+        except Exception as e:
+            logger.warning(f"Không đọc được worker metrics: {e}")
+            return
+        total = 0.0
+        for name in sorted(metrics):
+            m = metrics[name]
+            if name != "router":
+                total += m.get("msgs_per_sec", 0.0)
+            logger.info(f"[{name}] msgs={m.get('messages')} rate={m.get('msgs_per_sec')}/s "
+                        f"busy_rate={m.get('busy_msgs_per_sec')}/s util={m.get('utilization')}")
+        logger.info(f"Tổng throughput engine: {total:.1f} msgs/s ({self.num_workers} workers)")
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        try:
+            redis_pool.get_redis().delete(ENGINE_WORKER_METRICS_KEY)
+        except Exception:
+            pass
+
+        logger.info(f"Engine supervisor: {self.num_workers} workers, {self.num_partitions} partitions.")
+        self._spawn("router")
+        for worker_id in range(self.num_workers):
+            self._spawn(f"w{worker_id}")
+
+        last_metrics_log = time.time()
+        while not self.stop_event.is_set():
+            self.stop_event.wait(1.0)
+            if self.stop_event.is_set():
+                break
+            # Khởi động lại tiến trình bị chết (message chưa ACK sẽ được reclaimer nhận lại)
+            for name, proc in list(self.processes.items()):
+                if not proc.is_alive():
+                    logger.warning(f"{name} exited (code={proc.exitcode}), restarting...")
+                    self._spawn(name)
+            if time.time() - last_metrics_log >= ENGINE_METRICS_LOG_INTERVAL_SEC:
+                self.log_metrics()
+                last_metrics_log = time.time()
+
+        self.shutdown()
+
+    def shutdown(self, timeout: Optional[float] = ENGINE_SHUTDOWN_TIMEOUT_SEC):
+        """Chờ các tiến trình flush write-behind và thoát; quá hạn thì terminate."""
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for name, proc in self.processes.items():
+            proc.join(max(0.0, deadline - time.time()))
+            if proc.is_alive():
+                logger.warning(f"{name} did not stop in time, terminating.")
+                proc.terminate()
+                proc.join(5)
+        self.log_metrics()
+        logger.info("Engine supervisor stopped.")
+
+
+if __name__ == "__main__":
+    EngineSupervisor().run()
@@ -0,0 +1,405 @@
+# engine/feature_state.py
+"""
+================================================================================
+TRẠNG THÁI FEATURE LIÊN BATCH (STATEFUL FEATURES)
+================================================================================
+Giữ trạng thái theo từng user giữa các batch của realtime engine để các
+feature ngữ cảnh không bị "reset" tại ranh giới batch.
+
+- RollingWindowStore: cửa sổ trượt 5 phút (count / sum / std) theo user.
+  Mỗi user giữ một ring buffer các event còn nằm trong cửa sổ. Khi có batch
+  mới, buffer cũ được ghép vào batch, toàn bộ cửa sổ được tính một lần bằng
+  cumsum + searchsorted (không còn groupby().apply theo từng user).
+  Bộ nhớ mặc định là RAM; có thể truyền redis_client để lưu bền trạng thái trên
+  Redis (giữ qua restart / khi user chuyển sang worker khác): mỗi user một ZSET
+  các event (nhị phân, score = timestamp ms). Mỗi batch chỉ ZADD event mới +
+  ZREMRANGEBYSCORE phần ra khỏi cửa sổ; Redis chỉ được đọc khi user chưa có trong RAM.
+  Giới hạn: buffer chỉ giữ event trong (window + grace) tính từ event mới nhất
+  của user. Event đến trễ hơn `grace` được tính cửa sổ thiếu phần lịch sử đã bị
+  cắt; feature của các event đã xử lý trước đó không được tính lại.
+- UserBaselineStore: baseline mean/variance theo user (Welford, có thể suy giảm
+  theo hàm mũ) cho các feature *_zscore. Cập nhật theo lô bằng phép gộp song
+  song của Chan, checkpoint ra file parquet hoặc Redis.
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Thứ tự các giá trị lưu trong ring buffer
+_WINDOW_VALUE_COLS = ("query_length", "has_error", "rows_returned")
+ROLLING_FEATURE_COLUMNS = ["query_count_5m", "error_count_5m", "total_rows_5m", "query_len_std_5m"]
+# Một event trong ZSET Redis: timestamp ns, id duy nhất (member ZSET không được trùng), 3 giá trị
+_EVENT_DTYPE = np.dtype([("ts", "<i8"), ("uid", "<u8"), ("v", "<f8", (len(_WINDOW_VALUE_COLS),))])
+
+
+class RollingWindowStore:
+    """
+    Cửa sổ thời gian trượt theo user, tồn tại xuyên suốt các batch.
+
+    - redis_client: (tùy chọn, decode_responses=False) lưu bền ring buffer trên Redis.
+      RAM luôn là bản chính trong tiến trình; Redis chỉ được đọc cho user chưa có trong RAM.
+    - max_events_per_user: 0 = không giới hạn (buffer chỉ bị giới hạn theo thời gian).
+      Nếu đặt, user vượt ngưỡng có query_count_5m bị chặn trên (có log cảnh báo).
+    """
+
+    # Sau lỗi Redis, dùng RAM trong N giây thay vì chờ timeout kết nối ở mỗi batch
+    REDIS_RETRY_SEC = 30
+    # Chu kỳ (giây) dọn các user không còn event nào trong (window + grace) khỏi RAM
+    EVICT_INTERVAL_SEC = 60
+
+    def __init__(self, window: str = "5min", redis_client=None,
+                 key_prefix: str = "uba:window:", max_events_per_user: int = 0,
+                 grace: str = "0s"):
+        self.window_ns = int(pd.Timedelta(window).value)
+        # Giữ thêm lịch sử ngoài cửa sổ để event đến trễ (<= grace) vẫn thấy đủ cửa sổ của nó
+        self.grace_ns = int(pd.Timedelta(grace).value)
+        self.redis_client = redis_client
+        self._redis_retry_at = 0.0
+        self.key_prefix = key_prefix
+        self.max_events_per_user = max_events_per_user
+        # user -> (timestamps int64 ns, values float64 shape (k, 3))
+        self._tails: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # Timestamp lớn nhất đã thấy (event time), mốc để dọn user không còn hoạt động
+        self._watermark = np.iinfo("int64").min
+        self._evicted_at = time.time()
+        # id event = (số ngẫu nhiên theo instance << 32) | bộ đếm -> không trùng giữa các tiến trình
+        self._uid_base = int.from_bytes(os.urandom(4), "little") << 32
+        self._uid_next = 0
+
+    # ------------------------------------------------------------------
+    # Lưu trữ ring buffer (RAM, lưu bền trên Redis)
+    # ------------------------------------------------------------------
+    def _redis_usable(self) -> bool:
+        return self.redis_client is not None and time.time() >= self._redis_retry_at
+
+    def _redis_failed(self, action: str, error: Exception):
+        self._redis_retry_at = time.time() + self.REDIS_RETRY_SEC
+        logger.warning(f"Rolling window: không {action} Redis ({error}), dùng bộ nhớ RAM "
+                       f"trong {self.REDIS_RETRY_SEC}s.")
+
+    def _load_tails(self, users: Iterable[str]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        users = list(users)
+        tails = {u: self._tails[u] for u in users if u in self._tails}
+        missing = [u for u in users if u not in tails]
+        if not missing or not self._redis_usable():
+            return tails
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for user in missing:
+                pipe.zrange(f"{self.key_prefix}{user}", 0, -1)
+            for user, members in zip(missing, pipe.execute()):
+                if members:
+                    events = np.frombuffer(b"".join(members), dtype=_EVENT_DTYPE)
+                    tails[user] = (events["ts"].copy(), events["v"].copy())
+        except Exception as e:
+            self._redis_failed("đọc được trạng thái từ", e)
+        return tails
+
+    def _persist(self, users: np.ndarray, ts: np.ndarray, vals: np.ndarray, trim_before: Dict[str, int]):
+        """Ghi phần thay đổi lên Redis: ZADD các event mới, ZREMRANGEBYSCORE phần đã ra khỏi (window + grace)."""
+        if not self._redis_usable() or not trim_before:
+            return
+        n = len(ts)
+        events = np.empty(n, dtype=_EVENT_DTYPE)
+        events["ts"], events["v"] = ts, vals
+        events["uid"] = self._uid_base | ((self._uid_next + np.arange(n, dtype="uint64")) & 0xFFFFFFFF)
+        self._uid_next += n
+        raw, width = events.tobytes(), _EVENT_DTYPE.itemsize
+        scores = ts // 1_000_000
+
+        by_user: Dict[str, Dict[bytes, int]] = {}
+        for i, user in enumerate(users):
+            by_user.setdefault(user, {})[raw[i * width:(i + 1) * width]] = int(scores[i])
+        ttl_sec = max(1, int((self.window_ns + self.grace_ns) // 1_000_000_000) * 2)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for user, cutoff_ns in trim_before.items():
+                key = f"{self.key_prefix}{user}"
+                if user in by_user:
+                    pipe.zadd(key, by_user[user])
+                # Score theo ms: giữ lại cả ms chứa mốc cắt, phần dư bị loại khi tính cửa sổ
+                pipe.zremrangebyscore(key, "-inf", f"({cutoff_ns // 1_000_000}")
+                if self.max_events_per_user:
+                    pipe.zremrangebyrank(key, 0, -self.max_events_per_user - 1)
+                pipe.expire(key, ttl_sec)
+            pipe.execute()
+        except Exception as e:
+            self._redis_failed("ghi được trạng thái lên", e)
+
+    def _evict_idle(self):
+        """Bỏ khỏi RAM các user mà event mới nhất đã ra khỏi (window + grace) so với watermark."""
+        now = time.time()
+        if now - self._evicted_at < self.EVICT_INTERVAL_SEC:
+            return
+        self._evicted_at = now
+        cutoff = self._watermark - self.window_ns - self.grace_ns
+        idle = [u for u, (ts, _) in self._tails.items() if not len(ts) or ts[-1] <= cutoff]
+        for user in idle:
+            del self._tails[user]
+        if idle:
+            logger.debug(f"Rolling window: evicted {len(idle)} idle users ({len(self._tails)} active).")
+
+    def reset(self):
+        self._tails.clear()
+
+    # ------------------------------------------------------------------
+    # Tính toán
+    # ------------------------------------------------------------------
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Cập nhật trạng thái bằng batch `df` và trả về các feature cửa sổ trượt
+        (cùng index với df). Cửa sổ là (t - window, t], giống rolling('5min') của pandas.
+        """
+        if df.empty:
+            return pd.DataFrame(columns=ROLLING_FEATURE_COLUMNS, index=df.index, dtype="float64")
+
+        n_new = len(df)
+        users = (df["user"] if "user" in df.columns else pd.Series("unknown", index=df.index)).astype(str).to_numpy()
+        ts = pd.to_datetime(df["timestamp"]).to_numpy(dtype="datetime64[ns]").astype("int64")
+        vals = np.column_stack([
+            pd.to_numeric(df[c], errors="coerce").fillna(0).to_numpy(dtype="float64")
+            if c in df.columns else np.zeros(n_new)
+            for c in _WINDOW_VALUE_COLS
+        ])
+
+        # 1. Ghép ring buffer của các user có trong batch
+        history = self._load_tails(pd.unique(users))
+        h_users = [np.full(len(t), u, dtype=object) for u, (t, _) in history.items()]
+        all_users = np.concatenate(h_users + [users.astype(object)]) if h_users else users.astype(object)
+        all_ts = np.concatenate([t for t, _ in history.values()] + [ts])
+        all_vals = np.concatenate([v for _, v in history.values()] + [vals])
+        n_hist = len(all_ts) - n_new
+        # Vị trí gốc trong batch (-1 = event lịch sử), dùng làm khóa phụ khi trùng timestamp
+        all_pos = np.concatenate([np.full(n_hist, -1, dtype="int64"), np.arange(n_new)])
+
+        codes, uniq_users = pd.factorize(all_users)
+        order = np.lexsort((all_pos, all_ts, codes))
+        g, t_sorted, v_sorted, pos_sorted = codes[order], all_ts[order], all_vals[order], all_pos[order]
+        n_all = len(order)
+
+        grp_start = np.r_[0, np.flatnonzero(np.diff(g)) + 1]
+        grp_len = np.diff(np.r_[grp_start, n_all])
+        group_id = np.repeat(np.arange(len(grp_start)), grp_len)
+
+        # 2. Tìm điểm bắt đầu cửa sổ cho mỗi event (searchsorted trên khóa (user, ts) ghép)
+        rel = t_sorted - t_sorted[grp_start][group_id]
+        stride = int(rel.max()) + self.window_ns + 1
+        if stride * len(grp_start) < 2 ** 62:
+            key = group_id * stride + rel
+            start = np.searchsorted(key, key - self.window_ns, side="right")
+        else:
+            # Khoảng thời gian quá dài để ghép khóa -> tìm theo từng nhóm
+            start = np.empty(n_all, dtype="int64")
+            for s, l in zip(grp_start, grp_len):
+                seg = t_sorted[s:s + l]
+                start[s:s + l] = s + np.searchsorted(seg, seg - self.window_ns, side="right")
+
+        # 3. Tổng cửa sổ = hiệu của tổng tích lũy
+        cols = np.column_stack([v_sorted, v_sorted[:, 0] ** 2])
+        cs = np.vstack([np.zeros((1, cols.shape[1])), np.cumsum(cols, axis=0)])
+        end = np.arange(1, n_all + 1)
+        win = cs[end] - cs[start]
+        count = (end - start).astype("float64")
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (win[:, 3] - win[:, 0] ** 2 / count) / (count - 1)
+        std = np.where(count > 1, np.sqrt(np.clip(var, 0.0, None)), 0.0)
+
+        # 4. Lưu lại ring buffer: chỉ giữ event còn nằm trong cửa sổ (+ grace) của event mới nhất
+        grp_last_ts = t_sorted[grp_start + grp_len - 1]
+        grp_cutoff = grp_last_ts - self.window_ns - self.grace_ns
+        keep = t_sorted > grp_cutoff[group_id]
+        trim_before = {}
+        for gi, (s, l) in enumerate(zip(grp_start, grp_len)):
+            seg_keep = keep[s:s + l]
+            ts_keep, v_keep = t_sorted[s:s + l][seg_keep], v_sorted[s:s + l][seg_keep]
+            user = str(uniq_users[gi])
+            if self.max_events_per_user and len(ts_keep) > self.max_events_per_user:
+                logger.warning(f"Rolling window: user {user} has {len(ts_keep)} events in window, "
+                               f"keeping the last {self.max_events_per_user} (query_count_5m is capped).")
+                ts_keep, v_keep = ts_keep[-self.max_events_per_user:], v_keep[-self.max_events_per_user:]
+            self._tails[user] = (ts_keep, v_keep)
+            trim_before[user] = int(grp_cutoff[gi])
+        self._watermark = max(self._watermark, int(grp_last_ts.max()))
+        new_kept = keep & (pos_sorted >= 0)
+        self._persist(uniq_users[g[new_kept]].astype(str), t_sorted[new_kept], v_sorted[new_kept], trim_before)
+        self._evict_idle()
+
+        # 5. Map kết quả về thứ tự của batch
+        is_new = pos_sorted >= 0
+        result = np.empty((n_new, 4), dtype="float64")
+        result[pos_sorted[is_new]] = np.column_stack([count, win[:, 1], win[:, 2], std])[is_new]
+        return pd.DataFrame(result, columns=ROLLING_FEATURE_COLUMNS, index=df.index)
+
+
+# ==============================================================================
+# PER-USER BASELINES (WELFORD)
+# ==============================================================================
+BASELINE_METRICS = ["execution_time_ms", "rows_returned", "data_retrieval_speed"]
+
+
+class UserBaselineStore:
+    """
+    Baseline (n, mean, M2) theo user cho từng metric, tồn tại qua các batch.
+
+    - decay: hệ số suy giảm áp lên baseline cũ trước mỗi batch (1.0 = không suy giảm).
+    - min_count: số mẫu tối thiểu để tính z-score (ít hơn -> z = 0).
+    - checkpoint_path: file parquet để lưu/khôi phục baseline (RAM + checkpoint định kỳ).
+    - redis_client: nếu có, baseline được đọc/ghi trên Redis hash `redis_key`
+      (dùng chung giữa nhiều tiến trình engine).
+    """
+
+    def __init__(self, metrics: Optional[List[str]] = None, decay: float = 1.0, min_count: int = 3,
+                 checkpoint_path: Optional[str] = None, checkpoint_interval_sec: int = 60,
+                 redis_client=None, redis_key: str = "uba:baseline"):
+        self.metrics = list(metrics or BASELINE_METRICS)
+        self.decay = float(decay)
+        self.min_count = min_count
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval_sec = checkpoint_interval_sec
+        self.redis_client = redis_client
+        self.redis_key = redis_key
+        self.last_checkpoint_time = time.time()
+        self._columns = [f"{m}__{k}" for m in self.metrics for k in ("n", "mean", "m2")]
+        # Baseline trong RAM: ma trận (dòng = user) + chỉ mục user -> dòng; mỗi batch chỉ
+        # đọc / ghi đè đúng các dòng của user trong batch (không dựng lại bảng mọi user)
+        self._row: Dict[str, int] = {}
+        self._values = np.zeros((0, len(self._columns)), dtype="float64")
+        self._load_checkpoint()
+
+    # ------------------------------------------------------------------
+    # Lưu trữ
+    # ------------------------------------------------------------------
+    @property
+    def stats(self) -> pd.DataFrame:
+        """Bản sao baseline của mọi user (DataFrame index = user) - dùng cho checkpoint / debug."""
+        users = list(self._row)
+        return pd.DataFrame(self._values[:len(users)], columns=self._columns,
+                            index=pd.Index(users, name="user", dtype="object"))
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            try:
+                df = pd.read_parquet(self.checkpoint_path)
+                df = df.reindex(columns=self._columns).fillna(0.0)
+                self._row = {str(u): i for i, u in enumerate(df.index)}
+                self._values = df.to_numpy(dtype="float64", copy=True)
+                logger.info(f"🔄 Restored user baselines: {len(df)} users.")
+            except Exception as e:
+                logger.error(f"Failed to load user baselines: {e}")
+
+    def _ram_users(self, users: np.ndarray) -> pd.DataFrame:
+        rows = np.fromiter((self._row.get(u, -1) for u in users), dtype="int64", count=len(users))
+        values = np.full((len(users), len(self._columns)), np.nan)
+        found = rows >= 0
+        values[found] = self._values[rows[found]]
+        return pd.DataFrame(values, index=pd.Index(users, name="user"), columns=self._columns)
+
+    def _load_users(self, users: np.ndarray) -> pd.DataFrame:
+        if self.redis_client is None:
+            return self._ram_users(users)
+        try:
+            raw_values = self.redis_client.hmget(self.redis_key, list(users))
+            rows = [json.loads(raw) if raw else [np.nan] * len(self._columns) for raw in raw_values]
+            return pd.DataFrame(rows, index=pd.Index(users, name="user"), columns=self._columns, dtype="float64")
+        except Exception as e:
+            logger.warning(f"Baseline: không đọc được từ Redis ({e}), dùng bộ nhớ RAM.")
+            return self._ram_users(users)
+
+    def _store_users(self, merged: pd.DataFrame):
+        users = [str(u) for u in merged.index]
+        new_users = [u for u in users if u not in self._row]
+        if new_users:
+            n_used = len(self._row)
+            needed = n_used + len(new_users)
+            if needed > len(self._values):
+                # Tăng gấp đôi sức chứa: chi phí sao chép khấu hao O(1) cho mỗi user mới
+                grown = np.zeros((max(needed, 2 * len(self._values), 64), len(self._columns)), dtype="float64")
+                grown[:n_used] = self._values[:n_used]
+                self._values = grown
+            for i, user in enumerate(new_users):
+                self._row[user] = n_used + i
+        rows = np.fromiter((self._row[u] for u in users), dtype="int64", count=len(users))
+        self._values[rows] = merged.to_numpy(dtype="float64")
+        if self.redis_client is not None:
+            try:
+                mapping = {u: json.dumps(row) for u, row in zip(merged.index, merged.to_numpy().tolist())}
+                self.redis_client.hset(self.redis_key, mapping=mapping)
+            except Exception as e:
+                logger.warning(f"Baseline: không ghi được lên Redis: {e}")
+
+    def save_checkpoint(self, force: bool = False):
+        if not self.checkpoint_path:
+            return
+        now = time.time()
+        if not force and (now - self.last_checkpoint_time < self.checkpoint_interval_sec):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+            tmp_path = self.checkpoint_path + ".tmp"
+            self.stats.to_parquet(tmp_path)
+            os.replace(tmp_path, self.checkpoint_path)
+            self.last_checkpoint_time = now
+        except Exception as e:
+            logger.error(f"Failed to checkpoint user baselines: {e}")
+
+    # ------------------------------------------------------------------
+    # Cập nhật & tính z-score
+    # ------------------------------------------------------------------
+    def update_and_score(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Gộp batch vào baseline theo user rồi trả về các cột `<metric>_zscore`
+        (cùng index với df). Z-score tính trên baseline đã gộp cả batch hiện tại,
+        nên với user mới (chưa có lịch sử) kết quả trùng với cách tính theo batch cũ.
+        """
+        z_cols = [f"{m}_zscore" for m in self.metrics]
+        if df.empty:
+            return pd.DataFrame(columns=z_cols, index=df.index, dtype="float64")
+
+        users = (df["user"] if "user" in df.columns else pd.Series("unknown", index=df.index)).astype(str)
+        codes, uniq_users = pd.factorize(users)
+        n_users = len(uniq_users)
+        counts = np.bincount(codes, minlength=n_users).astype("float64")
+
+        prior = self._load_users(np.asarray(uniq_users, dtype=object)).fillna(0.0)
+        merged = pd.DataFrame(index=pd.Index(uniq_users, name="user"), columns=self._columns, dtype="float64")
+        result = pd.DataFrame(index=df.index)
+
+        for m in self.metrics:
+            x = pd.to_numeric(df[m], errors="coerce").fillna(0.0).to_numpy(dtype="float64") \
+                if m in df.columns else np.zeros(len(df))
+
+            # Thống kê của batch theo user (group reduction bằng bincount)
+            mean_b = np.bincount(codes, weights=x, minlength=n_users) / counts
+            m2_b = np.bincount(codes, weights=(x - mean_b[codes]) ** 2, minlength=n_users)
+
+            # Baseline cũ (có suy giảm), gộp theo công thức song song của Chan
+            n_a = prior[f"{m}__n"].to_numpy() * self.decay
+            mean_a = prior[f"{m}__mean"].to_numpy()
+            m2_a = prior[f"{m}__m2"].to_numpy() * self.decay
+
+            n = n_a + counts
+            delta = mean_b - mean_a
+            mean = mean_a + delta * counts / n
+            m2 = m2_a + m2_b + delta ** 2 * n_a * counts / n
+
+            merged[f"{m}__n"], merged[f"{m}__mean"], merged[f"{m}__m2"] = n, mean, m2
+
+            # Lookup vector hóa: mỗi dòng lấy baseline của user mình
+            std = np.sqrt(np.clip(m2 / n, 0.0, None))
+            valid = (n >= self.min_count) & (std > 1e-12)
+            safe_std = np.where(valid, std, 1.0)
+            z = (x - mean[codes]) / safe_std[codes]
+            result[f"{m}_zscore"] = np.where(valid[codes], z, 0.0)
+
+        self._store_users(merged)
+        self.save_checkpoint()
+        return result[z_cols]
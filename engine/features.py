@@ -4,7 +4,8 @@ import re
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, Optional
+import os
 import logging
 import math
 from collections import Counter
@@ -18,6 +19,10 @@ except ImportError:
     SQLGLOT_AVAILABLE = False
     logging.warning("Thư viện 'sqlglot' chưa được cài đặt. Đang dùng chế độ Regex cơ bản (kém chính xác hơn). Hãy chạy: pip install sqlglot")
 
+from engine.sql_analysis import analyze_query
+from engine.feature_state import RollingWindowStore, UserBaselineStore, ROLLING_FEATURE_COLUMNS
+from engine.redis_pool import get_redis
+
 logging.basicConfig(level=logging.INFO)
 
 # Sensitive tables from your schema
@@ -160,10 +165,10 @@ def extract_query_features(row: pd.Series) -> Dict[str, Any]:
     if rows_ret >= 0:
         f["data_retrieval_speed"] = rows_ret / (exec_time + 0.001)
 
-    # 3. SQL Structure (Parser)
-    parsed = safe_parse_sql(query)
+    # 3. SQL Structure (Parser) - dùng kết quả parse-once từ cache chung
+    analysis = analyze_query(query)
     
-    f["is_parse_failed"] = 1 if parsed is None else 0
+    f["is_parse_failed"] = 0 if analysis.parsed else 1
 
     # Default values
     for k in ["num_tables", "num_joins", "num_where_conditions", "subquery_depth", 
@@ -185,8 +190,8 @@ def extract_query_features(row: pd.Series) -> Dict[str, Any]:
         else:
             tables_from_regex.add(table_name.lower())
 
-    if parsed:
-        cmd = parsed.key.upper() if hasattr(parsed, "key") else "UNKNOWN"
+    if analysis.parsed:
+        cmd = analysis.command_type
         f["command_type"] = cmd
         
         # Check commands via parser (More accurate)
@@ -196,22 +201,13 @@ def extract_query_features(row: pd.Series) -> Dict[str, Any]:
         if cmd in {"CREATE", "DROP", "ALTER", "TRUNCATE"}: f["is_ddl"] = 1
 
         # Elements
-        f["num_tables"] = len(list(parsed.find_all(exp.Table)))
-        f["num_joins"] = len(list(parsed.find_all(exp.Join)))
-        f["num_where_conditions"] = len(list(parsed.find_all(exp.Where)))
-        
-        # Subquery Depth
-        depth = 0
-        node = parsed
-        while node:
-            if isinstance(node, exp.Subquery): depth += 1
-            try: node = list(node.children.values())[0][0]
-            except: break
-        f["subquery_depth"] = min(depth, 10)
-
-        tables_found = _extract_tables(parsed)
+        f["num_tables"] = analysis.num_tables
+        f["num_joins"] = analysis.num_joins
+        f["num_where_conditions"] = analysis.num_where_conditions
+        f["subquery_depth"] = analysis.subquery_depth
+
         # Merge with regex fallback
-        tables_found = tables_found.union(tables_from_regex)
+        tables_found = set(analysis.tables).union(tables_from_regex)
         
         for full in tables_found:
             t_name = full.split('.')[-1]
@@ -250,12 +246,281 @@ def extract_query_features(row: pd.Series) -> Dict[str, Any]:
     return f
 
 
+# ==============================================================================
+# VECTORIZED STATIC FEATURES (Columnar path)
+# ==============================================================================
+# extract_query_features() ở trên được giữ làm bản tham chiếu (reference).
+# Bản dưới đây tính cùng bộ feature theo cột: các feature thời gian/lỗi/hiệu năng
+# dùng pandas/NumPy, còn parser + regex chỉ chạy trên các query KHÁC NHAU.
+
+# Thứ tự cột giống hệt dict trả về của extract_query_features
+STATIC_FEATURE_COLUMNS = [
+    "query_length", "query_entropy", "hour_sin", "hour_cos", "is_weekend",
+    "is_late_night", "is_work_hours", "error_count", "has_error",
+    "execution_time_ms", "rows_returned", "rows_affected", "no_index_used",
+    "data_retrieval_speed", "is_parse_failed",
+    "num_tables", "num_joins", "num_where_conditions", "subquery_depth",
+    "is_sensitive_access", "is_system_access", "is_dcl", "is_ddl",
+    "has_comment", "has_hex", "is_risky_command", "is_admin_command",
+    "is_select_star", "has_into_outfile", "has_load_data", "has_sleep_benchmark",
+    "accessed_tables", "command_type", "is_access_denied"
+]
+
+_RE_TABLE_FALLBACK = re.compile(r'(?:FROM|JOIN)\s+(?:`?(\w+)`?\.)?`?(\w+)`?', re.IGNORECASE)
+
+
+def _vec_safe_int(s: pd.Series) -> pd.Series:
+    """Bản vector của safe_int: NaN/''/inf/rác -> 0, còn lại cắt phần thập phân"""
+    num = pd.to_numeric(s, errors="coerce").astype("float64")
+    num = num.where(np.isfinite(num), 0.0)
+    return np.trunc(num).astype("int64")
+
+
+def _col(df: pd.DataFrame, name: str, default=None) -> pd.Series:
+    if name in df.columns:
+        return df[name]
+    return pd.Series(default, index=df.index, dtype="object")
+
+
+def _row_hour_weekday(ts):
+    """Giữ nguyên logic thời gian của extract_query_features cho cột dạng object"""
+    # None / NaN: "không có thời gian" (NaN float sẽ lỗi .hour ở bản tham chiếu)
+    if ts is None or (isinstance(ts, float) and np.isnan(ts)):
+        return (12, 0)
+    if isinstance(ts, str):
+        try: ts = pd.to_datetime(ts).tz_localize(None)
+        except: ts = None
+    elif isinstance(ts, pd.Timestamp) and ts.tzinfo:
+        ts = ts.tz_localize(None)
+    return (ts.hour, ts.weekday()) if ts else (12, 0)
+
+
+def _vec_hour_weekday(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    if "timestamp" not in df.columns:
+        n = len(df)
+        return np.full(n, 12.0), np.zeros(n)
+
+    ts = df["timestamp"]
+    if pd.api.types.is_datetime64_any_dtype(ts):
+        if ts.dt.tz is not None:
+            ts = ts.dt.tz_localize(None)
+        return ts.dt.hour.to_numpy(dtype="float64"), ts.dt.weekday.to_numpy(dtype="float64")
+
+    # Cột object/string: chỉ parse mỗi giá trị khác nhau một lần
+    codes, uniques = pd.factorize(ts)
+    pairs = np.array([_row_hour_weekday(v) for v in uniques], dtype="float64").reshape(-1, 2)
+    hour, weekday = np.empty(len(ts)), np.empty(len(ts))
+    present = np.flatnonzero(codes >= 0)
+    hour[present], weekday[present] = pairs[codes[present], 0], pairs[codes[present], 1]
+    # Giá trị thiếu: factorize gộp None / NaN / NaT, nhưng bản tham chiếu xử lý khác nhau
+    # (None -> 12h, NaT -> NaN) nên tính riêng từng dòng
+    missing = np.flatnonzero(codes < 0)
+    if len(missing):
+        na_pairs = np.array([_row_hour_weekday(v) for v in ts.iloc[missing]], dtype="float64").reshape(-1, 2)
+        hour[missing], weekday[missing] = na_pairs[:, 0], na_pairs[:, 1]
+    return hour, weekday
+
+
+def _query_level_features(uniques: pd.Series) -> pd.DataFrame:
+    """Feature chỉ phụ thuộc vào nội dung query, tính trên danh sách query KHÁC NHAU"""
+    q_upper = uniques.str.upper()
+    out = pd.DataFrame(index=uniques.index)
+
+    # Regex heuristics (vectorized trên các query unique)
+    out["has_comment"] = (uniques.str.contains("--", regex=False)
+                          | uniques.str.contains("/*", regex=False)
+                          | uniques.str.contains("#", regex=False)).astype("int64")
+    out["has_hex"] = q_upper.str.contains("0X", regex=False).astype("int64")
+    out["is_select_star"] = q_upper.str.contains("SELECT *", regex=False).astype("int64")
+    out["has_into_outfile"] = q_upper.str.contains("INTO OUTFILE", regex=False).astype("int64")
+    out["has_load_data"] = q_upper.str.contains("LOAD DATA", regex=False).astype("int64")
+    out["has_sleep_benchmark"] = uniques.str.contains(r"SLEEP\s*\(|BENCHMARK\s*\(", case=False, regex=True).astype("int64")
+
+    fallback_cmd = np.select(
+        [q_upper.str.contains(k, regex=False) for k in ("SELECT", "INSERT", "UPDATE", "DELETE")],
+        ["SELECT", "INSERT", "UPDATE", "DELETE"], default="UNKNOWN"
+    )
+
+    # Parser (qua cache parse-once) + bảng
+    n = len(uniques)
+    parse_failed = np.ones(n, dtype="int64")
+    struct = np.zeros((n, 4), dtype="int64")   # num_tables, num_joins, num_where, subquery_depth
+    flags = np.zeros((n, 6), dtype="int64")    # sensitive, system, dcl, ddl, risky, admin
+    commands = []
+    tables_col = []
+
+    for i, query in enumerate(uniques.tolist()):
+        analysis = analyze_query(query)
+        tables_from_regex = set()
+        for match in _RE_TABLE_FALLBACK.finditer(query):
+            db_name, table_name = match.group(1), match.group(2)
+            tables_from_regex.add(f"{db_name.lower()}.{table_name.lower()}" if db_name else table_name.lower())
+
+        if analysis.parsed:
+            cmd = analysis.command_type
+            parse_failed[i] = 0
+            struct[i] = (analysis.num_tables, analysis.num_joins,
+                         analysis.num_where_conditions, analysis.subquery_depth)
+            flags[i, 2] = cmd in {"GRANT", "REVOKE", "CREATE USER"}
+            flags[i, 3] = cmd in {"CREATE", "DROP", "ALTER", "TRUNCATE"}
+            flags[i, 4] = cmd in RISKY_COMMANDS
+            flags[i, 5] = cmd in {"GRANT", "REVOKE", "CREATE USER", "ALTER USER", "SET PASSWORD"}
+            tables_found = set(analysis.tables).union(tables_from_regex)
+            check_system = True
+        else:
+            cmd = fallback_cmd[i]
+            tables_found = tables_from_regex
+            check_system = False
+
+        for full in tables_found:
+            t_name = full.split('.')[-1]
+            if full in SENSITIVE_TABLES or t_name in SENSITIVE_TABLES: flags[i, 0] = 1
+            if check_system and '.' in full and full.split('.')[0] in SYSTEM_SCHEMAS: flags[i, 1] = 1
+
+        commands.append(cmd)
+        tables_col.append(tuple(tables_found))
+
+    out["is_parse_failed"] = parse_failed
+    out["num_tables"], out["num_joins"] = struct[:, 0], struct[:, 1]
+    out["num_where_conditions"], out["subquery_depth"] = struct[:, 2], struct[:, 3]
+    out["is_sensitive_access"], out["is_system_access"] = flags[:, 0], flags[:, 1]
+    out["is_dcl"], out["is_ddl"] = flags[:, 2], flags[:, 3]
+    out["is_risky_command"], out["is_admin_command"] = flags[:, 4], flags[:, 5]
+    out["command_type"] = commands
+    out["accessed_tables"] = tables_col
+    out["query_length"] = uniques.str.len()
+    return out
+
+
+def extract_query_features_batch(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bản vectorized của extract_query_features cho cả DataFrame.
+    Trả về DataFrame (cùng index với df) có đúng các cột STATIC_FEATURE_COLUMNS.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=STATIC_FEATURE_COLUMNS, index=df.index)
+
+    queries = _col(df, "query", "").astype(str).str.strip()
+
+    # 1. Các feature theo query: tính trên query unique rồi map ngược lại
+    codes, uniques = pd.factorize(queries, use_na_sentinel=False)
+    per_query = _query_level_features(pd.Series(uniques, dtype="object"))
+    qf = per_query.iloc[codes].reset_index(drop=True)
+    qf.index = df.index
+
+    f = pd.DataFrame(index=df.index)
+
+    # 2. Base features
+    if "query_length" in df.columns:
+        f["query_length"] = df["query_length"].where(df["query_length"].notna(), qf["query_length"])
+    else:
+        f["query_length"] = qf["query_length"]
+
+    pub_entropy = _col(df, "query_entropy")
+    missing_entropy = pub_entropy.isna().to_numpy()
+    if missing_entropy.all():
+        entropy_by_code = np.array([_shannon_entropy(q) for q in uniques], dtype="float64")
+        f["query_entropy"] = entropy_by_code[codes] if len(uniques) else np.nan
+    elif missing_entropy.any():
+        missing_codes = np.unique(codes[missing_entropy])
+        entropy_by_code = {c: _shannon_entropy(uniques[c]) for c in missing_codes}
+        fallback_entropy = pd.Series([entropy_by_code.get(c, np.nan) for c in codes], index=df.index)
+        f["query_entropy"] = pub_entropy.where(~missing_entropy, fallback_entropy)
+    else:
+        f["query_entropy"] = pub_entropy
+
+    hour, weekday = _vec_hour_weekday(df)
+    f["hour_sin"] = np.sin(2 * np.pi * hour / 24.0)
+    f["hour_cos"] = np.cos(2 * np.pi * hour / 24.0)
+    f["is_weekend"] = (weekday >= 5).astype("int64")
+    f["is_late_night"] = ((hour >= 0) & (hour < 6)).astype("int64")
+    f["is_work_hours"] = ((hour >= 8) & (hour <= 18)).astype("int64")
+
+    # Lỗi
+    err_cnt = _vec_safe_int(_col(df, "error_count"))
+    has_err = _vec_safe_int(_col(df, "has_error"))
+    if "has_error" not in df.columns:
+        # Publisher chưa tính -> fallback theo error_count / error_code
+        err_code = pd.to_numeric(_col(df, "error_code"), errors="coerce").astype("float64")
+        code_flag = np.isfinite(err_code) & (np.trunc(err_code) != 0)
+        has_err = has_err.mask((err_cnt.clip(lower=0) > 0) | code_flag, 1)
+    f["error_count"] = err_cnt
+    f["has_error"] = has_err.clip(lower=0)
+
+    # 3. Performance metrics
+    exec_time = pd.to_numeric(_col(df, "execution_time_ms"), errors="coerce").astype("float64").fillna(0.0)
+    rows_ret = _vec_safe_int(_col(df, "rows_returned"))
+    f["execution_time_ms"] = exec_time
+    f["rows_returned"] = rows_ret
+    f["rows_affected"] = _vec_safe_int(_col(df, "rows_affected"))
+    f["no_index_used"] = _vec_safe_int(_col(df, "no_index_used"))
+    f["data_retrieval_speed"] = np.where(rows_ret >= 0, rows_ret / (exec_time + 0.001), 0.0)
+
+    # 4. SQL structure + regex heuristics (đã map từ query unique)
+    for col in STATIC_FEATURE_COLUMNS:
+        if col in qf.columns and col not in f.columns:
+            f[col] = qf[col]
+    f["accessed_tables"] = [list(t) for t in f["accessed_tables"]]
+
+    if "error_message" in df.columns:
+        f["is_access_denied"] = df["error_message"].astype(str).str.lower().str.contains(
+            "access denied", regex=False).astype("int64")
+    else:
+        f["is_access_denied"] = 0
+
+    return f[STATIC_FEATURE_COLUMNS]
+
+
+def compare_with_reference(df: pd.DataFrame, atol: float = 1e-9) -> Dict[str, int]:
+    """
+    Kiểm tra parity: so sánh extract_query_features_batch với bản tham chiếu
+    extract_query_features (từng dòng). Trả về {tên cột: số dòng lệch}; rỗng = khớp.
+    """
+    if df.empty:
+        return {}
+    ref = pd.DataFrame(df.apply(extract_query_features, axis=1).tolist(), index=df.index)
+    vec = extract_query_features_batch(df)
+
+    mismatches = {}
+    for col in STATIC_FEATURE_COLUMNS:
+        if col not in ref.columns:
+            mismatches[col] = len(df)
+            continue
+        a, b = ref[col], vec[col]
+        if col == "accessed_tables":
+            diff = int(sum(set(x) != set(y) for x, y in zip(a, b)))
+        elif col == "command_type":
+            diff = int((a.astype(str) != b.astype(str)).sum())
+        else:
+            a_num = pd.to_numeric(a, errors="coerce").to_numpy(dtype="float64")
+            b_num = pd.to_numeric(b, errors="coerce").to_numpy(dtype="float64")
+            diff = int((~np.isclose(a_num, b_num, atol=atol, equal_nan=True)).sum())
+        if diff:
+            mismatches[col] = diff
+    return mismatches
+
+
 # ==============================================================================
 # BATCH FEATURE ENHANCEMENT
 # ==============================================================================
-def enhance_features_batch(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
+# Tùy chọn: lưu bền cửa sổ trượt trên Redis (giữ qua restart và khi user đổi worker)
+ROLLING_WINDOW_REDIS = os.getenv("ROLLING_WINDOW_REDIS", "0") == "1"
+# Event đến trễ tối đa bao lâu vẫn được tính cửa sổ với đầy đủ lịch sử
+ROLLING_WINDOW_GRACE = os.getenv("ROLLING_WINDOW_GRACE", "2min")
+
+# Trạng thái cửa sổ trượt dùng chung, giữ qua các batch của engine
+_rolling_store = RollingWindowStore(window='5min', grace=ROLLING_WINDOW_GRACE,
+                                    redis_client=get_redis(decode_responses=False) if ROLLING_WINDOW_REDIS else None)
+# Baseline theo user (chỉ RAM nếu caller không truyền store có checkpoint)
+_baseline_store = UserBaselineStore()
+
+def enhance_features_batch(df: pd.DataFrame,
+                           rolling_store: Optional[RollingWindowStore] = None,
+                           baseline_store: Optional[UserBaselineStore] = None) -> Tuple[pd.DataFrame, List[str]]:
     """
-    Apply extract_query_features to entire DataFrame + add per-user behavioral baselines
+    Apply static features (vectorized) to entire DataFrame + add per-user behavioral baselines.
+    rolling_store: trạng thái cửa sổ 5 phút (mặc định dùng store dùng chung của engine).
+    baseline_store: baseline Welford theo user cho các cột *_zscore.
     """
     if df.empty:
         return df, []
@@ -263,10 +528,9 @@ def enhance_features_batch(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
     # 1. Reset Index
     df = df.reset_index(drop=True)
 
-    # 2. Extract Static Features
+    # 2. Extract Static Features (columnar path, parity với extract_query_features)
     logging.info("Generating Static Features...")
-    feature_dicts = df.apply(extract_query_features, axis=1).tolist()
-    features_df = pd.DataFrame(feature_dicts)
+    features_df = extract_query_features_batch(df)
     
     # Xử lý duplicate columns
     cols_to_drop = [c for c in features_df.columns if c in df.columns]
@@ -281,34 +545,14 @@ def enhance_features_batch(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
     if 'timestamp' in df_final.columns:
         # Chuyển về naive datetime
         df_final['timestamp'] = pd.to_datetime(df_final['timestamp']).dt.tz_localize(None)
-        df_final.sort_values(by=['user', 'timestamp'], inplace=True)
-        
-        def calc_rolling(g):
-            g = g.set_index('timestamp').sort_index()
-            win = '5min'
-            
-            g['query_count_5m'] = g['query_length'].rolling(win).count()
-            g['error_count_5m'] = g['has_error'].rolling(win).sum()
-            g['total_rows_5m'] = g['rows_returned'].rolling(win).sum()
-            # Thêm std để đo độ biến thiên hành vi
-            g['query_len_std_5m'] = g['query_length'].rolling(win).std().fillna(0)
-            
-            return g.reset_index()
+        if 'user' not in df_final.columns:
+            df_final['user'] = 'unknown'
+        df_final.sort_values(by=['user', 'timestamp'], inplace=True, kind='stable')
+        df_final = df_final.reset_index(drop=True)
 
-        try:
-            # group_keys=True để giữ 'user' trong index kết quả
-            df_rolled = df_final.groupby('user', group_keys=True).apply(calc_rolling, include_groups=False)
-            
-            # Kết quả df_rolled có MultiIndex (user, index_cũ). 
-            # Ta reset_index để đưa 'user' quay lại thành cột.
-            df_final = df_rolled.reset_index(level=0)
-            
-            # Reset index lần nữa để index trở lại dạng 0,1,2... và xóa index thừa nếu có
-            df_final = df_final.reset_index(drop=True)
-            
-        except TypeError:
-            # Fallback cho pandas bản cũ
-            df_final = df_final.groupby('user', group_keys=False).apply(calc_rolling)
+        # Cửa sổ 5 phút tính tăng dần với trạng thái giữ qua các batch
+        store = rolling_store if rolling_store is not None else _rolling_store
+        df_final[ROLLING_FEATURE_COLUMNS] = store.update(df_final)
 
         pd.set_option('future.no_silent_downcasting', True)
         df_final = df_final.fillna(0).infer_objects(copy=False)
@@ -321,21 +565,13 @@ def enhance_features_batch(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
          # Fallback cực đoan nếu mất user (hiếm khi xảy ra với fix trên)
          df_final['user'] = 'unknown'
 
-    metrics = ["execution_time_ms", "rows_returned", "data_retrieval_speed"]
-    for metric in metrics:
+    # Baseline theo user giữ qua các batch (Welford), z-score bằng lookup vector hóa
+    store = baseline_store if baseline_store is not None else _baseline_store
+    for metric in store.metrics:
         if metric not in df_final.columns: 
             df_final[metric] = 0.0
-            
-        col_name = f"{metric}_zscore"
-        
-        def compute_zscore(x):
-            if len(x) < 3: return pd.Series(0.0, index=x.index)
-            std = x.std(ddof=0)
-            if std == 0: return pd.Series(0.0, index=x.index)
-            return (x - x.mean()) / std
-
-        zscores = df_final.groupby('user', group_keys=False)[metric].apply(compute_zscore)
-        df_final[col_name] = zscores.fillna(0.0)
+    zscores = store.update_and_score(df_final)
+    df_final[zscores.columns] = zscores.fillna(0.0)
 
     # 5. Feature Selection & Clean up
     cat_cols = ["user", "client_ip", "database", "command_type"]
@@ -13,6 +13,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from config import *
     from engine.utils import save_logs_to_parquet, configure_redis_for_reliability, handle_redis_misconf_error, extract_db_from_sql 
+    from engine import redis_pool
 except ImportError:
     print("Lỗi: Không thể import config/utils.")
     sys.exit(1)
@@ -98,25 +99,8 @@ def connect_db():
         return None
 
 def connect_redis():
-    try:
-        r = Redis.from_url(
-            REDIS_URL, 
-            decode_responses=True,
-            socket_keepalive=True,
-            socket_keepalive_options={},
-            health_check_interval=30,
-            retry_on_timeout=True,
-            socket_connect_timeout=5
-        )
-        r.ping()
-        
-        # Configure Redis for better reliability
-        configure_redis_for_reliability(r)
-        
-        return r
-    except Exception as e:
-        logging.error(f"Redis connection failed: {e}")
-        return None
+    # Một lần thử trên connection pool dùng chung; caller tự xử lý None
+    return redis_pool.connect_redis(configure=True, max_attempts=1)
 
 # === 3. Helpers ===
 def calculate_entropy(text):
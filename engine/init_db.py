@@ -17,7 +17,7 @@ if PROJECT_ROOT not in sys.path:
 try:
     # Import các thành phần CSDL từ 'backend_api'
     # Quan trọng: Import AllLogs để SQLAlchemy biết structure bảng này
-    from backend_api.models import Base, engine, AllLogs, Anomaly, AggregateAnomaly
+    from backend_api.models import Base, engine, AllLogs, Anomaly, AggregateAnomaly, run_migrations
     from config import DATABASE_URL
 except ImportError as e:
     print("Lỗi: Không thể import 'backend_api.models' hoặc 'config'.")
@@ -39,13 +39,16 @@ try:
         conn.execute(text("DROP TABLE IF EXISTS all_logs CASCADE;"))
         conn.execute(text("DROP TABLE IF EXISTS anomalies CASCADE;"))
         conn.execute(text("DROP TABLE IF EXISTS aggregate_anomalies CASCADE;"))
+        # Rollup dashboard phải reset cùng dữ liệu gốc, nếu không stats/KPIs vẫn đếm dữ liệu đã xóa
+        conn.execute(text("DROP TABLE IF EXISTS anomaly_rollups CASCADE;"))
+        conn.execute(text("DROP TABLE IF EXISTS log_rollups CASCADE;"))
     
     log.info("Đã xóa sạch các bảng cũ.")
 
     log.info("-------------------------------------------------")
     log.info("BƯỚC 2: Tạo lại bảng mới từ Models")
     Base.metadata.create_all(bind=engine)
-    log.info("Đã tạo xong các bảng: all_logs, anomalies, aggregate_anomalies.")
+    log.info("Đã tạo xong các bảng: all_logs, anomalies, aggregate_anomalies, anomaly_rollups, log_rollups.")
 
     log.info("-------------------------------------------------")
     log.info("BƯỚC 3: Kiểm tra bổ sung")
@@ -68,6 +71,13 @@ try:
     with engine.begin() as conn:
         conn.execute(text(create_agg_check_sql))
     
+    log.info("BƯỚC 4: Index tìm kiếm (pg_trgm + full-text)")
+    run_migrations(engine)
+
+    log.info("BƯỚC 5: Tạo trước partition theo thời gian cho all_logs")
+    from engine.partitions import ensure_partitions
+    ensure_partitions(engine)
+
     log.info("✅ HOÀN TẤT! Schema CSDL đã được khởi tạo thành công.")
     log.info("-------------------------------------------------")
 
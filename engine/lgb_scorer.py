@@ -0,0 +1,232 @@
+# engine/lgb_scorer.py
+"""
+================================================================================
+LIGHTGBM SCORER (COMPILED INFERENCE PATH)
+================================================================================
+Chấm điểm ML cho load_and_process_data:
+
+- Đường nhanh: gọi thẳng Booster.predict trên một ma trận numpy dựng sẵn.
+  Mã category được tra bằng pd.Index cache theo từng phiên bản model (không
+  astype('category') từng cột, không qua lớp sklearn/pandas của LightGBM).
+- Đường cũ (fallback): encode bằng pandas + LGBMClassifier.predict_proba.
+
+Phần lớn thời gian là duyệt cây trong LightGBM (giống nhau ở cả hai đường); đường
+nhanh chỉ bỏ được phần encode pandas, p99 giảm khoảng 5-10%. float32 và model biên
+dịch bằng treelite/tl2cgen đã thử, không nhanh hơn Booster.predict.
+
+Parity hai đường được kiểm tra trong tests/test_lgb_scorer_parity.py. Kiểm tra lúc
+chạy (LGB_PARITY_CHECK_ROWS > 0) là tùy chọn: chấm thêm bằng đường cũ N dòng đầu
+của batch đầu tiên mỗi phiên bản model, lệch quá LGB_PARITY_TOLERANCE -> tắt đường
+nhanh cho phiên bản đó.
+
+Benchmark: python engine/lgb_scorer.py [số_dòng]
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+LGB_COMPILED_INFERENCE = os.getenv("LGB_COMPILED_INFERENCE", "1") == "1"
+# 0 = không chấm lại bằng đường cũ lúc chạy (parity đã được test)
+LGB_PARITY_CHECK_ROWS = int(os.getenv("LGB_PARITY_CHECK_ROWS", "0"))
+LGB_PARITY_TOLERANCE = float(os.getenv("LGB_PARITY_TOLERANCE", "1e-9"))
+
+
+# ==============================================================================
+# ĐƯỜNG CŨ (PANDAS + SKLEARN WRAPPER)
+# ==============================================================================
+
+def encode_frame(df: pd.DataFrame, features: List[str], cat_mapping: Dict[str, list]) -> pd.DataFrame:
+    """Encode giống hệt bản gốc: category theo cat_mapping, số -> to_numeric().fillna(0)."""
+    X = df.copy()
+    for f in features:
+        if f not in X.columns: X[f] = 0
+    X = X[features]
+
+    for col in X.columns:
+        if col in cat_mapping:
+            known_cats = cat_mapping[col]
+            X[col] = X[col].astype(str).astype(pd.CategoricalDtype(categories=known_cats))
+            if 'unknown' in known_cats:
+                X[col] = X[col].fillna('unknown')
+            else:
+                X[col] = X[col].fillna(known_cats[0])
+        else:
+            X[col] = pd.to_numeric(X[col], errors='coerce').fillna(0)
+    return X
+
+
+def predict_pandas(bundle, df: pd.DataFrame) -> np.ndarray:
+    X = encode_frame(df, list(bundle.features), bundle.cat_mapping)
+    return bundle.model.predict_proba(X)[:, 1]
+
+
+# ==============================================================================
+# ĐƯỜNG NHANH (NATIVE BOOSTER)
+# ==============================================================================
+
+class CompiledLGBScorer:
+    """Booster + bảng tra mã category cho một phiên bản model."""
+
+    def __init__(self, model, features, cat_mapping: Dict[str, list]):
+        self.booster = model.booster_
+        self.features = list(features)
+        if self.booster.feature_name() != self.features:
+            raise ValueError("Booster feature order does not match bundle features")
+        self.num_threads = getattr(model, "n_jobs", None)
+        # Mã category = vị trí trong cat_mapping (khớp pandas_categorical lúc train)
+        self.cat_index: Dict[str, pd.Index] = {}
+        self.cat_default: Dict[str, int] = {}
+        for col, known_cats in cat_mapping.items():
+            if col in self.features and known_cats:
+                index = pd.Index(known_cats)
+                self.cat_index[col] = index
+                self.cat_default[col] = index.get_loc('unknown') if 'unknown' in known_cats else 0
+        self.verified = False
+        self.disabled = False
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray:
+        n = len(df)
+        mat = np.empty((n, len(self.features)), dtype=np.float64)
+        for j, col in enumerate(self.features):
+            if col in self.cat_index:
+                values = df[col].astype(str) if col in df.columns else pd.Series(['0'] * n)
+                codes = self.cat_index[col].get_indexer(values)
+                codes[codes < 0] = self.cat_default[col]
+                mat[:, j] = codes
+            elif col in df.columns:
+                mat[:, j] = pd.to_numeric(df[col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+            else:
+                mat[:, j] = 0.0
+        return mat
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        kwargs = {"num_threads": self.num_threads} if self.num_threads else {}
+        return self.booster.predict(self.transform(df), **kwargs)
+
+
+_scorer_lock = threading.Lock()
+_scorer_cache: Dict[str, CompiledLGBScorer] = {}
+
+
+def get_compiled_scorer(bundle) -> Optional[CompiledLGBScorer]:
+    """Scorer đã cache cho phiên bản model (None nếu model không hỗ trợ / đã bị tắt)."""
+    with _scorer_lock:
+        scorer = _scorer_cache.get(bundle.version)
+        if scorer is None:
+            try:
+                scorer = CompiledLGBScorer(bundle.model, bundle.features, bundle.cat_mapping)
+            except Exception as e:
+                logger.warning(f"Compiled scorer unavailable for {bundle.version}: {e}")
+                return None
+            _scorer_cache.clear()  # Chỉ giữ phiên bản đang dùng
+            _scorer_cache[bundle.version] = scorer
+    return None if scorer.disabled else scorer
+
+
+def score_batch(bundle, df: pd.DataFrame) -> np.ndarray:
+    """Xác suất bất thường (lớp 1) cho từng dòng của df."""
+    scorer = get_compiled_scorer(bundle) if LGB_COMPILED_INFERENCE else None
+    if scorer is None:
+        return predict_pandas(bundle, df)
+
+    try:
+        scores = scorer.predict(df)
+    except Exception as e:
+        logger.error(f"Compiled scoring failed for {bundle.version} ({e}); falling back to predict_proba.")
+        scorer.disabled = True
+        return predict_pandas(bundle, df)
+
+    if not scorer.verified and LGB_PARITY_CHECK_ROWS > 0:
+        # Parity check một lần cho mỗi phiên bản model
+        sample = df.iloc[:LGB_PARITY_CHECK_ROWS]
+        expected = predict_pandas(bundle, sample)
+        diff = float(np.max(np.abs(expected - scores[:len(sample)]))) if len(sample) else 0.0
+        if diff > LGB_PARITY_TOLERANCE:
+            logger.error(f"Compiled scorer parity check FAILED for {bundle.version} "
+                         f"(max diff {diff:.3e}); using predict_proba for this model.")
+            scorer.disabled = True
+            return predict_pandas(bundle, df)
+        scorer.verified = True
+        logger.info(f"Compiled scorer verified for {bundle.version} (max diff {diff:.1e}).")
+    return scores
+
+
+# ==============================================================================
+# BENCHMARK
+# ==============================================================================
+
+def synthetic_model(seed: int = 42, n_train: int = 20000):
+    """
+    Model tổng hợp cho benchmark / test parity: (bundle, make_frame).
+    make_frame(n) sinh batch cùng phân phối với dữ liệu train.
+    """
+    import lightgbm as lgb
+    from types import SimpleNamespace
+
+    rng = np.random.default_rng(seed)
+    cat_values = {
+        'user': [f"user{i}" for i in range(200)],
+        'client_ip': [f"10.0.{i // 256}.{i % 256}" for i in range(300)],
+        'database': [f"db{i}" for i in range(20)],
+        'command_type': ['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'OTHER', 'unknown'],
+    }
+    num_cols = [f"num_{i}" for i in range(30)]
+
+    def make_frame(n):
+        data = {col: rng.choice(values, n) for col, values in cat_values.items()}
+        data.update({col: rng.random(n) * 100 for col in num_cols})
+        return pd.DataFrame(data)
+
+    train = make_frame(n_train)
+    features = list(train.columns)
+    cat_mapping = {}
+    X = train.copy()
+    for col in cat_values:
+        X[col] = X[col].astype(str).astype('category')
+        cat_mapping[col] = X[col].cat.categories.tolist()
+    y = (train['num_0'] + rng.normal(0, 10, n_train) > 90).astype(int)
+    model = lgb.LGBMClassifier(n_estimators=200, learning_rate=0.05, num_leaves=31, n_jobs=-1, verbose=-1)
+    model.fit(X, y, categorical_feature=list(cat_values))
+    bundle = SimpleNamespace(version="bench", model=model, features=tuple(features), cat_mapping=cat_mapping)
+    return bundle, make_frame
+
+
+def benchmark(n_rows: int = 10000, repeat: int = 50) -> Dict[str, float]:
+    """p50/p99 độ trễ chấm điểm (ms) của đường pandas và đường native trên model tổng hợp."""
+    bundle, make_frame = synthetic_model()
+    batch = make_frame(n_rows)
+    batch.loc[:10, 'user'] = 'never_seen_user'
+    scorer = CompiledLGBScorer(bundle.model, bundle.features, bundle.cat_mapping)
+
+    def latencies(fn):
+        out = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            out.append((time.perf_counter() - started) * 1000)
+        return np.percentile(out, 50), np.percentile(out, 99)
+
+    pandas_p50, pandas_p99 = latencies(lambda: predict_pandas(bundle, batch))
+    native_p50, native_p99 = latencies(lambda: scorer.predict(batch))
+    return {
+        "rows": n_rows,
+        "max_abs_diff": float(np.max(np.abs(predict_pandas(bundle, batch) - scorer.predict(batch)))),
+        "pandas_p50_ms": round(pandas_p50, 2), "pandas_p99_ms": round(pandas_p99, 2),
+        "native_p50_ms": round(native_p50, 2), "native_p99_ms": round(native_p99, 2),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [LGBScorer] - %(message)s")
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for key, value in benchmark(rows).items():
+        logger.info(f"{key}: {value}")
@@ -0,0 +1,189 @@
+# engine/model_registry.py
+"""
+================================================================================
+MODEL REGISTRY (VERSIONED, ATOMIC, CHECKSUMMED)
+================================================================================
+Mỗi phiên bản model là một thư mục bất biến:
+
+    <MODEL_REGISTRY_DIR>/<version>/bundle.joblib   # model + features + cat_mapping + scaler + AE state
+    <MODEL_REGISTRY_DIR>/<version>/manifest.json   # metadata + sha256 của bundle
+    <MODEL_REGISTRY_DIR>/CURRENT                   # tên phiên bản đang dùng
+
+Ghi: dump vào thư mục tạm -> rename thư mục (nguyên tử) -> thay CURRENT bằng os.replace.
+Đọc: kiểm tra sha256; bundle hỏng thì lùi về phiên bản hợp lệ gần nhất.
+
+Engine giữ một tham chiếu ModelBundle bất biến cho inference; thread train chỉ
+cần gán lại tham chiếu này khi có bundle mới (không khóa, không đọc file giữa batch).
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import joblib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import MODELS_DIR
+
+logger = logging.getLogger(__name__)
+
+MODEL_REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", os.path.join(MODELS_DIR, "registry"))
+# Số phiên bản giữ lại (phiên bản cũ hơn bị xóa sau mỗi lần publish)
+MODEL_REGISTRY_KEEP = int(os.getenv("MODEL_REGISTRY_KEEP", "5"))
+
+BUNDLE_FILE = "bundle.joblib"
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+
+
+class ModelRegistryError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ModelBundle:
+    """Mọi thứ inference cần, thay thế cùng nhau. Không sửa sau khi tạo."""
+    version: str
+    model: Any
+    features: Tuple[str, ...]
+    cat_mapping: Dict[str, list] = field(default_factory=dict)
+    scaler: Any = None
+    ae_state: Optional[Dict[str, Any]] = None
+    trained_at: str = ""
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+def make_version(features) -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    version_hash = hashlib.md5(str(list(features)).encode()).hexdigest()[:8]
+    return f"v{timestamp}_{version_hash}"
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ModelRegistry:
+    def __init__(self, root: str = MODEL_REGISTRY_DIR, keep: int = MODEL_REGISTRY_KEEP):
+        self.root = root
+        self.keep = max(1, keep)
+
+    # ------------------------------------------------------------------
+    def _version_dir(self, version: str) -> str:
+        return os.path.join(self.root, version)
+
+    def list_versions(self) -> List[str]:
+        """Các phiên bản đã publish hoàn chỉnh, cũ -> mới (tên phiên bản sắp theo thời gian)."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith(".") and os.path.isfile(os.path.join(self.root, name, MANIFEST_FILE))
+        )
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.root, CURRENT_FILE), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    # ------------------------------------------------------------------
+    def publish(self, bundle: ModelBundle) -> str:
+        """Ghi bundle thành phiên bản mới và trỏ CURRENT tới nó."""
+        os.makedirs(self.root, exist_ok=True)
+        final_dir = self._version_dir(bundle.version)
+        if os.path.exists(final_dir):
+            raise ModelRegistryError(f"Version {bundle.version} already exists")
+
+        tmp_dir = os.path.join(self.root, f".{bundle.version}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            bundle_path = os.path.join(tmp_dir, BUNDLE_FILE)
+            joblib.dump(bundle, bundle_path)
+            manifest = {
+                "version": bundle.version,
+                "trained_at": bundle.trained_at,
+                "published_at": datetime.now().isoformat(),
+                "feature_count": len(bundle.features),
+                "features": list(bundle.features),
+                "has_scaler": bundle.scaler is not None,
+                "has_ae_state": bundle.ae_state is not None,
+                "metadata": bundle.metadata,
+                "files": {BUNDLE_FILE: {"sha256": _sha256(bundle_path), "bytes": os.path.getsize(bundle_path)}},
+            }
+            with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2, default=str)
+            os.rename(tmp_dir, final_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        _write_atomic(os.path.join(self.root, CURRENT_FILE), bundle.version)
+        self._prune()
+        return bundle.version
+
+    def _prune(self):
+        current = self.current_version()
+        versions = self.list_versions()
+        for version in versions[:-self.keep]:
+            if version != current:
+                shutil.rmtree(self._version_dir(version), ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    def load(self, version: Optional[str] = None) -> ModelBundle:
+        """Đọc một phiên bản (mặc định CURRENT) sau khi kiểm tra checksum."""
+        version = version or self.current_version()
+        if not version:
+            raise ModelRegistryError("Registry has no current version")
+        version_dir = self._version_dir(version)
+        try:
+            with open(os.path.join(version_dir, MANIFEST_FILE), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ModelRegistryError(f"Cannot read manifest of {version}: {e}")
+
+        bundle_path = os.path.join(version_dir, BUNDLE_FILE)
+        expected = manifest.get("files", {}).get(BUNDLE_FILE, {}).get("sha256")
+        if not os.path.isfile(bundle_path) or _sha256(bundle_path) != expected:
+            raise ModelRegistryError(f"Checksum mismatch for {version}")
+
+        bundle = joblib.load(bundle_path)
+        if not isinstance(bundle, ModelBundle) or bundle.version != version:
+            raise ModelRegistryError(f"Unexpected bundle content in {version}")
+        return bundle
+
+    def load_latest_valid(self) -> Optional[ModelBundle]:
+        """CURRENT nếu hợp lệ, nếu không thì phiên bản hợp lệ mới nhất (thay cho file fallback)."""
+        current = self.current_version()
+        candidates = [current] if current else []
+        candidates += [v for v in reversed(self.list_versions()) if v != current]
+        for version in candidates:
+            try:
+                bundle = self.load(version)
+                if version != current:
+                    logger.warning(f"Model registry: CURRENT={current} unusable, fell back to {version}")
+                return bundle
+            except Exception as e:
+                logger.error(f"Model registry: cannot load {version}: {e}")
+        return None
@@ -10,6 +10,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from config import *
     from engine.utils import save_logs_to_parquet, configure_redis_for_reliability, handle_redis_misconf_error
+    from engine import redis_pool
 
     try:
         # Đọc URL của publisher kia để biết nó dùng user nào
@@ -33,20 +34,8 @@ STREAM_KEY = None # Sẽ được set khi chạy
 
 # --- HÀM KẾT NỐI REDIS TIN CẬY ---
 def connect_redis():
-    """Kết nối đến Redis với cơ chế thử lại vô hạn."""
-    while True:
-        try:
-            r = Redis.from_url(REDIS_URL, decode_responses=True)
-            r.ping()
-            logging.info("Kết nối Redis (Publisher) thành công.")
-            
-            # Configure Redis for better reliability
-            configure_redis_for_reliability(r)  
-            
-            return r
-        except ConnectionError as e:
-            logging.error(f"Kết nối Redis (Publisher) thất bại: {e}. Thử lại sau 5 giây...")
-            time.sleep(5)
+    """Kết nối đến Redis (connection pool dùng chung) với cơ chế thử lại vô hạn."""
+    return redis_pool.connect_redis(configure=True)
 
 # ==============================================================================
 # LOGIC TỪ MYSQL_LOG_PARSER.PY
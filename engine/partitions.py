@@ -0,0 +1,320 @@
+# engine/partitions.py
+"""
+================================================================================
+ALL_LOGS TIME PARTITIONING (POSTGRESQL RANGE PARTITIONS)
+================================================================================
+all_logs là bảng PARTITION BY RANGE (timestamp) (xem backend_api/models.py):
+
+    all_logs_p20261016   FOR VALUES FROM ('2026-10-16') TO ('2026-10-17')   # theo ngày
+    all_logs_p20261012   FOR VALUES FROM ('2026-10-12') TO ('2026-10-19')   # hoặc theo tuần
+    all_logs_default     DEFAULT                                             # dòng ngoài mọi khoảng
+
+- ensure_partitions: tạo trước partition cho PARTITION_PREMAKE khoảng tới. Nếu partition
+  default đang giữ dòng thuộc khoảng mới, các dòng đó được chuyển sang trước khi ATTACH.
+- apply_retention: partition cũ hơn ALL_LOGS_RETENTION_DAYS được lưu ra parquet
+  (PARTITION_ARCHIVE=1) rồi DETACH + DROP (không DELETE từng dòng, không bloat).
+- Index khai báo trên bảng cha (model + index tìm kiếm) là template: PostgreSQL tự
+  tạo trên mọi partition mới. Query lọc theo timestamp chỉ quét partition liên quan.
+
+DB writer gọi maybe_ensure_partitions (tối đa 1 lần / PARTITION_MAINTENANCE_INTERVAL_SEC);
+retention chạy theo lịch (cron):
+    python engine/partitions.py maintain      # tạo trước + retention
+    python engine/partitions.py status
+    python engine/partitions.py migrate       # chuyển bảng all_logs cũ (không phân vùng) sang phân vùng
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+logger = logging.getLogger(__name__)
+
+# 'day' | 'week' (tuần bắt đầu từ thứ Hai)
+ALL_LOGS_PARTITION_INTERVAL = os.getenv("ALL_LOGS_PARTITION_INTERVAL", "day")
+# Số khoảng (ngày / tuần) được tạo trước
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", "7"))
+# 0 = giữ vĩnh viễn
+ALL_LOGS_RETENTION_DAYS = int(os.getenv("ALL_LOGS_RETENTION_DAYS", "90"))
+PARTITION_ARCHIVE = os.getenv("PARTITION_ARCHIVE", "1") == "1"
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", os.path.join(PROJECT_ROOT, "data", "archive"))
+PARTITION_ARCHIVE_CHUNK_ROWS = int(os.getenv("PARTITION_ARCHIVE_CHUNK_ROWS", "200000"))
+PARTITION_MAINTENANCE_INTERVAL_SEC = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SEC", "3600"))
+
+PARTITIONED_TABLE = "all_logs"
+TIME_COLUMN = "timestamp"
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+_last_maintenance = 0.0
+
+
+# ==============================================================================
+# KHOẢNG THỜI GIAN / TÊN PARTITION
+# ==============================================================================
+
+def interval_start(ts: datetime, interval: str = ALL_LOGS_PARTITION_INTERVAL) -> datetime:
+    start = datetime(ts.year, ts.month, ts.day)
+    if interval == "week":
+        start -= timedelta(days=start.weekday())
+    elif interval != "day":
+        raise ValueError(f"Unsupported partition interval '{interval}'")
+    return start
+
+
+def interval_bounds(ts: datetime, interval: str = ALL_LOGS_PARTITION_INTERVAL) -> Tuple[datetime, datetime]:
+    start = interval_start(ts, interval)
+    return start, start + timedelta(days=7 if interval == "week" else 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+# ==============================================================================
+# TRA CỨU
+# ==============================================================================
+
+def is_partitioned(conn, table: str = PARTITIONED_TABLE) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE relname = :t"), {"t": table}).scalar() or False
+
+
+def list_partitions(conn, table: str = PARTITIONED_TABLE) -> List[Tuple[str, datetime, datetime]]:
+    """(tên, start, end) của các partition theo khoảng, cũ -> mới (không gồm partition default)."""
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :t
+    """), {"t": table}).all()
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound or "")
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+# ==============================================================================
+# TẠO TRƯỚC PARTITION
+# ==============================================================================
+
+def create_partition(conn, table: str, start: datetime, end: datetime) -> str:
+    """Tạo partition [start, end); dòng tương ứng đang nằm trong partition default được chuyển sang."""
+    name = partition_name(table, start)
+    default = default_partition_name(table)
+    params = {"start": start, "end": end}
+    stranded = conn.execute(text(
+        f'SELECT 1 FROM {default} WHERE "{TIME_COLUMN}" >= :start AND "{TIME_COLUMN}" < :end LIMIT 1'
+    ), params).first()
+    if stranded is None:
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{start:%Y-%m-%d %H:%M:%S}') "
+            f"TO ('{end:%Y-%m-%d %H:%M:%S}')"
+        ))
+    else:
+        conn.execute(text(f"CREATE TABLE {name} (LIKE {table})"))
+        moved = conn.execute(text(f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE "{TIME_COLUMN}" >= :start AND "{TIME_COLUMN}" < :end RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """), params).rowcount
+        conn.execute(text(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start:%Y-%m-%d %H:%M:%S}') "
+            f"TO ('{end:%Y-%m-%d %H:%M:%S}')"
+        ))
+        logger.info(f"Moved {moved} rows from {default} into {name}")
+    return name
+
+
+def ensure_partitions(db_engine, table: str = PARTITIONED_TABLE, now: Optional[datetime] = None,
+                      premake: int = PARTITION_PREMAKE) -> List[str]:
+    """Đảm bảo có partition default và partition cho khoảng hiện tại + premake khoảng tới. Trả về tên đã tạo."""
+    now = now or datetime.now()
+    created = []
+    with db_engine.begin() as conn:
+        if not is_partitioned(conn, table):
+            return created
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {default_partition_name(table)} PARTITION OF {table} DEFAULT"))
+        existing = {start for _, start, _ in list_partitions(conn, table)}
+        start, _ = interval_bounds(now)
+        last = start
+        for _ in range(premake):
+            last = interval_bounds(last)[1]
+        while start <= last:
+            end = interval_bounds(start)[1]
+            if start not in existing:
+                created.append(create_partition(conn, table, start, end))
+            start = end
+    if created:
+        logger.info(f"Created {len(created)} partition(s) of {table}: {created[0]} .. {created[-1]}")
+    return created
+
+
+def maybe_ensure_partitions(db_engine):
+    """Gọi từ DB writer: tạo trước partition tối đa 1 lần / PARTITION_MAINTENANCE_INTERVAL_SEC."""
+    global _last_maintenance
+    now = time.time()
+    if now - _last_maintenance < PARTITION_MAINTENANCE_INTERVAL_SEC or db_engine.dialect.name != "postgresql":
+        return
+    _last_maintenance = now
+    try:
+        ensure_partitions(db_engine)
+    except Exception as e:
+        # Không chặn việc ghi: dòng ngoài khoảng vẫn vào partition default
+        logger.warning(f"Partition maintenance failed: {e}")
+
+
+# ==============================================================================
+# RETENTION (ARCHIVE PARQUET + DROP)
+# ==============================================================================
+
+def _archive_query(conn, sql: str, params: dict, out_dir: str) -> int:
+    """Ghi kết quả query ra thư mục parquet (mỗi chunk một file, ghi tạm rồi đổi tên)."""
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    total = 0
+    stream = conn.execution_options(stream_results=True)
+    for i, chunk in enumerate(pd.read_sql(text(sql), stream, params=params, chunksize=PARTITION_ARCHIVE_CHUNK_ROWS)):
+        for col in chunk.columns[chunk.dtypes == object]:
+            # JSONB (list / dict) -> chuỗi JSON để schema parquet ổn định
+            if chunk[col].map(lambda v: isinstance(v, (list, dict))).any():
+                chunk[col] = chunk[col].map(lambda v: json.dumps(v, ensure_ascii=False, default=str)
+                                            if isinstance(v, (list, dict)) else v)
+        chunk.to_parquet(os.path.join(tmp_dir, f"part-{i:05d}.parquet"), engine="pyarrow",
+                         compression="snappy", index=False)
+        total += len(chunk)
+    # Lần chạy trước đã archive nhưng DROP bị rollback -> ghi đè
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return total
+
+
+def apply_retention(db_engine, table: str = PARTITIONED_TABLE, retention_days: int = ALL_LOGS_RETENTION_DAYS,
+                    archive: bool = PARTITION_ARCHIVE, now: Optional[datetime] = None) -> List[str]:
+    """DETACH + DROP các partition kết thúc trước mốc retention (archive parquet trước nếu bật)."""
+    if retention_days <= 0:
+        return []
+    cutoff = (now or datetime.now()) - timedelta(days=retention_days)
+    dropped = []
+    with db_engine.connect() as conn:
+        if not is_partitioned(conn, table):
+            return dropped
+        expired = [(name, start, end) for name, start, end in list_partitions(conn, table) if end <= cutoff]
+
+    for name, start, end in expired:
+        with db_engine.begin() as conn:
+            if archive:
+                out_dir = os.path.join(PARTITION_ARCHIVE_DIR, table, name)
+                rows = _archive_query(conn, f"SELECT * FROM {name}", {}, out_dir)
+                logger.info(f"Archived {rows} rows of {name} to {out_dir}")
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+
+    # Dòng cũ lọt vào partition default (VD log đến trễ trước khi có partition)
+    default = default_partition_name(table)
+    where = f'"{TIME_COLUMN}" < :cutoff'
+    with db_engine.begin() as conn:
+        if conn.execute(text(f"SELECT 1 FROM {default} WHERE {where} LIMIT 1"), {"cutoff": cutoff}).first():
+            if archive:
+                out_dir = os.path.join(PARTITION_ARCHIVE_DIR, table, f"{default}_before_{cutoff:%Y%m%d%H%M%S}")
+                _archive_query(conn, f"SELECT * FROM {default} WHERE {where}", {"cutoff": cutoff}, out_dir)
+            deleted = conn.execute(text(f"DELETE FROM {default} WHERE {where}"), {"cutoff": cutoff}).rowcount
+            logger.info(f"Removed {deleted} expired rows from {default}")
+
+    if dropped:
+        logger.info(f"Retention ({retention_days}d) dropped {len(dropped)} partition(s) of {table}")
+    return dropped
+
+
+# ==============================================================================
+# CHUYỂN BẢNG CŨ SANG PHÂN VÙNG
+# ==============================================================================
+
+def migrate_to_partitioned(db_engine, keep_legacy: bool = False):
+    """
+    all_logs (bảng thường) -> all_logs phân vùng, trong một transaction:
+    đổi tên bảng / index / sequence cũ, tạo bảng cha theo model, tạo partition phủ dữ liệu cũ,
+    chép dữ liệu, đặt lại sequence id. Nên chạy khi Engine đang dừng.
+    """
+    from backend_api.models import AllLogs, run_migrations  # type: ignore
+
+    table, legacy = PARTITIONED_TABLE, f"{PARTITIONED_TABLE}_legacy"
+    with db_engine.begin() as conn:
+        if is_partitioned(conn, table):
+            logger.info(f"{table} is already partitioned")
+            return
+        conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        for (index_name,) in conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": legacy}):
+            conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_legacy"'))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": legacy}).scalar()
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq"))
+
+        AllLogs.__table__.create(conn)
+        bounds = conn.execute(text(f'SELECT MIN("{TIME_COLUMN}"), MAX("{TIME_COLUMN}") FROM {legacy}')).one()
+        conn.execute(text(f"CREATE TABLE {default_partition_name(table)} PARTITION OF {table} DEFAULT"))
+        first = bounds[0] or datetime.now()
+        start, _ = interval_bounds(first)
+        while start <= (bounds[1] or first):
+            end = interval_bounds(start)[1]
+            create_partition(conn, table, start, end)
+            start = end
+
+        columns = ", ".join(f'"{c.name}"' for c in AllLogs.__table__.columns)
+        copied = conn.execute(text(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")).rowcount
+        conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                          f"GREATEST((SELECT MAX(id) FROM {table}), 1))"))
+        if not keep_legacy:
+            conn.execute(text(f"DROP TABLE {legacy}"))
+        logger.info(f"Copied {copied} rows into partitioned {table}")
+
+    run_migrations(db_engine)  # index tìm kiếm trên bảng cha mới
+    ensure_partitions(db_engine)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [Partitions] - %(message)s")
+    parser = argparse.ArgumentParser(description="all_logs partition maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    maintain = sub.add_parser("maintain", help="Create upcoming partitions and apply retention")
+    maintain.add_argument("--no-archive", action="store_true")
+    sub.add_parser("status", help="List partitions")
+    migrate = sub.add_parser("migrate", help="Convert an unpartitioned all_logs table")
+    migrate.add_argument("--keep-legacy", action="store_true")
+    args = parser.parse_args()
+
+    from backend_api.models import engine as db_engine  # type: ignore
+    if args.command == "maintain":
+        ensure_partitions(db_engine)
+        apply_retention(db_engine, archive=PARTITION_ARCHIVE and not args.no_archive)
+    elif args.command == "migrate":
+        migrate_to_partitioned(db_engine, keep_legacy=args.keep_legacy)
+    else:
+        with db_engine.connect() as conn:
+            for name, start, end in list_partitions(conn):
+                rows = conn.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = :n"), {"n": name}).scalar()
+                logger.info(f"{name}: [{start} .. {end}) ~{max(rows or 0, 0)} rows")
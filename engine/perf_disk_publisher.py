@@ -12,6 +12,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from config import *
     from engine.utils import save_logs_to_parquet, extract_db_from_sql
+    from engine import redis_pool
 except ImportError:
     print("Lỗi: Không thể import 'config' hoặc 'engine.utils'.")
     sys.exit(1)
@@ -108,7 +109,7 @@ def monitor_persistent_log(poll_interval=1): # Poll nhanh mỗi 1s
     global is_running, total_collected
     
     engine = connect_db()
-    redis = Redis.from_url(REDIS_URL, decode_responses=True)
+    redis = redis_pool.get_redis()
     
     last_id = get_last_id()
     logging.info(f"🚀 Persistent Publisher started. Last ID: {last_id}")
@@ -285,7 +286,8 @@ def monitor_persistent_log(poll_interval=1): # Poll nhanh mỗi 1s
                 # Reconnect
                 try:
                     engine = connect_db()
-                    redis = Redis.from_url(REDIS_URL, decode_responses=True)
+                    redis_pool.reset_pool()
+                    redis = redis_pool.get_redis()
                 except: pass
         
         time.sleep(poll_interval)
@@ -14,6 +14,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from config import *
     from engine.utils import save_logs_to_parquet, configure_redis_for_reliability, handle_redis_misconf_error, extract_db_from_sql
+    from engine import redis_pool
 except ImportError:
     print("Lỗi: Không thể import 'config' hoặc 'engine.utils'.")
     sys.exit(1)
@@ -114,20 +115,8 @@ def connect_db():
         return None
 
 def connect_redis():
-    while is_running:
-        try:
-            r = Redis.from_url(REDIS_URL, decode_responses=True)
-            r.ping()
-            logging.info("✅ Kết nối Redis thành công.")
-            
-            # Configure Redis for better reliability
-            configure_redis_for_reliability(r)  
-            
-            return r
-        except Exception as e:
-            logging.error(f"❌ Lỗi kết nối Redis: {e}. Thử lại sau 5s...")
-            time.sleep(5)
-    return None
+    # Connection pool dùng chung (health check + tự thử lại), cấu hình reliability một lần
+    return redis_pool.connect_redis(configure=True, should_continue=lambda: is_running)
 
 # === 3. Logic Feature ===
 
@@ -12,7 +12,10 @@ from engine.db_writer import save_results_to_db
 from email_alert import send_email_alert
 from active_response import execute_lock_and_kill_strategy
 from utils import generate_html_alert
-from engine.utils import configure_redis_for_reliability, handle_redis_misconf_error
+from engine.utils import handle_redis_misconf_error
+from engine import redis_pool
+from engine.write_behind import WriteBehindSink
+from engine.stream_decoder import decode_stream_batch
 from config import *
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [RealtimeEngine] - %(message)s")
@@ -33,43 +36,22 @@ signal.signal(signal.SIGINT, handle_shutdown)
 signal.signal(signal.SIGTERM, handle_shutdown)
     
 # --- HÀM KẾT NỐI REDIS ---
-            
+# Dùng connection pool chung (engine/redis_pool.py), có health check và bộ đếm reconnect
+
 def connect_redis():
-    while is_running:
-        try:
-            r = Redis.from_url(
-                REDIS_URL, 
-                decode_responses=True,
-                socket_keepalive=True,
-                socket_keepalive_options={},
-                health_check_interval=30,
-                retry_on_timeout=True,
-                socket_connect_timeout=5
-            )
-            r.ping()
-            
-            # Configure Redis for better reliability
-            configure_redis_for_reliability(r)
-            
-            logging.info("✅ Kết nối Redis thành công.")
-            return r
-        except Exception as e:
-            logging.error(f"❌ Lỗi kết nối Redis: {e}. Thử lại sau 5s...")
-            time.sleep(5)
-    return None
+    return redis_pool.connect_redis(configure=True, should_continue=lambda: is_running)
 
-def ensure_group(r: Redis, stream: str, group: str):
+def ensure_group(r: Redis, stream: str, group: str, start_id: str = "$"):
     """Đảm bảo Consumer Group tồn tại"""
-    try:
-        r.xgroup_create(stream, group, id="$", mkstream=True)
-        logging.info(f"Created consumer group {group} on {stream}")
-    except ResponseError as e:
-        if "BUSYGROUP" in str(e):
-            logging.info(f"Consumer group {group} already exists on {stream}.")
-            pass
-        else:
-            logging.error(f"❌ Lỗi tạo group {group} trên {stream}: {e}")
-            raise e
+    redis_pool.ensure_consumer_group(r, stream, group, start_id=start_id)
+
+# --- WRITE-BEHIND (ghi DB bất đồng bộ, ACK sau khi commit) ---
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "1") == "1"
+
+def ack_messages(ack_ids):
+    """ACK các message đã được ghi bền vững (gọi từ writer thread hoặc vòng lặp chính).
+    Một XACK cho mỗi stream, gửi trong một pipeline."""
+    redis_pool.ack_messages(redis_pool.get_redis(), REDIS_GROUP_ENGINE, ack_ids)
 
 
 def handle_email_alerts_async(results: dict):
@@ -336,19 +318,49 @@ def handle_active_responses(results: dict):
 
 
 
-def start_engine():
+def start_engine(streams=None, consumer_name=None, stop_event=None, block_ms=50000, on_batch=None):
+    """
+    Vòng lặp consumer chính.
+    Mặc định đọc STREAMS với REDIS_CONSUMER_NAME (một tiến trình). Khi chạy dưới
+    engine_supervisor, mỗi worker nhận danh sách stream phân vùng của mình,
+    một stop_event dùng chung để dừng đồng loạt và callback on_batch(n_records, seconds)
+    để báo throughput.
+    """
     global is_running
-    
+
+    # Stream phân vùng chỉ chứa message router đã chuyển (và đã ACK ở stream gốc): đọc từ "0"
+    group_start_id = "0" if streams else "$"
+    streams = list(streams) if streams else list(STREAMS.keys())
+    consumer_name = consumer_name or REDIS_CONSUMER_NAME
+
+    def running():
+        return is_running and not (stop_event is not None and stop_event.is_set())
+
+    def ensure_groups(r):
+        for stream in streams:
+            ensure_group(r, stream, REDIS_GROUP_ENGINE, start_id=group_start_id)
+
     r = connect_redis()
-    
-    logging.info(f"Initializing Consumer Group: {REDIS_GROUP_ENGINE}")
-    for stream in STREAMS.values():
-        ensure_group(r, stream, REDIS_GROUP_ENGINE)
 
-    ensure_group(r, "uba:logs:mysql", REDIS_GROUP_ENGINE)
+    # Nhận lại message treo trong PEL (consumer chết / ghi DB lỗi) bằng XPENDING + XCLAIM
+    reclaimer = redis_pool.PendingReclaimer(streams, REDIS_GROUP_ENGINE, consumer_name)
+
+    def ack_persisted(ack_ids):
+        ack_messages(ack_ids)
+        reclaimer.mark_persisted(ack_ids)
+
+    # Writer thread: gom kết quả nhiều batch, ghi DB rồi mới ACK
+    write_sink = WriteBehindSink(save_results_to_db, ack_persisted,
+                                 fail_fn=reclaimer.mark_persistence_failed).start() if WRITE_BEHIND_ENABLED else None
+    # Không nhận lại message sink còn giữ (trong buffer / đang thử ghi lại / chờ submit)
+    reclaimer.in_flight = write_sink.in_flight_ids if write_sink is not None else None
+    reclaimer.start()
+    
+    logging.info(f"Initializing Consumer Group: {REDIS_GROUP_ENGINE} on {streams} (consumer={consumer_name})")
+    ensure_groups(r)
     logging.info("Realtime UBA Engine STARTED — Monitoring MySQL Performance Schema")
 
-    while is_running:
+    while running():
         try:
             # Check if Redis connection is still valid
             if not r:
@@ -358,33 +370,37 @@ def start_engine():
                     time.sleep(5)
                     continue
             
-            msgs = r.xreadgroup(
-                groupname=REDIS_GROUP_ENGINE,
-                consumername=REDIS_CONSUMER_NAME,
-                streams=STREAMS,
-                count=10000,
-                block=50000
-            )
+            # Ưu tiên xử lý các message đã nhận lại từ PEL, sau đó mới đọc message mới
+            msgs = reclaimer.drain(max_messages=10000)
+            if not msgs:
+                msgs = r.xreadgroup(
+                    groupname=REDIS_GROUP_ENGINE,
+                    consumername=consumer_name,
+                    streams={stream: ">" for stream in streams},
+                    count=10000,
+                    block=block_ms
+                )
 
             if not msgs:
                 continue
 
-            records = []
-            ack_ids = []
+            # Giải mã cả batch một lượt (orjson + dựng cột theo dtype, hỗ trợ payload msgpack/Arrow)
+            batch_started = time.time()
+            df, ack_ids = decode_stream_batch(msgs)
 
-            for stream, entries in msgs:
-                for msg_id, fields in entries:
-                    data = fields.get("data")
-                    if data:
-                        records.append(json.loads(data))
-                        ack_ids.append((stream, msg_id))
+            if df.empty and ack_ids:
+                # Toàn message hỏng/rỗng: ACK để không bị redeliver mãi
+                ack_messages(ack_ids)
 
-            if records:
-                df = pd.DataFrame(records)
+            if not df.empty:
                 results = load_and_process_data(df, {})
 
-                # Save to DB
-                save_results_to_db(results)
+                # Save to DB (write-behind: ghi + ACK ở writer thread, batch sau chạy song song)
+                if write_sink is not None:
+                    write_sink.submit(results, ack_ids)
+                    saved = None
+                else:
+                    saved = save_results_to_db(results)
                        
                 try:
                     handle_email_alerts_async(results)    # Sending Alert (nếu có nội dung)
@@ -396,9 +412,18 @@ def start_engine():
                 except Exception as e:
                     logging.error(f"[Active Response Error] Error while executing Lock/Kill: {e}", exc_info=True)
                 
-                # ACK messages
-                for stream, msg_id in ack_ids:
-                    r.xack(stream, REDIS_GROUP_ENGINE, msg_id)
+                # ACK messages (chế độ đồng bộ: chỉ ACK khi đã ghi DB thành công)
+                if saved:
+                    ack_persisted(ack_ids)
+                elif saved is False:
+                    reclaimer.mark_persistence_failed(ack_ids)
+                    logging.warning(f"DB write failed, leaving {len(ack_ids)} messages un-ACKed for redelivery.")
+
+                if on_batch is not None:
+                    on_batch(len(df), time.time() - batch_started)
+
+                logging.debug(f"Redis pool stats: {redis_pool.get_pool_stats()} | "
+                              f"Stream stats: {redis_pool.get_stream_metrics()}")
 
         except KeyboardInterrupt:
             logging.info("Engine stopped by user")
@@ -410,9 +435,7 @@ def start_engine():
                 logging.warning(f"Consumer group missing: {e}")
                 logging.info("🔄 Recreating consumer groups...")
                 try:
-                    for stream in STREAMS.values():
-                        ensure_group(r, stream, REDIS_GROUP_ENGINE)
-                    ensure_group(r, "uba:logs:mysql", REDIS_GROUP_ENGINE)
+                    ensure_groups(r)
                     logging.info("✅ Consumer groups recreated")
                 except Exception as group_error:
                     logging.error(f"Failed to recreate groups: {group_error}")
@@ -427,15 +450,12 @@ def start_engine():
             logging.info("🔄 Attempting to reconnect to Redis...")
             time.sleep(3)
             try:
-                if r:
-                    r.close()  # Close the broken connection
+                redis_pool.reset_pool()  # Đóng các kết nối hỏng trong pool
                 r = connect_redis()
                 if r:
-                    logging.info("✅ Redis reconnection successful")
+                    logging.info(f"✅ Redis reconnection successful. Pool: {redis_pool.get_pool_stats()}")
                     # Re-ensure consumer groups after reconnection
-                    for stream in STREAMS.values():
-                        ensure_group(r, stream, REDIS_GROUP_ENGINE)
-                    ensure_group(r, "uba:logs:mysql", REDIS_GROUP_ENGINE)
+                    ensure_groups(r)
                 else:
                     logging.error("❌ Redis reconnection failed, will retry...")
             except Exception as reconnect_error:
@@ -446,5 +466,11 @@ def start_engine():
             logging.error(f"Unexpected engine error: {e}", exc_info=True)
             time.sleep(1)
 
+    # Flush phần kết quả còn lại trước khi thoát
+    reclaimer.stop()
+    if write_sink is not None:
+        write_sink.stop()
+    logging.info(f"Stream stats: {redis_pool.get_stream_metrics()}")
+
 if __name__ == "__main__":
     start_engine()
\ No newline at end of file
@@ -0,0 +1,400 @@
+# engine/redis_pool.py
+"""
+================================================================================
+REDIS CONNECTION POOL DÙNG CHUNG
+================================================================================
+Một connection pool (có health check) cho mỗi (REDIS_URL, decode_responses)
+trong mỗi tiến trình. Engine, data_processor và các publisher lấy client từ
+đây thay vì tự mở socket mới mỗi batch bằng Redis.from_url().
+
+- get_redis(): client dùng chung pool (rẻ, không mở kết nối mới).
+- connect_redis(): lấy client + PING, thử lại cho tới khi thành công (hoặc hết lượt).
+- reset_pool(): đóng toàn bộ socket của pool sau lỗi kết nối (được tính là reconnect).
+- pipeline(): context manager gửi lệnh theo lô, tự execute khi thoát.
+- ensure_consumer_group(): tạo consumer group cho stream (bỏ qua BUSYGROUP).
+- ack_messages(): XACK theo lô - một lệnh XACK cho mỗi stream, gửi trong một pipeline.
+- PendingReclaimer: thread nền dùng XPENDING/XCLAIM nhận lại message bị treo
+  (consumer chết / ghi DB lỗi) quá thời gian idle cho phép, trừ message tiến trình
+  còn giữ; message bị giao quá STREAM_MAX_DELIVERIES lần (không phải do lỗi ghi DB)
+  được chuyển sang "<stream>:dead" và ACK.
+- get_pool_stats() / get_stream_metrics(): số liệu pool và ACK / pending / reclaim.
+"""
+
+import os
+import time
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from redis import Redis, BlockingConnectionPool, ResponseError
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import REDIS_URL
+except ImportError:
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# --- Cấu hình pool ---
+REDIS_POOL_MAX_CONNECTIONS = int(os.getenv("REDIS_POOL_MAX_CONNECTIONS", "32"))
+# Thời gian chờ tối đa (giây) khi pool đã hết kết nối rảnh
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", "20"))
+# PING lại kết nối đã rảnh quá N giây trước khi dùng
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_SOCKET_CONNECT_TIMEOUT = int(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+
+# --- Cấu hình nhận lại message treo (pending entries) ---
+STREAM_RECLAIM_MIN_IDLE_MS = int(os.getenv("STREAM_RECLAIM_MIN_IDLE_MS", str(5 * 60 * 1000)))
+STREAM_RECLAIM_INTERVAL_SEC = float(os.getenv("STREAM_RECLAIM_INTERVAL_SEC", "30"))
+STREAM_RECLAIM_COUNT = int(os.getenv("STREAM_RECLAIM_COUNT", "1000"))
+# Message đã được giao quá N lần (luôn lỗi) -> chuyển sang stream "<stream>:dead" và ACK
+STREAM_MAX_DELIVERIES = int(os.getenv("STREAM_MAX_DELIVERIES", "5"))
+STREAM_DEAD_LETTER_SUFFIX = os.getenv("STREAM_DEAD_LETTER_SUFFIX", ":dead")
+STREAM_DEAD_LETTER_MAXLEN = int(os.getenv("STREAM_DEAD_LETTER_MAXLEN", "100000"))
+
+_pools: Dict[Tuple[str, bool], BlockingConnectionPool] = {}
+_configured: set = set()
+_lock = threading.Lock()
+_metrics = {
+    "pools_created": 0,
+    "clients_issued": 0,
+    "connect_attempts": 0,
+    "connect_failures": 0,
+    "reconnects": 0,
+}
+_stream_metrics = {
+    "acked": 0,
+    "ack_batches": 0,
+    "ack_latency_ms_last": 0.0,
+    "ack_latency_ms_total": 0.0,
+    "pending_depth": {},
+    "reclaimed": 0,
+    "reclaimed_deleted": 0,
+    "dead_lettered": 0,
+}
+
+
+def _get_pool(url: Optional[str] = None, decode_responses: bool = True) -> BlockingConnectionPool:
+    key = (url or REDIS_URL, decode_responses)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = BlockingConnectionPool.from_url(
+                key[0],
+                decode_responses=decode_responses,
+                max_connections=REDIS_POOL_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT,
+                health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                socket_keepalive=True,
+                socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+                retry_on_timeout=True,
+            )
+            _pools[key] = pool
+            _metrics["pools_created"] += 1
+        return pool
+
+
+def get_redis(url: Optional[str] = None, decode_responses: bool = True) -> Redis:
+    """Trả về client Redis dùng connection pool chung của tiến trình (không PING)."""
+    client = Redis(connection_pool=_get_pool(url, decode_responses))
+    with _lock:
+        _metrics["clients_issued"] += 1
+    return client
+
+
+def reset_pool(url: Optional[str] = None, decode_responses: bool = True):
+    """Đóng mọi kết nối của pool (sau lỗi mạng); lần dùng tiếp theo sẽ mở kết nối mới."""
+    key = (url or REDIS_URL, decode_responses)
+    with _lock:
+        pool = _pools.get(key)
+        _metrics["reconnects"] += 1
+    if pool is not None:
+        try:
+            pool.disconnect()
+        except Exception as e:
+            logger.debug(f"Redis pool disconnect error: {e}")
+
+
+def connect_redis(url: Optional[str] = None, decode_responses: bool = True,
+                  configure: bool = False, max_attempts: Optional[int] = None,
+                  retry_delay: float = 5.0,
+                  should_continue: Callable[[], bool] = lambda: True) -> Optional[Redis]:
+    """
+    Lấy client từ pool và kiểm tra bằng PING, thử lại mỗi `retry_delay` giây.
+    - configure: chạy configure_redis_for_reliability() một lần cho mỗi pool.
+    - max_attempts: None = thử lại vô hạn (tới khi should_continue() trả về False).
+    Trả về None nếu hết lượt thử hoặc tiến trình đang dừng.
+    """
+    attempt = 0
+    while should_continue():
+        attempt += 1
+        with _lock:
+            _metrics["connect_attempts"] += 1
+        try:
+            client = get_redis(url, decode_responses)
+            client.ping()
+            key = (url or REDIS_URL, decode_responses)
+            if configure and key not in _configured:
+                from engine.utils import configure_redis_for_reliability
+                configure_redis_for_reliability(client)
+                _configured.add(key)
+            logger.info("✅ Kết nối Redis thành công.")
+            return client
+        except Exception as e:
+            with _lock:
+                _metrics["connect_failures"] += 1
+            # Bỏ các socket hỏng để lần thử sau mở kết nối mới
+            reset_pool(url, decode_responses)
+            if max_attempts is not None and attempt >= max_attempts:
+                logger.error(f"❌ Lỗi kết nối Redis: {e}. Đã thử {attempt} lần.")
+                return None
+            logger.error(f"❌ Lỗi kết nối Redis: {e}. Thử lại sau {retry_delay:g}s...")
+            time.sleep(retry_delay)
+    return None
+
+
+@contextmanager
+def pipeline(client: Optional[Redis] = None, transaction: bool = False):
+    """
+    Pipeline tự execute khi thoát khối with (bỏ qua nếu có exception).
+        with pipeline() as pipe:
+            pipe.xadd(...)
+    """
+    client = client or get_redis()
+    pipe = client.pipeline(transaction=transaction)
+    try:
+        yield pipe
+        pipe.execute()
+    finally:
+        pipe.reset()
+
+
+def ensure_consumer_group(client: Redis, stream: str, group: str, start_id: str = "$"):
+    """Đảm bảo Consumer Group tồn tại (tạo stream nếu chưa có)."""
+    try:
+        client.xgroup_create(stream, group, id=start_id, mkstream=True)
+        logger.info(f"Created consumer group {group} on {stream}")
+    except ResponseError as e:
+        if "BUSYGROUP" in str(e):
+            logger.info(f"Consumer group {group} already exists on {stream}.")
+        else:
+            logger.error(f"❌ Lỗi tạo group {group} trên {stream}: {e}")
+            raise
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """Thống kê pool: kết nối đã tạo / đang dùng / rảnh và các bộ đếm kết nối."""
+    with _lock:
+        stats = dict(_metrics)
+        pools = list(_pools.values())
+    created = idle = 0
+    for pool in pools:
+        # BlockingConnectionPool: _connections = mọi kết nối đã mở, pool.queue = kết nối rảnh (None = slot trống)
+        created += len(getattr(pool, "_connections", ()))
+        idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    stats.update({
+        "pools": len(pools),
+        "connections_created": created,
+        "connections_in_use": max(created - idle, 0),
+        "connections_idle": idle,
+        "max_connections": REDIS_POOL_MAX_CONNECTIONS,
+    })
+    return stats
+
+
+def ack_messages(client: Redis, group: str, ack_ids: Iterable[Tuple[str, str]]) -> int:
+    """
+    ACK các message [(stream, msg_id), ...]: gộp theo stream, mỗi stream một lệnh XACK,
+    tất cả trong một pipeline (1 round trip). Trả về số message đã được ACK.
+    """
+    by_stream: Dict[str, List[str]] = {}
+    for stream, msg_id in ack_ids:
+        by_stream.setdefault(stream, []).append(msg_id)
+    if not by_stream:
+        return 0
+
+    start = time.perf_counter()
+    pipe = client.pipeline(transaction=False)
+    for stream, ids in by_stream.items():
+        pipe.xack(stream, group, *ids)
+    acked = sum(int(n or 0) for n in pipe.execute())
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    with _lock:
+        _stream_metrics["acked"] += acked
+        _stream_metrics["ack_batches"] += 1
+        _stream_metrics["ack_latency_ms_last"] = latency_ms
+        _stream_metrics["ack_latency_ms_total"] += latency_ms
+    return acked
+
+
+class PendingReclaimer:
+    """
+    Thread nền: định kỳ đo độ sâu PEL (XPENDING) và dùng XPENDING (lọc idle) + XCLAIM
+    để chuyển các message idle quá `min_idle_ms` về consumer hiện tại. Message nhận lại
+    được đưa vào hàng đợi nội bộ; vòng lặp engine lấy ra bằng drain() và xử lý như batch thường.
+
+    - Bỏ qua các message chính tiến trình này còn giữ (`in_flight()`, VD đang nằm trong
+      write-behind buffer / đang thử ghi lại / chờ submit): không nhận lại, không tăng
+      times_delivered.
+    - Bỏ qua cả lượt khi hàng đợi nội bộ còn message chưa được drain (vòng lặp engine đang
+      bận / bị chặn) để không đưa cùng một id vào hàng đợi nhiều lần.
+    - Message luôn lỗi (poison) sẽ bị nhận lại mãi và mỗi lần xử lý lại cập nhật lại state
+      (profile Redis, baseline, DB): khi times_delivered vượt `max_deliveries`, message được
+      XADD sang `<stream>:dead` (kèm id gốc + số lần giao) rồi XACK. Message chưa ACK chỉ vì
+      ghi DB lỗi (mark_persistence_failed) không bao giờ bị chuyển sang dead-letter.
+    """
+
+    def __init__(self, streams: List[str], group: str, consumer: str,
+                 min_idle_ms: int = STREAM_RECLAIM_MIN_IDLE_MS,
+                 interval_sec: float = STREAM_RECLAIM_INTERVAL_SEC,
+                 count: int = STREAM_RECLAIM_COUNT,
+                 max_deliveries: int = STREAM_MAX_DELIVERIES,
+                 in_flight: Optional[Callable[[], Iterable[Tuple[str, str]]]] = None):
+        self.streams = list(streams)
+        self.group = group
+        self.consumer = consumer
+        self.min_idle_ms = min_idle_ms
+        self.interval_sec = interval_sec
+        self.count = count
+        self.max_deliveries = max_deliveries
+        self.in_flight = in_flight
+        self._reclaimed: "queue.Queue[Tuple[str, list]]" = queue.Queue()
+        self._persist_failed: Set[Tuple[str, str]] = set()
+        self._persist_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="PendingReclaimer", daemon=True)
+            self._thread.start()
+            logger.info(f"Pending reclaimer started (min_idle={self.min_idle_ms}ms, every {self.interval_sec:g}s).")
+        return self
+
+    def stop(self, timeout: Optional[float] = 5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def mark_persistence_failed(self, ack_ids: Iterable[Tuple[str, str]]):
+        """Các message [(stream, id)] chưa ACK vì ghi DB lỗi: vẫn nhận lại nhưng không dead-letter."""
+        with self._persist_lock:
+            self._persist_failed.update(ack_ids)
+
+    def mark_persisted(self, ack_ids: Iterable[Tuple[str, str]]):
+        with self._persist_lock:
+            self._persist_failed.difference_update(ack_ids)
+
+    def drain(self, max_messages: int = 10000) -> List[Tuple[str, list]]:
+        """Lấy các message đã nhận lại, cùng định dạng với kết quả xreadgroup: [(stream, [(id, fields), ...])]."""
+        by_stream: Dict[str, list] = {}
+        taken = 0
+        while taken < max_messages:
+            try:
+                stream, entries = self._reclaimed.get_nowait()
+            except queue.Empty:
+                break
+            by_stream.setdefault(stream, []).extend(entries)
+            taken += len(entries)
+        return list(by_stream.items())
+
+    def reclaim_once(self, client: Optional[Redis] = None) -> int:
+        """Một lượt XPENDING + XCLAIM trên mọi stream. Trả về số message đã nhận lại."""
+        if not self._reclaimed.empty():
+            logger.debug("Reclaim skipped: previously reclaimed messages not drained yet.")
+            return 0
+        client = client or get_redis()
+        held = set(self.in_flight()) if self.in_flight is not None else set()
+        total = 0
+        for stream in self.streams:
+            try:
+                summary = client.xpending(stream, self.group)
+                depth = int(summary.get("pending", 0)) if isinstance(summary, dict) else 0
+                with _lock:
+                    _stream_metrics["pending_depth"][stream] = depth
+                if depth == 0:
+                    continue
+
+                start_id = "-"
+                while True:
+                    pending = client.xpending_range(stream, self.group, min=start_id, max="+",
+                                                    count=self.count, idle=self.min_idle_ms)
+                    if not pending:
+                        break
+                    deliveries = {p["message_id"]: int(p["times_delivered"]) for p in pending
+                                  if (stream, p["message_id"]) not in held}
+                    total += self._claim(client, stream, deliveries)
+                    if len(pending) < self.count:
+                        break
+                    start_id = f"({pending[-1]['message_id']}"
+            except ResponseError as e:
+                # Stream/group chưa tồn tại (NOGROUP) - bỏ qua, engine sẽ tạo lại
+                logger.debug(f"Reclaim skipped on {stream}: {e}")
+        if total:
+            logger.info(f"♻️ Reclaimed {total} idle pending messages.")
+        return total
+
+    def _claim(self, client: Redis, stream: str, deliveries: Dict[str, int]) -> int:
+        """XCLAIM các id (min_idle kiểm tra lại phía Redis), dead-letter phần giao quá nhiều lần."""
+        if not deliveries:
+            return 0
+        entries = client.xclaim(stream, self.group, self.consumer, self.min_idle_ms, list(deliveries))
+        # Entry đã bị xóa khỏi stream (hoặc vừa được consumer khác nhận) không được trả về / trả về không có fields
+        live = [(msg_id, fields) for msg_id, fields in entries if fields]
+        if live and self.max_deliveries > 0:
+            live = self._dead_letter(client, stream, live, deliveries)
+        if live:
+            self._reclaimed.put((stream, live))
+        with _lock:
+            _stream_metrics["reclaimed"] += len(live)
+            _stream_metrics["reclaimed_deleted"] += len(deliveries) - len(entries) + \
+                sum(1 for _, fields in entries if not fields)
+        return len(live)
+
+    def _dead_letter(self, client: Redis, stream: str, entries: list, deliveries: Dict[str, int]) -> list:
+        """
+        Chuyển message đã giao quá max_deliveries lần sang `<stream>:dead` + XACK; trả về phần còn lại.
+        `deliveries` là times_delivered trước lượt XCLAIM này (lượt này là lần giao thứ +1).
+        """
+        with self._persist_lock:
+            persist_failed = {msg_id for msg_id, _ in entries if (stream, msg_id) in self._persist_failed}
+        dead = [(msg_id, fields) for msg_id, fields in entries
+                if deliveries.get(msg_id, 0) + 1 > self.max_deliveries and msg_id not in persist_failed]
+        if not dead:
+            return entries
+
+        dead_stream = f"{stream}{STREAM_DEAD_LETTER_SUFFIX}"
+        pipe = client.pipeline(transaction=True)
+        for msg_id, fields in dead:
+            pipe.xadd(dead_stream, {**fields, "dead_source_id": msg_id,
+                                    "dead_times_delivered": deliveries[msg_id] + 1},
+                      maxlen=STREAM_DEAD_LETTER_MAXLEN, approximate=True)
+        pipe.xack(stream, self.group, *[msg_id for msg_id, _ in dead])
+        pipe.execute()
+        with _lock:
+            _stream_metrics["dead_lettered"] += len(dead)
+        logger.warning(f"☠️ Moved {len(dead)} messages delivered more than {self.max_deliveries} times "
+                       f"from {stream} to {dead_stream}.")
+        dead_ids = {msg_id for msg_id, _ in dead}
+        return [(msg_id, fields) for msg_id, fields in entries if msg_id not in dead_ids]
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            try:
+                self.reclaim_once()
+            except Exception as e:
+                logger.warning(f"Pending reclaimer error: {e}")
+
+
+def get_stream_metrics() -> Dict[str, object]:
+    """Số liệu ACK (độ trễ), độ sâu PEL theo stream và số message đã nhận lại."""
+    with _lock:
+        stats = dict(_stream_metrics)
+        stats["pending_depth"] = dict(_stream_metrics["pending_depth"])
+    batches = stats["ack_batches"]
+    stats["ack_latency_ms_avg"] = stats["ack_latency_ms_total"] / batches if batches else 0.0
+    return stats
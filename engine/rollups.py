@@ -0,0 +1,310 @@
+# engine/rollups.py
+"""
+================================================================================
+ROLLUP TABLES (DASHBOARD STATS)
+================================================================================
+Bảng tổng hợp theo bucket thời gian (minute / hour / day), được DB writer cập nhật
+tăng dần trong CÙNG transaction với lần ghi dữ liệu gốc:
+
+- anomaly_rollups: (bucket, source, anomaly_type, behavior_group, user, database, status)
+                   -> anomaly_count, score_sum
+- log_rollups:     (bucket) -> log_count, anomaly_count
+
+/api/anomalies/stats và /api/anomalies/kpis chỉ đọc các bảng này, nên độ trễ
+dashboard không tăng theo số anomaly / log được giữ lại.
+
+Bucket của aggregate anomaly lấy theo created_at (giống logic chart cũ).
+Rollup theo phút chỉ giữ ROLLUP_MINUTE_RETENTION_DAYS ngày (đủ cho chart 24h).
+
+Dựng lại từ bảng gốc (lần đầu nâng cấp, hoặc sau khi sửa dữ liệu tay):
+    python engine/rollups.py rebuild
+Benchmark trên PostgreSQL (sinh dữ liệu giả vào DATABASE_URL - chỉ dùng DB thử nghiệm):
+    python engine/rollups.py benchmark --rows 10000000
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from backend_api.models import AnomalyRollup, LogRollup  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Tên granularity -> tần suất pandas
+GRANULARITIES = {"minute": "min", "hour": "h", "day": "D"}
+ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "3"))
+# Chu kỳ dọn rollup theo phút (chạy trong writer, tối đa 1 lần / chu kỳ)
+ROLLUP_PRUNE_INTERVAL_SEC = int(os.getenv("ROLLUP_PRUNE_INTERVAL_SEC", "3600"))
+
+ANOMALY_DIMENSIONS = ["source", "anomaly_type", "behavior_group", "user", "database", "status"]
+
+_last_prune = 0.0
+
+
+# ==============================================================================
+# TÍNH DELTA TỪ BATCH
+# ==============================================================================
+
+def _dimension(frame: pd.DataFrame, col: str, default: str = "") -> pd.Series:
+    if col not in frame.columns:
+        return pd.Series(default, index=frame.index, dtype=object)
+    return frame[col].astype(object).where(frame[col].notna(), default).astype(str)
+
+
+def anomaly_rollup_rows(frame: pd.DataFrame, source: str, time_col: str,
+                        score_col: Optional[str] = None) -> List[Dict]:
+    """Delta anomaly_rollups (mọi granularity) cho một frame đã ghi vào anomalies / aggregate_anomalies."""
+    if frame is None or frame.empty:
+        return []
+    ts = pd.to_datetime(frame[time_col], errors="coerce")
+    base = pd.DataFrame({
+        "source": source,
+        "anomaly_type": _dimension(frame, "anomaly_type"),
+        "behavior_group": _dimension(frame, "behavior_group"),
+        "user": _dimension(frame, "user"),
+        "database": _dimension(frame, "database"),
+        "status": _dimension(frame, "status", "new"),
+        "score": pd.to_numeric(frame[score_col], errors="coerce").fillna(0.0) if score_col else 0.0,
+    }, index=frame.index)[ts.notna()]
+    ts = ts[ts.notna()]
+
+    rows = []
+    for granularity, freq in GRANULARITIES.items():
+        grouped = base.assign(bucket_start=ts.dt.floor(freq)).groupby(
+            ["bucket_start"] + ANOMALY_DIMENSIONS, sort=True
+        )["score"].agg(["size", "sum"]).reset_index()
+        grouped = grouped.rename(columns={"size": "anomaly_count", "sum": "score_sum"})
+        grouped["granularity"] = granularity
+        rows.extend(grouped.to_dict("records"))
+    return _plain(rows)
+
+
+def log_rollup_rows(frame: pd.DataFrame) -> List[Dict]:
+    """Delta log_rollups (mọi granularity) cho một frame đã ghi vào all_logs."""
+    if frame is None or frame.empty:
+        return []
+    ts = pd.to_datetime(frame["timestamp"], errors="coerce")
+    is_anomaly = frame["is_anomaly"].fillna(False).astype(bool) if "is_anomaly" in frame.columns \
+        else pd.Series(False, index=frame.index)
+    valid = ts.notna()
+    rows = []
+    for granularity, freq in GRANULARITIES.items():
+        grouped = is_anomaly[valid].groupby(ts[valid].dt.floor(freq), sort=True).agg(["size", "sum"])
+        for bucket, (n, n_anomaly) in zip(grouped.index, grouped.to_numpy()):
+            rows.append({"granularity": granularity, "bucket_start": bucket,
+                         "log_count": n, "anomaly_count": n_anomaly})
+    return _plain(rows)
+
+
+def _plain(rows: List[Dict]) -> List[Dict]:
+    """numpy/pandas scalar -> kiểu Python (driver DB không nhận np.int64 / Timestamp)."""
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, pd.Timestamp):
+                row[key] = value.to_pydatetime()
+            elif isinstance(value, np.generic):
+                row[key] = value.item()
+    return rows
+
+
+# ==============================================================================
+# UPSERT (CÙNG TRANSACTION VỚI LẦN GHI DỮ LIỆU GỐC)
+# ==============================================================================
+
+def _upsert(conn, table, rows: List[Dict], sum_cols: List[str]):
+    if not rows:
+        return
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Rollup upsert is not supported on '{dialect}'")
+
+    keys = [c.name for c in table.primary_key.columns]
+    # Thứ tự khóa cố định -> các writer song song khóa dòng theo cùng thứ tự (tránh deadlock)
+    rows = sorted(rows, key=lambda r: tuple(str(r[k]) for k in keys))
+    stmt = insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c: table.c[c] + stmt.excluded[c] for c in sum_cols},
+    )
+    conn.execute(stmt)
+
+
+def apply_rollups(conn, anomaly_rows: Optional[List[Dict]] = None, log_rows: Optional[List[Dict]] = None):
+    """Cộng delta vào các bảng rollup trên kết nối / transaction đang mở."""
+    _upsert(conn, AnomalyRollup.__table__, anomaly_rows or [], ["anomaly_count", "score_sum"])
+    _upsert(conn, LogRollup.__table__, log_rows or [], ["log_count", "anomaly_count"])
+    maybe_prune(conn)
+
+
+def maybe_prune(conn, force: bool = False):
+    """Xóa rollup theo phút cũ hơn ROLLUP_MINUTE_RETENTION_DAYS (tối đa 1 lần / ROLLUP_PRUNE_INTERVAL_SEC)."""
+    global _last_prune
+    now = time.time()
+    if not force and now - _last_prune < ROLLUP_PRUNE_INTERVAL_SEC:
+        return
+    _last_prune = now
+    cutoff = datetime.now() - timedelta(days=ROLLUP_MINUTE_RETENTION_DAYS)
+    for table in (AnomalyRollup.__table__, LogRollup.__table__):
+        conn.execute(table.delete().where(table.c.granularity == "minute").where(table.c.bucket_start < cutoff))
+
+
+# ==============================================================================
+# DỰNG LẠI TỪ BẢNG GỐC (POSTGRESQL)
+# ==============================================================================
+
+_REBUILD_SQL = [
+    "DELETE FROM anomaly_rollups",
+    "DELETE FROM log_rollups",
+    """
+    INSERT INTO anomaly_rollups (granularity, bucket_start, source, anomaly_type, behavior_group,
+                                 "user", database, status, anomaly_count, score_sum)
+    SELECT g.name, date_trunc(g.name, a.timestamp), 'event', COALESCE(a.anomaly_type, ''),
+           COALESCE(a.behavior_group, ''), COALESCE(a."user", ''), COALESCE(a.database, ''),
+           COALESCE(a.status, 'new'), COUNT(*), COALESCE(SUM(a.score), 0)
+    FROM anomalies a
+    CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS g(name)
+    WHERE a.timestamp IS NOT NULL
+      AND (g.name <> 'minute' OR a.timestamp >= :minute_cutoff)
+    GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+    """,
+    """
+    INSERT INTO anomaly_rollups (granularity, bucket_start, source, anomaly_type, behavior_group,
+                                 "user", database, status, anomaly_count, score_sum)
+    SELECT g.name, date_trunc(g.name, a.created_at), 'aggregate', COALESCE(a.anomaly_type, ''), '',
+           COALESCE(a."user", ''), COALESCE(a.database, ''), 'new', COUNT(*), COALESCE(SUM(a.severity), 0)
+    FROM aggregate_anomalies a
+    CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS g(name)
+    WHERE a.created_at IS NOT NULL
+      AND (g.name <> 'minute' OR a.created_at >= :minute_cutoff)
+    GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+    """,
+    """
+    INSERT INTO log_rollups (granularity, bucket_start, log_count, anomaly_count)
+    SELECT g.name, date_trunc(g.name, l.timestamp), COUNT(*), COUNT(*) FILTER (WHERE l.is_anomaly)
+    FROM all_logs l
+    CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS g(name)
+    WHERE l.timestamp IS NOT NULL
+      AND (g.name <> 'minute' OR l.timestamp >= :minute_cutoff)
+    GROUP BY 1, 2
+    """,
+]
+
+
+def rebuild_rollups(engine):
+    """Tính lại toàn bộ rollup từ anomalies / aggregate_anomalies / all_logs trong một transaction."""
+    if engine.dialect.name != "postgresql":
+        raise NotImplementedError("rebuild_rollups requires PostgreSQL (date_trunc)")
+    cutoff = datetime.now() - timedelta(days=ROLLUP_MINUTE_RETENTION_DAYS)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        # Chặn writer cộng delta trong lúc dựng lại (tránh đếm trùng)
+        conn.execute(text("LOCK TABLE anomaly_rollups, log_rollups IN EXCLUSIVE MODE"))
+        for sql in _REBUILD_SQL:
+            conn.execute(text(sql), {"minute_cutoff": cutoff})
+    logger.info(f"Rollups rebuilt in {time.perf_counter() - started:.1f}s")
+
+
+# ==============================================================================
+# BENCHMARK (POSTGRESQL)
+# ==============================================================================
+
+def _seed(engine, rows: int, anomaly_ratio: float = 0.01):
+    """Sinh `rows` dòng all_logs (+ anomalies tương ứng) trải đều 365 ngày bằng generate_series."""
+    n_anomalies = max(1, int(rows * anomaly_ratio))
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO all_logs (timestamp, "user", client_ip, query, is_anomaly)
+            SELECT now() - (random() * interval '365 days'), 'user' || (i % 500), '10.0.0.' || (i % 250),
+                   'SELECT * FROM t' || (i % 100) || ' WHERE id = ' || i, (i % 100) = 0
+            FROM generate_series(1, :n) AS s(i)
+        """), {"n": rows})
+        conn.execute(text("""
+            INSERT INTO anomalies (timestamp, "user", client_ip, database, query, anomaly_type,
+                                   behavior_group, score, reason, status)
+            SELECT now() - (random() * interval '365 days'), 'user' || (i % 500), '10.0.0.' || (i % 250),
+                   'db' || (i % 20), 'SELECT 1', 'Rule ' || (i % 30),
+                   (ARRAY['TECHNICAL_ATTACK','INSIDER_THREAT','ACCESS_ANOMALY','ML_DETECTED'])[1 + i % 4],
+                   random(), 'bench', 'new'
+            FROM generate_series(1, :n) AS s(i)
+        """), {"n": n_anomalies})
+        conn.execute(text("ANALYZE all_logs; ANALYZE anomalies;"))
+
+
+def _legacy_stats_queries(conn, start: datetime):
+    """Phần tốn kém của /api/anomalies/stats trước khi có rollup."""
+    conn.execute(text("SELECT COUNT(id) FROM all_logs")).scalar()
+    conn.execute(text("SELECT COUNT(id) FROM anomalies")).scalar()
+    conn.execute(text("SELECT COUNT(id) FROM aggregate_anomalies")).scalar()
+    conn.execute(text("SELECT * FROM anomalies WHERE timestamp >= :s"), {"s": start}).fetchall()
+    conn.execute(text("SELECT * FROM aggregate_anomalies WHERE created_at >= :s"), {"s": start}).fetchall()
+    conn.execute(text('SELECT "user", SUM(score), COUNT(id) FROM anomalies WHERE "user" IS NOT NULL '
+                      'GROUP BY "user" ORDER BY 2 DESC LIMIT 10')).fetchall()
+    conn.execute(text("SELECT behavior_group, COUNT(id) FROM anomalies GROUP BY behavior_group")).fetchall()
+
+
+def benchmark(rows: int = 10_000_000, repeat: int = 20, seed: bool = True) -> Dict[str, float]:
+    """p50/p95 (ms) của /api/anomalies/stats: đường cũ (quét bảng gốc) và đường rollup."""
+    from backend_api.models import engine, SessionLocal  # type: ignore
+    from backend_api import main_api  # type: ignore
+
+    if engine.dialect.name != "postgresql":
+        raise NotImplementedError("benchmark requires PostgreSQL")
+    if seed:
+        logger.info(f"Seeding {rows} all_logs rows ...")
+        _seed(engine, rows)
+        rebuild_rollups(engine)
+
+    def percentiles(fn) -> Tuple[float, float]:
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - started) * 1000)
+        return float(np.percentile(samples, 50)), float(np.percentile(samples, 95))
+
+    results: Dict[str, float] = {"all_logs_rows": rows}
+    for time_range, days in (("D", 1), ("M", 30), ("Y", 365)):
+        start = datetime.now() - timedelta(days=days)
+        with engine.connect() as conn:
+            p50, p95 = percentiles(lambda: _legacy_stats_queries(conn, start))
+        results[f"legacy_{time_range}_p50_ms"], results[f"legacy_{time_range}_p95_ms"] = round(p50, 1), round(p95, 1)
+        with SessionLocal() as db:
+            p50, p95 = percentiles(lambda: main_api._anomaly_stats(db, time_range))
+        results[f"rollup_{time_range}_p50_ms"], results[f"rollup_{time_range}_p95_ms"] = round(p50, 1), round(p95, 1)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [Rollups] - %(message)s")
+    parser = argparse.ArgumentParser(description="Dashboard rollup maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="Recompute all rollups from the base tables")
+    bench = sub.add_parser("benchmark", help="Seed a test database and compare stats latency")
+    bench.add_argument("--rows", type=int, default=10_000_000)
+    bench.add_argument("--repeat", type=int, default=20)
+    bench.add_argument("--no-seed", action="store_true")
+    args = parser.parse_args()
+
+    from backend_api.models import Base, engine as db_engine  # type: ignore
+    Base.metadata.create_all(bind=db_engine, tables=[AnomalyRollup.__table__, LogRollup.__table__])
+    if args.command == "rebuild":
+        rebuild_rollups(db_engine)
+    else:
+        for key, value in benchmark(args.rows, args.repeat, seed=not args.no_seed).items():
+            logger.info(f"{key}: {value}")
@@ -0,0 +1,224 @@
+# engine/sql_analysis.py
+"""
+================================================================================
+LỚP PHÂN TÍCH SQL DÙNG CHUNG (PARSE-ONCE)
+================================================================================
+Mỗi câu query chỉ được sqlglot parse MỘT lần, kết quả (loại lệnh, bảng, join,
+độ sâu subquery, các cờ cấu trúc) được cache trong một LRU có giới hạn.
+Features, Rules và các Publisher (extract_db_from_sql) đều đọc từ cache này.
+
+Khóa cache là dạng chuẩn hóa của query (bỏ literal chuỗi/số), nên các query
+chỉ khác nhau về giá trị tham số sẽ dùng chung một kết quả phân tích.
+Lưu ý: không dùng trực tiếp get_normalized_query() làm khóa vì hàm đó thay cả
+chữ số nằm trong tên bảng (orders_2020 -> orders_?), làm trộn lẫn các bảng khác nhau.
+"""
+
+import os
+import re
+import threading
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+try:
+    import sqlglot
+    import sqlglot.expressions as exp
+    SQLGLOT_AVAILABLE = True
+except ImportError:
+    SQLGLOT_AVAILABLE = False
+
+# Kích thước tối đa của cache (số digest khác nhau)
+SQL_ANALYSIS_CACHE_SIZE = int(os.getenv("SQL_ANALYSIS_CACHE_SIZE", "20000"))
+
+# Giới hạn độ dài query đưa vào parser để tránh treo
+MAX_PARSE_LENGTH = 10000
+
+# --- Regex chuẩn hóa literal (chỉ literal, KHÔNG đụng vào identifier) ---
+_RE_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_RE_HEX_LITERAL = re.compile(r"\b0[xX][0-9a-fA-F]+\b")
+_RE_NUMBER_LITERAL = re.compile(r"(?<![\w.`])[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w`])")
+_RE_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_RE_WHITESPACE = re.compile(r"\s+")
+
+
+@dataclass(frozen=True)
+class QueryAnalysis:
+    """Kết quả phân tích cấu trúc của một query (bất biến, dùng chung giữa các luồng)"""
+    parsed: bool = False
+    command_type: Optional[str] = None
+    # Tên bảng đầy đủ "db.table" (chữ thường) - dùng cho Features
+    tables: Tuple[str, ...] = ()
+    # Tên bảng trần "table" (chữ thường) - dùng cho Rule Multi-table
+    table_names: Tuple[str, ...] = ()
+    # Tên database theo thứ tự xuất hiện - dùng cho extract_db_from_sql
+    databases: Tuple[str, ...] = ()
+    num_tables: int = 0
+    num_joins: int = 0
+    num_where_conditions: int = 0
+    subquery_depth: int = 0
+    num_subqueries: int = 0
+    has_limit: int = 0
+    has_order_by: int = 0
+    has_group_by: int = 0
+    has_union: int = 0
+
+
+EMPTY_ANALYSIS = QueryAnalysis()
+
+
+def analysis_key(query: str) -> str:
+    """Tạo khóa cache: thay literal chuỗi/hex/số bằng '?' và gộp khoảng trắng."""
+    if not query or not isinstance(query, str):
+        return ""
+    key = _RE_STRING_LITERAL.sub("?", query.strip())
+    key = _RE_HEX_LITERAL.sub("?", key)
+    key = _RE_NUMBER_LITERAL.sub("?", key)
+    key = _RE_PLACEHOLDER_LIST.sub("?", key)
+    return _RE_WHITESPACE.sub(" ", key)
+
+
+def _subquery_depth(parsed) -> int:
+    # Giữ nguyên cách đo cũ của features.py (đi theo nhánh con đầu tiên)
+    depth = 0
+    node = parsed
+    while node:
+        if isinstance(node, exp.Subquery): depth += 1
+        try: node = list(node.children.values())[0][0]
+        except: break
+    return min(depth, 10)
+
+
+def _analyze_uncached(query: str) -> QueryAnalysis:
+    """Parse query bằng sqlglot và trích xuất toàn bộ thông tin cấu trúc."""
+    if not SQLGLOT_AVAILABLE or not query or not isinstance(query, str):
+        return EMPTY_ANALYSIS
+    query = query.strip()
+    if not query:
+        return EMPTY_ANALYSIS
+    try:
+        parsed = sqlglot.parse_one(query[:MAX_PARSE_LENGTH], read="mysql")
+    except Exception:
+        return EMPTY_ANALYSIS
+    if parsed is None:
+        return EMPTY_ANALYSIS
+
+    try:
+        table_nodes = list(parsed.find_all(exp.Table))
+        tables, table_names, databases = [], [], []
+        for table in table_nodes:
+            db = table.db or ""
+            name = table.name or table.this if hasattr(table, "this") else ""
+            full_name = f"{db}.{name}".lower() if db else str(name).lower()
+            if full_name and full_name not in tables:
+                tables.append(full_name)
+
+            bare_name = table.name
+            if hasattr(table, 'this') and table.this and isinstance(table.this, exp.Identifier):
+                bare_name = table.this.name
+            if bare_name and bare_name.lower() not in table_names:
+                table_names.append(bare_name.lower())
+
+            if db:
+                databases.append(db.lower())
+
+        return QueryAnalysis(
+            parsed=True,
+            command_type=parsed.key.upper() if hasattr(parsed, "key") else "UNKNOWN",
+            tables=tuple(tables),
+            table_names=tuple(table_names),
+            databases=tuple(databases),
+            num_tables=len(table_nodes),
+            num_joins=sum(1 for _ in parsed.find_all(exp.Join)),
+            num_where_conditions=sum(1 for _ in parsed.find_all(exp.Where)),
+            subquery_depth=_subquery_depth(parsed),
+            num_subqueries=sum(1 for _ in parsed.find_all(exp.Subquery)),
+            has_limit=1 if parsed.find(exp.Limit) else 0,
+            has_order_by=1 if parsed.find(exp.Order) else 0,
+            has_group_by=1 if parsed.find(exp.Group) else 0,
+            has_union=1 if parsed.find(exp.Union) else 0,
+        )
+    except Exception as e:
+        logging.debug(f"SQL analysis failed: {e}")
+        return EMPTY_ANALYSIS
+
+
+class QueryAnalysisCache:
+    """LRU cache (thread-safe) cho kết quả phân tích SQL, có bộ đếm hit/miss."""
+
+    def __init__(self, max_size: int = SQL_ANALYSIS_CACHE_SIZE):
+        self.max_size = max(1, int(max_size))
+        self._data: "OrderedDict[str, QueryAnalysis]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, query: str, key: Optional[str] = None) -> QueryAnalysis:
+        """Lấy kết quả phân tích, parse nếu chưa có trong cache."""
+        if not query or not isinstance(query, str):
+            return EMPTY_ANALYSIS
+        if key is None:
+            key = analysis_key(query)
+
+        with self._lock:
+            result = self._data.get(key)
+            if result is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        # Parse ngoài lock để không chặn các luồng khác
+        result = _analyze_uncached(query)
+
+        with self._lock:
+            self._data[key] = result
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+# Global instance (dùng chung cho toàn engine)
+_analysis_cache = QueryAnalysisCache()
+
+
+def analyze_query(query: str) -> QueryAnalysis:
+    """Phân tích một query (có cache)."""
+    return _analysis_cache.get(query)
+
+
+def analyze_queries(queries: Iterable) -> Dict[str, QueryAnalysis]:
+    """Phân tích một loạt query, mỗi query khác nhau chỉ tra cache một lần."""
+    results = {}
+    for q in queries:
+        if isinstance(q, str) and q not in results:
+            results[q] = _analysis_cache.get(q)
+    return results
+
+
+def get_analysis_cache_stats() -> Dict[str, float]:
+    return _analysis_cache.stats()
+
+
+def clear_analysis_cache():
+    _analysis_cache.clear()
@@ -0,0 +1,354 @@
+# engine/stream_decoder.py
+"""
+================================================================================
+STREAM DECODER (REDIS STREAM PAYLOADS -> DATAFRAME)
+================================================================================
+Giải mã cả batch message của Redis Stream trong một lượt:
+- JSON (mặc định, field "data"): orjson (fallback json) -> dựng từng cột trực tiếp
+  với dtype khai báo trong RECORD_SCHEMA, không qua pd.DataFrame(list_of_dicts).
+- msgpack (field "format" = "msgpack"): một record / message, base64.
+- Arrow IPC (field "format" = "arrow"): nhiều record / message, base64.
+
+Payload nhị phân được base64 vì client Redis của engine dùng decode_responses=True.
+Publisher có thể dùng encode_records() để tạo message ở các định dạng này
+(message Arrow được gom theo user để giữ partition affinity của engine_supervisor).
+
+Benchmark: python engine/stream_decoder.py [số_record]
+"""
+
+import sys
+import json
+import time
+import base64
+import logging
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+
+# Schema của record do các publisher (perf/hybrid/disk/table) gửi lên.
+# Cột không có trong schema được suy kiểu như pd.DataFrame cũ.
+_INT_FIELDS = [
+    'event_id', 'query_length', 'is_system_table', 'is_admin_command', 'is_risky_command', 'has_comment',
+    'rows_returned', 'rows_examined', 'rows_affected', 'error_code', 'error_count', 'has_error',
+    'warning_count', 'created_tmp_disk_tables', 'created_tmp_tables', 'select_full_join', 'select_scan',
+    'sort_merge_passes', 'no_index_used', 'no_good_index_used',
+]
+_FLOAT_FIELDS = ['query_entropy', 'scan_efficiency', 'execution_time_ms', 'lock_time_ms', 'cpu_time_ms']
+_STR_FIELDS = [
+    'event_name', 'user', 'client_ip', 'database', 'query', 'normalized_query', 'program_name',
+    'connector_name', 'client_os', 'source_host', 'error_message', 'connection_type',
+]
+RECORD_SCHEMA: Dict[str, str] = {
+    'timestamp': 'datetime',
+    **{c: 'int64' for c in _INT_FIELDS},
+    **{c: 'float64' for c in _FLOAT_FIELDS},
+    **{c: 'str' for c in _STR_FIELDS},
+}
+
+PAYLOAD_FORMATS = ("json", "msgpack", "arrow")
+
+
+# ==============================================================================
+# DỰNG CỘT THEO DTYPE
+# ==============================================================================
+
+def _infer_column(values) -> pd.Series:
+    return pd.Series(list(values))
+
+
+_NUMBER_TYPES = (int, float, np.integer, np.floating)
+
+
+def _numeric_array(values) -> Optional[np.ndarray]:
+    """
+    Mảng số (int64 / float64, None -> NaN) nếu mọi giá trị là số, ngược lại None.
+    Không ép chuỗi số ("12") hay bool: các cột đó giữ kiểu object như pandas.
+    """
+    arr = np.array(values)
+    if arr.ndim != 1:
+        return None
+    if arr.dtype.kind in "iuf":
+        return arr
+    if arr.dtype == object and all(v is None or (isinstance(v, _NUMBER_TYPES) and not isinstance(v, bool))
+                                   for v in arr):
+        return arr.astype(np.float64)
+    return None
+
+
+def _float_column(values) -> pd.Series:
+    arr = _numeric_array(values)
+    if arr is None:
+        return _infer_column(values)
+    return pd.Series(arr.astype(np.float64, copy=False))
+
+
+def _int_column(values) -> pd.Series:
+    arr = _numeric_array(values)
+    if arr is None:
+        return _infer_column(values)
+    if arr.dtype.kind in "iu":
+        return pd.Series(arr.astype(np.int64, copy=False))
+    # float64: chỉ ép int64 khi mọi giá trị là số nguyên (không NaN, VD 1.7 hay error_code=None giữ float64)
+    if np.isfinite(arr).all() and (np.abs(arr) < 2 ** 63).all() and (arr == np.trunc(arr)).all():
+        return pd.Series(arr.astype(np.int64))
+    return pd.Series(arr)
+
+
+def _str_column(values) -> pd.Series:
+    arr = np.array(values, dtype=object)
+    if arr.ndim != 1:
+        # Giá trị dạng list/tuple bị numpy trải thành mảng 2 chiều
+        return pd.Series(list(values), dtype=object)
+    return pd.Series(arr, dtype=object, copy=False)
+
+
+def _datetime_column(values) -> pd.Series:
+    raw = pd.Series(list(values), dtype=object)
+    parsed = pd.to_datetime(raw, utc=True, errors='coerce', format='ISO8601')
+    bad = parsed.isna() & raw.notna()
+    if bad.any():
+        parsed[bad] = pd.to_datetime(raw[bad], utc=True, errors='coerce', format='mixed')
+    return parsed
+
+
+_BUILDERS = {'int64': _int_column, 'float64': _float_column, 'str': _str_column, 'datetime': _datetime_column}
+
+
+def records_to_frame(records: List[Dict[str, Any]], schema: Dict[str, str] = RECORD_SCHEMA) -> pd.DataFrame:
+    """List dict -> DataFrame, dựng từng cột với dtype theo schema."""
+    if not records:
+        return pd.DataFrame()
+
+    columns = list(records[0])
+    n_cols = len(columns)
+    try:
+        # Fast path: mọi record cùng tập khóa -> tách cột bằng itemgetter + zip (C-level)
+        if any(len(r) != n_cols for r in records):
+            raise KeyError
+        getter = itemgetter(*columns)
+        col_values = list(zip(*map(getter, records))) if n_cols > 1 else [tuple(map(getter, records))]
+    except KeyError:
+        # Record không đồng nhất: hợp các khóa theo thứ tự xuất hiện, khóa thiếu = NaN (như pandas)
+        keys = {}
+        for r in records:
+            keys.update(dict.fromkeys(r))
+        columns = list(keys)
+        col_values = [[r.get(c, np.nan) for r in records] for c in columns]
+
+    data = {}
+    for col, values in zip(columns, col_values):
+        builder = _BUILDERS.get(schema.get(col))
+        data[col] = builder(values) if builder else _infer_column(values)
+    return pd.DataFrame(data, copy=False)
+
+
+# ==============================================================================
+# GIẢI MÃ PAYLOAD
+# ==============================================================================
+
+def decode_json_payloads(payloads: List[str]) -> Tuple[List[Dict[str, Any]], int]:
+    """Parse cả batch JSON; nếu có payload hỏng thì parse lại từng cái và bỏ qua cái hỏng."""
+    try:
+        return [_loads(p) for p in payloads], 0
+    except ValueError:
+        records, bad = [], 0
+        for p in payloads:
+            try:
+                records.append(_loads(p))
+            except ValueError:
+                bad += 1
+        return records, bad
+
+
+def _decode_msgpack(payload: str) -> Dict[str, Any]:
+    if not MSGPACK_AVAILABLE:
+        raise ValueError("msgpack payload received but 'msgpack' is not installed")
+    return msgpack.unpackb(base64.b64decode(payload), raw=False)
+
+
+def _decode_arrow(payload: str):
+    if not PYARROW_AVAILABLE:
+        raise ValueError("arrow payload received but 'pyarrow' is not installed")
+    with pa.ipc.open_stream(base64.b64decode(payload)) as reader:
+        return reader.read_all()
+
+
+def _arrow_tables_to_frame(tables) -> pd.DataFrame:
+    """Gộp các bảng Arrow rồi chuyển sang pandas một lần (cột do Arrow định kiểu sẵn)."""
+    table = tables[0] if len(tables) == 1 else pa.concat_tables(tables, promote_options="permissive")
+    df = table.to_pandas()
+    if 'timestamp' in df.columns and not isinstance(df['timestamp'].dtype, pd.DatetimeTZDtype):
+        df['timestamp'] = _datetime_column(df['timestamp'])
+    return df
+
+
+def decode_stream_batch(msgs) -> Tuple[pd.DataFrame, List[Tuple[str, str]]]:
+    """
+    msgs: kết quả xreadgroup [(stream, [(msg_id, fields), ...]), ...].
+    Trả về (DataFrame, ack_ids). ack_ids gồm cả message hỏng/không có dữ liệu
+    (không thể xử lý lại) để chúng không bị redeliver mãi.
+    """
+    json_payloads: List[str] = []
+    other_records: List[Dict[str, Any]] = []
+    arrow_tables = []
+    ack_ids: List[Tuple[str, str]] = []
+    bad = 0
+
+    for stream, entries in msgs:
+        for msg_id, fields in entries:
+            ack_ids.append((stream, msg_id))
+            data = fields.get("data") if fields else None
+            if not data:
+                bad += 1
+                continue
+            fmt = fields.get("format", "json")
+            if fmt == "json":
+                json_payloads.append(data)
+                continue
+            try:
+                if fmt == "msgpack":
+                    other_records.append(_decode_msgpack(data))
+                elif fmt == "arrow":
+                    arrow_tables.append(_decode_arrow(data))
+                else:
+                    raise ValueError(f"unknown payload format '{fmt}'")
+            except Exception as e:
+                bad += 1
+                logger.warning(f"Cannot decode message {msg_id} ({fmt}): {e}")
+
+    records, bad_json = decode_json_payloads(json_payloads)
+    records.extend(other_records)
+    bad += bad_json
+    if bad:
+        logger.warning(f"Skipped {bad} undecodable/empty stream messages.")
+
+    frames = [records_to_frame(records)] if records else []
+    if arrow_tables:
+        frames.append(_arrow_tables_to_frame(arrow_tables))
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(), ack_ids
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    return df, ack_ids
+
+
+# ==============================================================================
+# MÃ HÓA (PHÍA PUBLISHER)
+# ==============================================================================
+
+def _dumps(record: Dict[str, Any]) -> str:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(record, default=str).decode("utf-8")
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def encode_records(records: List[Dict[str, Any]], fmt: str = "json") -> List[Dict[str, str]]:
+    """Tạo danh sách fields cho XADD. Message msgpack/arrow mang thêm field "user" cho router."""
+    if fmt == "json":
+        return [{"data": _dumps(r)} for r in records]
+    if fmt == "msgpack":
+        if not MSGPACK_AVAILABLE:
+            raise ValueError("'msgpack' is not installed")
+        return [{"format": "msgpack", "user": str(r.get("user")),
+                 "data": base64.b64encode(msgpack.packb(r, default=str)).decode("ascii")} for r in records]
+    if fmt == "arrow":
+        if not PYARROW_AVAILABLE:
+            raise ValueError("'pyarrow' is not installed")
+        by_user: Dict[str, List[Dict[str, Any]]] = {}
+        for r in records:
+            by_user.setdefault(str(r.get("user")), []).append(r)
+        messages = []
+        for user, rows in by_user.items():
+            table = pa.Table.from_pylist(rows)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            messages.append({"format": "arrow", "user": user,
+                             "data": base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")})
+        return messages
+    raise ValueError(f"unknown payload format '{fmt}'")
+
+
+# ==============================================================================
+# BENCHMARK
+# ==============================================================================
+
+def _sample_record(i: int) -> Dict[str, Any]:
+    return {
+        "timestamp": f"2025-01-01T10:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000000:06d}+00:00",
+        "event_id": i, "event_name": "statement/sql/select", "user": f"user{i % 50}",
+        "client_ip": f"10.0.0.{i % 200}", "database": "sales_db",
+        "query": f"SELECT * FROM orders WHERE id = {i}", "normalized_query": "SELECT * FROM orders WHERE id = ?",
+        "query_length": 32, "query_entropy": 3.1234, "is_system_table": 0, "scan_efficiency": 0.5,
+        "is_admin_command": 0, "is_risky_command": 0, "has_comment": 0, "execution_time_ms": 0.001 * i,
+        "lock_time_ms": 0.0, "cpu_time_ms": 0.0, "program_name": "mysql", "connector_name": "libmysql",
+        "client_os": "Linux", "source_host": "app01", "rows_returned": i % 10, "rows_examined": i % 100,
+        "rows_affected": 0, "error_code": None if i % 7 else 1064, "error_message": None if i % 7 else "syntax error",
+        "error_count": 0, "has_error": 0, "warning_count": 0, "created_tmp_disk_tables": 0, "created_tmp_tables": 0,
+        "select_full_join": 0, "select_scan": 1, "sort_merge_passes": 0, "no_index_used": 0,
+        "no_good_index_used": 0, "connection_type": "TCP/IP",
+    }
+
+
+def benchmark(n: int = 10000, repeat: int = 5) -> Dict[str, float]:
+    """So sánh thời gian giải mã n record: đường cũ (json.loads + pd.DataFrame + to_datetime) và decoder mới (ms)."""
+    records = [_sample_record(i) for i in range(n)]
+    stream = "uba:logs:mysql"
+
+    def best_of(fn):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - started)
+        return round(best * 1000, 2)
+
+    def legacy(msgs):
+        rows = [json.loads(fields["data"]) for _, entries in msgs for _, fields in entries]
+        df = pd.DataFrame(rows)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce', utc=True)
+        return df
+
+    results = {"records": n}
+    json_msgs = [(stream, [(f"{i}-0", f) for i, f in enumerate(encode_records(records, "json"))])]
+    results["legacy_json_ms"] = best_of(lambda: legacy(json_msgs))
+    results["decoder_json_ms"] = best_of(lambda: decode_stream_batch(json_msgs))
+    if PYARROW_AVAILABLE:
+        arrow_msgs = [(stream, [(f"{i}-0", f) for i, f in enumerate(encode_records(records, "arrow"))])]
+        results["decoder_arrow_ms"] = best_of(lambda: decode_stream_batch(arrow_msgs))
+    if MSGPACK_AVAILABLE:
+        mp_msgs = [(stream, [(f"{i}-0", f) for i, f in enumerate(encode_records(records, "msgpack"))])]
+        results["decoder_msgpack_ms"] = best_of(lambda: decode_stream_batch(mp_msgs))
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [StreamDecoder] - %(message)s")
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    logger.info(f"orjson={ORJSON_AVAILABLE} msgpack={MSGPACK_AVAILABLE} pyarrow={PYARROW_AVAILABLE}")
+    for key, value in benchmark(n_records).items():
+        logger.info(f"{key}: {value}")
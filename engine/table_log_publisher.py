@@ -14,6 +14,7 @@ from typing import Optional
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     from config import *
+    from engine import redis_pool
 except ImportError:
     print("Lỗi: Không thể import 'config'.")
     sys.exit(1)
@@ -72,16 +73,8 @@ def connect_db():
         return None
 
 def connect_redis():
-    """Kết nối đến Redis với cơ chế thử lại."""
-    while True:
-        try:
-            r = Redis.from_url(REDIS_URL, decode_responses=True)
-            r.ping()
-            logging.info("Kết nối Redis (Publisher) thành công.")
-            return r
-        except RedisConnectionError as e:
-            logging.error(f"Kết nối Redis (Publisher) thất bại: {e}. Thử lại sau 5 giây...")
-            time.sleep(5)
+    """Kết nối đến Redis (connection pool dùng chung) với cơ chế thử lại."""
+    return redis_pool.connect_redis()
 
 # === 3. Logic Publisher chính ===
 def monitor_log_table(poll_interval_sec: int = 1):
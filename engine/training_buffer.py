@@ -0,0 +1,174 @@
+# engine/training_buffer.py
+"""
+================================================================================
+TRAINING RING BUFFER
+================================================================================
+Bộ đệm dữ liệu huấn luyện cấp phát trước bằng NumPy (mỗi cột một mảng cố định
+`capacity` phần tử), ghi vòng thay cho `pd.concat` + cắt đuôi sau mỗi batch.
+
+- append(df): ghi đè các dòng cũ nhất khi đầy, chi phí O(len(df)).
+- to_frame(): DataFrame theo thứ tự cũ -> mới (dtype gốc được khôi phục).
+- frame_since(seq): chỉ các dòng ghi sau mốc `seq` (dùng cho huấn luyện tăng dần).
+"""
+
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+_OBJECT = np.dtype(object)
+
+
+def _storage_for(series: pd.Series) -> Tuple[np.dtype, Any, Any]:
+    """(dtype lưu trữ, giá trị rỗng, timezone) cho một cột."""
+    dtype = series.dtype
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return np.dtype("datetime64[ns]"), np.datetime64("NaT"), dtype.tz
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return np.dtype("datetime64[ns]"), np.datetime64("NaT"), None
+    if isinstance(dtype, np.dtype):
+        if dtype.kind == "b":
+            return np.dtype(bool), False, None
+        if dtype.kind in "iu":
+            return np.dtype(np.int64), 0, None
+        if dtype.kind == "f":
+            return np.dtype(np.float64), np.nan, None
+    return _OBJECT, None, None
+
+
+def _values_for(series: pd.Series, storage: np.dtype, tz) -> np.ndarray:
+    if storage.kind == "M":
+        if tz is not None or isinstance(series.dtype, pd.DatetimeTZDtype):
+            series = pd.to_datetime(series, utc=True, errors="coerce").dt.tz_localize(None)
+        return series.to_numpy(dtype="datetime64[ns]")
+    if storage == _OBJECT:
+        return series.to_numpy(dtype=object)
+    return series.to_numpy(dtype=storage)
+
+
+class TrainingRingBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self._columns: Dict[str, np.ndarray] = {}
+        self._fill: Dict[str, Any] = {}
+        self._tz: Dict[str, Any] = {}
+        self._head = 0            # vị trí ghi tiếp theo
+        self._size = 0
+        self.total_appended = 0   # tổng số dòng đã ghi (mốc tăng dần, không reset khi ghi vòng)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df: Optional[pd.DataFrame], capacity: int) -> "TrainingRingBuffer":
+        buf = cls(capacity)
+        if df is not None and not df.empty:
+            buf.append(df)
+        return buf
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def nbytes(self) -> int:
+        return int(sum(arr.nbytes for arr in self._columns.values()))
+
+    # ------------------------------------------------------------------
+    def _add_column(self, name: str, series: pd.Series):
+        storage, fill, tz = _storage_for(series)
+        self._columns[name] = np.full(self.capacity, fill, dtype=storage)
+        self._fill[name] = fill
+        self._tz[name] = tz
+
+    def _fits(self, name: str, series: pd.Series) -> bool:
+        storage = self._columns[name].dtype
+        if storage == _OBJECT:
+            return True
+        kind = series.dtype.kind if isinstance(series.dtype, np.dtype) else None
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            kind = "M"
+        if storage.kind == "M":
+            return kind == "M"
+        if storage.kind == "f":
+            return kind in ("b", "i", "u", "f")
+        if storage.kind == "i":
+            return kind in ("b", "i", "u")
+        return kind == "b"
+
+    def _promote(self, name: str, series: pd.Series):
+        """Nới kiểu khi batch mới không vừa kiểu cũ (bool/int -> float -> object)."""
+        arr = self._columns[name]
+        kind = series.dtype.kind if isinstance(series.dtype, np.dtype) else None
+        if arr.dtype.kind in "biu" and kind in ("b", "i", "u", "f"):
+            self._columns[name], self._fill[name] = arr.astype(np.float64), np.nan
+        else:
+            if arr.dtype.kind == "M":
+                # datetime64[ns].astype(object) cho ra số nguyên -> đi qua pandas để giữ Timestamp
+                col = pd.Series(arr)
+                if self._tz[name] is not None:
+                    col = col.dt.tz_localize("UTC").dt.tz_convert(self._tz[name])
+                self._columns[name] = col.to_numpy(dtype=object)
+            else:
+                self._columns[name] = arr.astype(object)
+            self._fill[name] = None
+            self._tz[name] = None
+
+    def append(self, df: pd.DataFrame):
+        n = len(df)
+        if n == 0:
+            return
+        with self._lock:
+            self.total_appended += n
+            if n > self.capacity:
+                df = df.iloc[-self.capacity:]
+                n = self.capacity
+
+            positions = (self._head + np.arange(n)) % self.capacity
+            for name in df.columns:
+                if name not in self._columns:
+                    self._add_column(name, df[name])
+                series = df[name]
+                if not self._fits(name, series):
+                    self._promote(name, series)
+                arr = self._columns[name]
+                arr[positions] = _values_for(series, arr.dtype, self._tz[name])
+            for name in self._columns.keys() - set(df.columns):
+                self._columns[name][positions] = self._fill[name]
+
+            self._head = (self._head + n) % self.capacity
+            self._size = min(self._size + n, self.capacity)
+
+    # ------------------------------------------------------------------
+    def _order(self, last: Optional[int] = None) -> np.ndarray:
+        """Vị trí các dòng theo thứ tự cũ -> mới (chỉ `last` dòng mới nhất nếu có)."""
+        k = self._size if last is None else max(0, min(last, self._size))
+        return (self._head - k + np.arange(k)) % self.capacity
+
+    def _frame(self, order: np.ndarray) -> pd.DataFrame:
+        data = {}
+        for name, arr in self._columns.items():
+            col = pd.Series(arr[order], copy=False)
+            if self._tz[name] is not None:
+                col = col.dt.tz_localize("UTC").dt.tz_convert(self._tz[name])
+            data[name] = col
+        return pd.DataFrame(data, copy=False)
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return self._frame(self._order())
+
+    def rows_since(self, seq: int) -> int:
+        return max(0, min(self.total_appended - seq, self._size))
+
+    def frame_since(self, seq: int) -> Tuple[pd.DataFrame, int]:
+        """(các dòng ghi sau mốc seq còn trong buffer, mốc mới)."""
+        with self._lock:
+            return self._frame(self._order(self.rows_since(seq))), self.total_appended
+
+    def snapshot(self) -> Tuple[pd.DataFrame, int]:
+        """(toàn bộ buffer, mốc hiện tại) lấy nguyên tử so với append."""
+        with self._lock:
+            return self._frame(self._order()), self.total_appended
@@ -0,0 +1,102 @@
+# engine/training_feed.py
+"""
+================================================================================
+TRAINING FEED (DỮ LIỆU HUẤN LUYỆN TỪ MỌI WORKER)
+================================================================================
+Với engine_supervisor, user được chia cho N worker theo crc32(user) nhưng chỉ một
+worker (ENGINE_TRAINING_WORKER) buffer + train model dùng chung rồi hot-swap sang
+mọi worker. Nếu chỉ dùng dữ liệu của chính nó, model chỉ thấy khoảng 1/N user.
+
+- publish(df): worker không train gửi các dòng huấn luyện của batch vào
+  TRAINING_FEED_STREAM (một message Arrow IPC / batch, base64, MAXLEN ~).
+- TrainingFeedConsumer.drain(): worker train đọc (không chặn) các batch đã được
+  chuyển tới qua consumer group riêng, trả về DataFrame để nối vào training buffer.
+
+Đây là dữ liệu huấn luyện (không phải log cần phát hiện): message được ACK ngay khi
+đọc, mất một vài batch khi worker train chết giữa chừng là chấp nhận được.
+"""
+
+import os
+import base64
+import logging
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+
+from engine.buffer_store import frame_to_table
+from engine.redis_pool import get_redis, ensure_consumer_group
+
+logger = logging.getLogger(__name__)
+
+TRAINING_FEED_STREAM = os.getenv("TRAINING_FEED_STREAM", "uba:training:feed")
+TRAINING_FEED_GROUP = os.getenv("TRAINING_FEED_GROUP", "uba_trainer")
+# Giới hạn độ dài stream (số batch) khi worker train chậm / không chạy
+TRAINING_FEED_MAXLEN = int(os.getenv("TRAINING_FEED_MAXLEN", "1000"))
+# Số batch tối đa đọc mỗi lượt drain()
+TRAINING_FEED_DRAIN_COUNT = int(os.getenv("TRAINING_FEED_DRAIN_COUNT", "100"))
+
+
+def encode_frame(df: pd.DataFrame) -> str:
+    table = frame_to_table(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+
+
+def decode_frame(payload: str) -> pd.DataFrame:
+    with pa.ipc.open_stream(base64.b64decode(payload)) as reader:
+        return reader.read_all().to_pandas()
+
+
+def publish(df: pd.DataFrame, worker_id: str = "", client=None) -> bool:
+    """Gửi các dòng huấn luyện của một batch cho worker train. Lỗi chỉ được log (không chặn phát hiện)."""
+    if df is None or df.empty:
+        return False
+    try:
+        client = client or get_redis()
+        client.xadd(TRAINING_FEED_STREAM, {"worker": worker_id, "rows": len(df), "data": encode_frame(df)},
+                    maxlen=TRAINING_FEED_MAXLEN, approximate=True)
+        return True
+    except Exception as e:
+        logger.warning(f"Cannot forward {len(df)} training rows: {e}")
+        return False
+
+
+class TrainingFeedConsumer:
+    def __init__(self, consumer: str, client=None, count: int = TRAINING_FEED_DRAIN_COUNT):
+        self.consumer = consumer
+        self.count = count
+        self._client = client
+        self._ready = False
+        self.rows_received = 0
+
+    def drain(self) -> List[pd.DataFrame]:
+        """Các batch đã được chuyển tới (không chặn). Lỗi Redis -> danh sách rỗng."""
+        try:
+            client = self._client or get_redis()
+            if not self._ready:
+                ensure_consumer_group(client, TRAINING_FEED_STREAM, TRAINING_FEED_GROUP, start_id="0")
+                self._ready = True
+            reply = client.xreadgroup(TRAINING_FEED_GROUP, self.consumer, {TRAINING_FEED_STREAM: ">"},
+                                      count=self.count)
+        except Exception as e:
+            logger.warning(f"Cannot read training feed: {e}")
+            return []
+
+        frames, ids = [], []
+        for _, entries in reply or []:
+            for msg_id, fields in entries:
+                ids.append(msg_id)
+                try:
+                    frames.append(decode_frame(fields["data"]))
+                except Exception as e:
+                    logger.warning(f"Dropping undecodable training feed message {msg_id}: {e}")
+        if ids:
+            try:
+                client.xack(TRAINING_FEED_STREAM, TRAINING_FEED_GROUP, *ids)
+            except Exception as e:
+                logger.warning(f"Cannot ACK training feed messages: {e}")
+        self.rows_received += sum(len(f) for f in frames)
+        return frames
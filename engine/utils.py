@@ -1,5 +1,7 @@
 import pandas as pd
+import numpy as np
 import os
+import threading
 import sqlglot
 import sqlglot.errors as errors
 import hashlib
@@ -25,6 +27,8 @@ if 'ACTIVE_RESPONSE_AUDIT_LOG_PATH' not in globals():
     ACTIVE_RESPONSE_AUDIT_LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'active_response_audit.log')
     # Ensure logs directory exists
     os.makedirs(os.path.dirname(ACTIVE_RESPONSE_AUDIT_LOG_PATH), exist_ok=True)
+if 'PROFILE_TTL_SECONDS' not in globals():
+    PROFILE_TTL_SECONDS = int(os.getenv("PROFILE_TTL_SECONDS", str(90 * 24 * 3600)))
 
 
 # --- Import GeoIP (Xử lý nếu chưa cài thư viện) ---
@@ -41,6 +45,8 @@ try:
     SQLGLOT_AVAILABLE = True
 except ImportError:
     SQLGLOT_AVAILABLE = False
+
+from engine.sql_analysis import analyze_query
     
 # ==============================================================================
 #   CÁC HÀM HỖ TRỢ FEATURE ENGINEERING VÀ FEEDBACK
@@ -67,26 +73,12 @@ def extract_db_from_sql(sql_text):
     if not sql_text:
         return None
 
-    # Cách 1: Dùng SQLGlot (Chính xác nhất)
+    # Cách 1: Dùng SQLGlot (Chính xác nhất) - qua cache parse-once dùng chung
     if SQLGLOT_AVAILABLE:
-        try:
-            # Parse query (limit độ dài để tránh treo)
-            parsed = sqlglot.parse_one(sql_text[:5000], read="mysql")
-            if parsed:
-                # Collect all database names, prioritize non-system databases
-                databases = []
-                for table in parsed.find_all(exp.Table):
-                    if table.db and table.db.lower() not in ['mysql', 'sys', 'information_schema', 'performance_schema']:
-                        databases.append(table.db.lower())
-                    elif table.db:  # System database as fallback
-                        databases.append(table.db.lower())
-                
-                # Return first non-system database, or first database if all are system
-                if databases:
-                    return databases[0]
-        except Exception as e:
-            # Log parsing errors for debugging but continue with regex fallback
-            logging.debug(f"SQLGlot parsing failed for query: {e}")
+        # Return first database found (user DB or system DB)
+        databases = analyze_query(sql_text).databases
+        if databases:
+            return databases[0]
 
     # Cách 2: Dùng Regex (Nhanh, dự phòng) - Improved patterns
     # Enhanced regex patterns to catch more SQL statement types and formats
@@ -136,30 +128,13 @@ def extract_db_from_sql(sql_text):
     return None
 
 def get_tables_with_sqlglot(sql_query):
-    """Trích xuất tên các bảng từ một câu lệnh SQL sử dụng thư viện sqlglot."""
-    tables = set() # Dùng set để tự động loại bỏ các tên bảng trùng lặp.
-    
+    """Trích xuất tên các bảng từ một câu lệnh SQL sử dụng thư viện sqlglot (có cache)."""
     # Trả về danh sách rỗng nếu query không hợp lệ.
     if pd.isna(sql_query) or not isinstance(sql_query, str) or not sql_query.strip():
         return []
-        
-    try:
-        # Phân tích cú pháp câu lệnh SQL theo dialect của MySQL.
-        parsed_expression = sqlglot.parse_one(sql_query, read='mysql')
-        if parsed_expression:
-            # Tìm tất cả các node là Table trong cây cú pháp trừu tượng.
-            for table_node in parsed_expression.find_all(exp.Table):
-                final_table_name = table_node.name
-                # Xử lý trường hợp tên bảng có alias.
-                if hasattr(table_node, 'this') and table_node.this and isinstance(table_node.this, exp.Identifier):
-                     final_table_name = table_node.this.name
-                if final_table_name:
-                    tables.add(final_table_name.lower()) # Chuẩn hóa về chữ thường.
-    except (errors.ParseError, Exception):
-        # Bỏ qua nếu sqlglot không thể phân tích cú pháp câu lệnh để chương trình không bị dừng.
-        pass
-        
-    return list(tables)
+
+    # Mỗi query chỉ parse một lần; kết quả lấy từ cache chung của engine.
+    return list(analyze_query(sql_query).table_names)
 
 def extract_query_features(sql_query):
     """
@@ -457,6 +432,116 @@ def generate_html_alert(violation_summary: list):
 #   CÁC HÀM HỖ TRỢ PHÂN TÍCH THEO LUẬT (RULE-BASED ANALYSIS)
 # ==============================================================================
 
+# ==============================================================================
+# 0. BỘ KHỚP CHỮ KÝ (SIGNATURE MATCHER) DÙNG CHUNG CHO CÁC RULE
+# Gộp toàn bộ danh sách chữ ký trong security_rules thành một regex tổng,
+# chỉ quét cột query MỘT lần mỗi batch (trên các query khác nhau), trả về ma trận
+# boolean theo từng rule. Chỉ biên dịch lại khi cấu hình chữ ký thay đổi.
+# ==============================================================================
+# Các mẫu cố định (không phụ thuộc cấu hình): tên rule -> (regex, phân biệt hoa thường)
+_STATIC_SIGNATURE_PATTERNS = {
+    'config_change': (r'SET GLOBAL|general_log', False),
+    'password_hash': (r'authentication_string|password_expired', False),
+    'json_extract': (r'JSON_EXTRACT|JSON_UNQUOTE|->>', False),
+    'create_user': (r'CREATE USER', False),
+    'old_data': (r'2019|2020|2021', True),
+    'audit_tables': (r'(?:general_log|audit_log|slow_log|history)', False),
+    'obfuscation': (r'RENAME\s+TABLE|CREATE\s+VIEW', False),
+    'read_only_prefix': (r'^\s*(?:SELECT|SHOW|DESC)', False),
+    'multi_table_target': (r'SELECT|SHOW|DESCRIBE', False),
+}
+
+# Các mẫu lấy từ danh sách chữ ký trong cấu hình: tên rule -> (khóa signatures, phân biệt hoa thường)
+_CONFIG_SIGNATURE_LISTS = {
+    'sqli': ('sqli_keywords', False),
+    'admin': ('admin_keywords', False),
+    'large_dump': ('large_dump_tables', False),
+    'sensitive_table': ('sensitive_tables', True),
+}
+
+SIGNATURE_RULES = list(_STATIC_SIGNATURE_PATTERNS) + list(_CONFIG_SIGNATURE_LISTS)
+
+# Mẫu khớp gần như mọi query (SELECT / SHOW): nếu nằm trong regex tổng thì bộ lọc không bao giờ
+# loại được query nào -> tách ra, luôn được đánh giá riêng (rẻ: một regex / query khác nhau)
+_BROAD_SIGNATURE_RULES = ('read_only_prefix', 'multi_table_target')
+
+
+def _lowercase_pattern(pattern: str) -> str:
+    """Hạ chữ thường phần literal của regex, giữ nguyên escape (\\s, \\S, \\W...) - cho bộ lọc chạy trên query.lower()."""
+    return re.sub(r'\\.|[A-Z]+', lambda m: m.group(0) if m.group(0)[0] == '\\' else m.group(0).lower(), pattern)
+
+
+class SignatureMatcher:
+    """
+    Tập chữ ký đã biên dịch: một regex tổng để lọc + regex riêng từng rule để xác nhận.
+    Các mẫu rộng (_BROAD_SIGNATURE_RULES) không nằm trong regex tổng mà được đánh giá riêng.
+    """
+
+    def __init__(self, signatures: dict):
+        patterns = dict(_STATIC_SIGNATURE_PATTERNS)
+        for rule, (key, case_sensitive) in _CONFIG_SIGNATURE_LISTS.items():
+            keywords = [k for k in signatures.get(key, []) if k]
+            if keywords:
+                patterns[rule] = ("|".join(re.escape(k) for k in keywords), case_sensitive)
+
+        self.rule_patterns = {
+            rule: re.compile(p, 0 if cs else re.IGNORECASE) for rule, (p, cs) in patterns.items()
+        }
+        # Regex tổng: một lần search cho biết query có THỂ khớp rule chọn lọc nào không (tập cha, rule
+        # riêng xác nhận lại). Chạy không IGNORECASE trên query.lower(): nhanh hơn nhiều với alternation dài
+        self.combined = re.compile("|".join(
+            f"(?:{_lowercase_pattern(p)})" for rule, (p, _) in patterns.items() if rule not in _BROAD_SIGNATURE_RULES
+        ))
+
+    def match(self, queries: pd.Series) -> pd.DataFrame:
+        """Trả về DataFrame bool (index = queries.index, cột = SIGNATURE_RULES)."""
+        codes, uniques = pd.factorize(queries, use_na_sentinel=True)
+        n_rules = len(SIGNATURE_RULES)
+        unique_hits = np.zeros((len(uniques) + 1, n_rules), dtype=bool)  # dòng cuối dành cho NaN
+
+        rule_cols = [(j, self.rule_patterns.get(rule)) for j, rule in enumerate(SIGNATURE_RULES)
+                     if rule not in _BROAD_SIGNATURE_RULES]
+        broad_cols = [(SIGNATURE_RULES.index(rule), self.rule_patterns[rule]) for rule in _BROAD_SIGNATURE_RULES]
+        combined_search = self.combined.search
+        for i, q in enumerate(uniques):
+            if not isinstance(q, str):
+                continue
+            for j, pattern in broad_cols:
+                unique_hits[i, j] = pattern.search(q) is not None
+            if not combined_search(q.lower()):
+                continue
+            # Chỉ query đã qua bộ lọc tổng mới được xác nhận theo từng rule chọn lọc
+            for j, pattern in rule_cols:
+                if pattern is not None and pattern.search(q):
+                    unique_hits[i, j] = True
+
+        return pd.DataFrame(unique_hits[codes], index=queries.index, columns=SIGNATURE_RULES)
+
+
+_signature_matcher = None
+_signature_matcher_key = None
+_signature_matcher_lock = threading.Lock()
+
+
+def get_signature_matcher(rule_config) -> SignatureMatcher:
+    """Lấy matcher đã biên dịch, chỉ biên dịch lại khi danh sách chữ ký thay đổi."""
+    global _signature_matcher, _signature_matcher_key
+    signatures = (rule_config or {}).get('signatures', {})
+    key = json.dumps({k: signatures.get(k, []) for k, _ in _CONFIG_SIGNATURE_LISTS.values()}, sort_keys=True)
+    with _signature_matcher_lock:
+        if _signature_matcher is None or key != _signature_matcher_key:
+            _signature_matcher = SignatureMatcher(signatures)
+            _signature_matcher_key = key
+            logging.info("Signature matcher compiled from security_rules.")
+        return _signature_matcher
+
+
+def match_signatures(df, rule_config) -> pd.DataFrame:
+    """Quét cột query một lần, trả về ma trận khớp chữ ký theo từng rule."""
+    if 'query' not in df.columns:
+        return pd.DataFrame(False, index=df.index, columns=SIGNATURE_RULES)
+    return get_signature_matcher(rule_config).match(df['query'])
+
 # ==============================================================================
 # 1. NHÓM ACCESS ANOMALIES (Bất thường truy cập)
 # Bao gồm: Concurrent Login, Brute-force, Impossible Travel
@@ -533,13 +618,80 @@ def check_access_anomalies(df, rule_config):
 
     return anomalies
 
+def _time_of_day_ns(ts: pd.Series) -> np.ndarray:
+    """Giờ trong ngày (nanosecond kể từ 00:00, theo giờ địa phương của timestamp)."""
+    return (ts - ts.dt.normalize()).to_numpy(dtype='timedelta64[ns]').astype('int64')
+
+
+def _dt_time_to_ns(t: dt_time) -> int:
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000_000 + t.microsecond * 1000
+
+
+def _in_time_range(tod_ns, start_ns, end_ns):
+    """Kiểm tra tod nằm trong [start, end] (vector hóa, hỗ trợ khung qua đêm)."""
+    return np.where(start_ns <= end_ns,
+                    (start_ns <= tod_ns) & (tod_ns <= end_ns),
+                    (start_ns <= tod_ns) | (tod_ns <= end_ns))
+
+
+def build_overtime_table(overtime_schedule) -> pd.DataFrame:
+    """
+    Chuyển overtime_schedule (list dict) thành bảng khoảng thời gian
+    khóa theo (user, date, ip) với start_ns/end_ns. Ca khai báo sai định dạng bị bỏ qua.
+    """
+    rows = []
+    for shift in overtime_schedule or []:
+        try:
+            rows.append({
+                'user': shift.get('user'),
+                'date': shift.get('date'),
+                'ip': (shift.get('ip') or '').strip(),
+                'start_ns': _dt_time_to_ns(dt_time.fromisoformat(shift['start'])),
+                'end_ns': _dt_time_to_ns(dt_time.fromisoformat(shift['end'])),
+            })
+        except (KeyError, TypeError, ValueError):
+            continue
+    return pd.DataFrame(rows, columns=['user', 'date', 'ip', 'start_ns', 'end_ns'])
+
+
+def overtime_excused_mask(rows: pd.DataFrame, overtime_table: pd.DataFrame, match_ip: bool) -> np.ndarray:
+    """
+    Trả về mảng bool (cùng thứ tự với rows): dòng log có "vé" overtime hợp lệ
+    (đúng user, đúng ngày, giờ nằm trong ca; nếu match_ip thì IP phải khớp IP đăng ký, nếu có).
+    """
+    excused = np.zeros(len(rows), dtype=bool)
+    if rows.empty or overtime_table.empty:
+        return excused
+
+    ts = rows['timestamp']
+    candidates = pd.DataFrame({
+        'pos': np.arange(len(rows)),
+        'user': rows['user'].to_numpy(),
+        'date': ts.dt.strftime('%Y-%m-%d').to_numpy(),
+        'tod_ns': _time_of_day_ns(ts),
+    })
+    if match_ip:
+        candidates['client_ip'] = rows['client_ip'].to_numpy()
+
+    joined = candidates.merge(overtime_table, on=['user', 'date'], how='inner')
+    if joined.empty:
+        return excused
+    ok = _in_time_range(joined['tod_ns'].to_numpy(), joined['start_ns'].to_numpy(), joined['end_ns'].to_numpy())
+    if match_ip:
+        ok &= (joined['ip'] == '').to_numpy() | (joined['ip'] == joined['client_ip']).to_numpy()
+    excused[joined['pos'].to_numpy()[ok]] = True
+    return excused
+
+
 # ============================================================================================================================================================
 # 2. NHÓM INSIDER THREATS (Mối đe dọa nội bộ)
 # Bao gồm: Service Account, Admin Privilege Escalation, Sensitive Access, Late Night, Ghost Account, System Table Modification, Insecure Connection
 # ============================================================================================================================================================
-def check_insider_threats(df, rule_config):
+def check_insider_threats(df, rule_config, signature_matches=None):
     """Nhóm 2: Insider Threat"""
     anomalies = {}
+    if signature_matches is None:
+        signature_matches = match_signatures(df, rule_config)
     service_accounts = rule_config.get('service_accounts', {})
     signatures = rule_config.get('signatures', {})
     settings = rule_config.get('settings', {})
@@ -548,54 +700,30 @@ def check_insider_threats(df, rule_config):
     # Rule 4. Service Account Misuse
     idx_service = []
     overtime_schedule = signatures.get('overtime_schedule', [])
+    # Lịch overtime dạng bảng khoảng thời gian theo (user, date, ip), dùng chung cho Rule 4 và Rule 7
+    overtime_table = build_overtime_table(overtime_schedule)
+    hour_violation_mask = pd.Series(False, index=df.index)
     for user, config in service_accounts.items():
-        user_logs = df[df['user'] == user]
-        if user_logs.empty: continue
+        is_user = df['user'] == user
+        if not is_user.any(): continue
         # 1. Check IP (Giữ nguyên logic cũ - IP sai là bắt luôn, không có ngoại lệ overtime cho IP)
-        invalid_ip = user_logs[~user_logs['client_ip'].isin(config.get('allowed_ips', []))]
+        invalid_ip = df[is_user & ~df['client_ip'].isin(config.get('allowed_ips', []))]
         idx_service.extend(invalid_ip.index.tolist())
-        # 2. Check Giờ (Logic mới: Sai giờ chuẩn -> Check tiếp vé Overtime)
-        # Lấy ra những dòng log vi phạm giờ chuẩn
-        potential_hour_violations = user_logs[~user_logs['timestamp'].dt.hour.isin(config.get('allowed_hours', []))]
-        if potential_hour_violations.empty:
-            continue
-        # Duyệt qua từng log vi phạm giờ để xem có "vé" overtime không
-        for idx, row in potential_hour_violations.iterrows():
-            is_excused = False
-            # Nếu có danh sách overtime, đi kiểm tra
-            if overtime_schedule:
-                current_time = row['timestamp'].time()
-                current_date_str = row['timestamp'].strftime('%Y-%m-%d')
-                for shift in overtime_schedule:
-                    # So khớp User và Ngày
-                    if shift.get('user') == user and shift.get('date') == current_date_str:
-                        try:
-                            allowed_start = dt_time.fromisoformat(shift['start'])
-                            allowed_end = dt_time.fromisoformat(shift['end'])
-                            
-                            # Kiểm tra giờ log có nằm trong khung giờ xin phép không
-                            if allowed_start <= allowed_end:
-                                if allowed_start <= current_time <= allowed_end:
-                                    is_excused = True
-                                    break
-                            else: # Xử lý qua đêm (ví dụ 23h đến 2h sáng)
-                                if allowed_start <= current_time or current_time <= allowed_end:
-                                    is_excused = True
-                                    break
-                        except:
-                            continue
-            # Nếu KHÔNG được tha (không khớp lịch overtime nào) -> Thêm vào danh sách lỗi
-            if not is_excused:
-                idx_service.append(idx)    
+        # 2. Đánh dấu các dòng vi phạm giờ chuẩn
+        hour_violation_mask |= is_user & ~df['timestamp'].dt.hour.isin(config.get('allowed_hours', []))
+    # Sai giờ chuẩn -> tra bảng overtime một lần cho mọi dòng vi phạm (không check IP cho rule này)
+    potential_hour_violations = df[hour_violation_mask]
+    if not potential_hour_violations.empty:
+        excused = overtime_excused_mask(potential_hour_violations, overtime_table, match_ip=False)
+        idx_service.extend(potential_hour_violations.index[~excused].tolist())
     if idx_service: anomalies['Service Account Misuse'] = list(set(idx_service))
 
     # Rule 5. Admin Privilege Escalation
     idx_admin = []
     admin_kws = signatures.get('admin_keywords', [])
     if admin_kws:
-        pattern = "|".join(re.escape(k) for k in admin_kws)
         admin_actions = df[
-            (df['query'].str.contains(pattern, case=False, na=False)) &
+            (signature_matches['admin']) &
             (df['user'] != 'root')
         ]
         idx_admin.extend(admin_actions.index.tolist())       
@@ -607,93 +735,41 @@ def check_insider_threats(df, rule_config):
     allowed_users = settings.get('sensitive_allowed_users', [])   
     safe_start = settings.get('sensitive_safe_hours_start', 8)
     safe_end = settings.get('sensitive_safe_hours_end', 17) 
-    # Hàm check logic
-    def is_violation(row):
-        # 1. Kiểm tra xem query có đụng vào bảng nhạy cảm không?
-        is_sensitive_query = False
-        for tbl in sensitive_tables:
-            if tbl in str(row['query']):
-                is_sensitive_query = True
-                break
-        if not is_sensitive_query:
-            return False # Không vi phạm vì không đụng bảng nhạy cảm
-        # 2. Kiểm tra User
-        if row['user'] not in allowed_users:
-            return True # Vi phạm nghiêm trọng: User không có quyền mà truy cập
-        # 3. Kiểm tra Thời gian (Dành cho User ĐÃ CÓ QUYỀN)
-        # Ngay cả khi có quyền, nếu truy cập ngoài giờ hành chính cũng bị coi là bất thường
-        try:
-            hour = row['timestamp'].hour
-            # Nếu giờ hiện tại nhỏ hơn giờ bắt đầu HOẶC lớn hơn giờ kết thúc
-            if hour < safe_start or hour >= safe_end:
-                return True # Vi phạm: User có quyền nhưng truy cập sai giờ (ví dụ: kế toán truy cập bảng lương lúc 3h sáng)
-        except:
-            pass
-        return False # Hợp lệ (Đúng người, đúng giờ)
     if sensitive_tables:
-        sensitive_violation = df[df.apply(is_violation, axis=1)]
+        # 1. Query đụng bảng nhạy cảm (mẫu 'sensitive_table' của signature matcher)
+        is_sensitive_query = signature_matches['sensitive_table']
+        # 2. User không có quyền -> vi phạm
+        # 3. User có quyền nhưng truy cập ngoài giờ hành chính -> vi phạm
+        #    (ví dụ: kế toán truy cập bảng lương lúc 3h sáng)
+        hour = df['timestamp'].dt.hour
+        outside_safe_hours = (hour < safe_start) | (hour >= safe_end)
+        sensitive_violation = df[is_sensitive_query & (~df['user'].isin(allowed_users) | outside_safe_hours)]
         idx_sensitive.extend(sensitive_violation.index.tolist())   
     if idx_sensitive: anomalies['Sensitive Table Access'] = list(set(idx_sensitive))
 
     # Rule 7. Late Night Query 
-    # Logic: Truy cập ngoài giờ hành chính (22h - 5h sáng)
+    # Logic: Truy cập ngoài giờ hành chính (22h - 5h sáng), trừ khi có lịch overtime hợp lệ
     idx_latenight = []
     try:
         # Lấy cấu hình giờ khuya
         s_str = settings.get('late_night_start', '22:00:00')
         e_str = settings.get('late_night_end', '05:00:00')
-        start_time_limit = dt_time.fromisoformat(s_str)
-        end_time_limit = dt_time.fromisoformat(e_str)
-        # Lấy danh sách đăng ký làm thêm giờ/bảo trì
-        overtime_schedule = signatures.get('overtime_schedule', [])
-        def is_late_night_violation(row):
-            ts = row['timestamp']
-            current_time = ts.time()
-            current_date_str = ts.strftime('%Y-%m-%d')
-            user_name = row['user']
-            current_ip = row['client_ip'] # Lấy IP hiện tại
-            # 1. Kiểm tra khung giờ khuya
-            is_night = False
-            if start_time_limit <= end_time_limit:
-                is_night = start_time_limit <= current_time <= end_time_limit
-            else:
-                is_night = start_time_limit <= current_time or current_time <= end_time_limit           
-            if not is_night:
-                return False # Không phải giờ khuya -> Không vi phạm
-            # 2. Check Overtime Schedule (Vé thông hành)
-            if overtime_schedule:
-                for shift in overtime_schedule:
-                    # Check User và Date
-                    if shift.get('user') == user_name and shift.get('date') == current_date_str:
-                        # Nếu trong lịch có đăng ký IP, thì bắt buộc phải khớp
-                        registered_ip = shift.get('ip')
-                        if registered_ip and registered_ip.strip():
-                            # Nếu IP đăng ký khác IP đang truy cập -> Không chấp nhận vé này
-                            if current_ip != registered_ip.strip():
-                                continue 
-                        try:
-                            allowed_start = dt_time.fromisoformat(shift['start'])
-                            allowed_end = dt_time.fromisoformat(shift['end'])                            
-                            is_authorized = False
-                            if allowed_start <= allowed_end:
-                                is_authorized = allowed_start <= current_time <= allowed_end
-                            else:
-                                is_authorized = allowed_start <= current_time or current_time <= allowed_end                            
-                            if is_authorized:
-                                return False # Hợp lệ (Đúng người, đúng giờ, đúng IP)
-                        except ValueError:
-                            continue
-            # 3. Không có vé hoặc vé không khớp -> Vi phạm
-            return True
-        late_night_logs = df[df.apply(is_late_night_violation, axis=1)]
-        idx_latenight.extend(late_night_logs.index.tolist())
+        start_ns = _dt_time_to_ns(dt_time.fromisoformat(s_str))
+        end_ns = _dt_time_to_ns(dt_time.fromisoformat(e_str))
+        # 1. Kiểm tra khung giờ khuya
+        is_night = _in_time_range(_time_of_day_ns(df['timestamp']), start_ns, end_ns)
+        night_logs = df[is_night]
+        # 2. Check Overtime Schedule (Vé thông hành): đúng người, đúng ngày, đúng giờ, đúng IP (nếu có đăng ký)
+        excused = overtime_excused_mask(night_logs, overtime_table, match_ip=True)
+        # 3. Không có vé hoặc vé không khớp -> Vi phạm
+        idx_latenight.extend(night_logs.index[~excused].tolist())
     except Exception as e:
         logging.error(f"Rule 7 Logic Error: {e}")   
     if idx_latenight: anomalies['Late Night Query'] = list(set(idx_latenight))
     
     # Rule 8. Ghost Account Creation
     idx_ghost = []
-    create_cmds = df[df['query'].str.contains("CREATE USER", case=False, na=False)]
+    create_cmds = df[signature_matches['create_user']]
     if not create_cmds.empty:
         pattern = re.compile(r"CREATE\s+USER\s+['\"`]?([a-zA-Z0-9_]+)['\"`]?", re.IGNORECASE)
         for idx, row in create_cmds.iterrows():
@@ -712,7 +788,7 @@ def check_insider_threats(df, rule_config):
             # Loại trừ các lệnh chỉ đọc (SELECT, SHOW, DESCRIBE)
             # Lưu ý: event_name thường là 'statement/sql/update', 'statement/sql/insert'...
             # Cách đơn giản: query không bắt đầu bằng SELECT/SHOW
-            sys_mod = sys_access[~sys_access['query'].str.match(r'^\s*(SELECT|SHOW|DESC)', case=False, na=False)]
+            sys_mod = sys_access[~signature_matches.loc[sys_access.index, 'read_only_prefix']]
             idx_sys_mod.extend(sys_mod.index.tolist())
     if idx_sys_mod: anomalies['System Table Modification'] = list(set(idx_sys_mod))
 
@@ -735,9 +811,11 @@ def check_insider_threats(df, rule_config):
 # Bao gồm: SQLi, DoS, High CPU Usage, Scan Efficiency, Config Change, Entropy, Client Mismatch, Disk Temp Table Abuse,
 #          Excessive Locking, Suspicious Comment, Warning Flooding, Password Hash Attack, JSON Data Extraction
 # ============================================================================================================================================================
-def check_technical_attacks(df, rule_config):
+def check_technical_attacks(df, rule_config, signature_matches=None):
     """Nhóm 3: Technical Attacks"""
     anomalies = {}
+    if signature_matches is None:
+        signature_matches = match_signatures(df, rule_config)
     thresholds = rule_config.get('thresholds', {})
     signatures = rule_config.get('signatures', {})
     
@@ -745,8 +823,7 @@ def check_technical_attacks(df, rule_config):
     idx_sqli = []
     sqli_kws = signatures.get('sqli_keywords', [])
     if sqli_kws:
-        pattern_sqli = "|".join(re.escape(k) for k in sqli_kws)
-        sqli_logs = df[df['query'].str.contains(pattern_sqli, case=False, na=False)]
+        sqli_logs = df[signature_matches['sqli']]
         idx_sqli.extend(sqli_logs.index.tolist())
     if idx_sqli: anomalies['SQL Injection'] = list(set(idx_sqli))
     
@@ -777,9 +854,7 @@ def check_technical_attacks(df, rule_config):
     
     # Rule 15. Config Change
     idx_config = []
-    config_change = df[
-        df['query'].str.contains("SET GLOBAL|general_log", regex=True, case=False, na=False)
-    ]
+    config_change = df[signature_matches['config_change']]
     idx_config.extend(config_change.index.tolist())
     if idx_config: anomalies['Config Change'] = list(set(idx_config))
     
@@ -852,14 +927,14 @@ def check_technical_attacks(df, rule_config):
     # Rule 23. Password Hash Attack
     # Logic: Cố tình select chuỗi xác thực
     idx_pass_attack = []
-    pass_attack = df[df['query'].str.contains(r'authentication_string|password_expired', regex=True, case=False, na=False)]
+    pass_attack = df[signature_matches['password_hash']]
     idx_pass_attack.extend(pass_attack.index.tolist())
     if idx_pass_attack: anomalies['Password Hash Attack'] = list(set(idx_pass_attack))
 
     # Rule 24. JSON Data Extraction
     # Logic: Dùng hàm JSON extract
     idx_json = []
-    json_extract = df[df['query'].str.contains(r'JSON_EXTRACT|JSON_UNQUOTE|->>', regex=True, case=False, na=False)]
+    json_extract = df[signature_matches['json_extract']]
     idx_json.extend(json_extract.index.tolist())
     if idx_json: anomalies['JSON Data Extraction'] = list(set(idx_json))
 
@@ -869,9 +944,11 @@ def check_technical_attacks(df, rule_config):
 # 4. NHÓM DATA DESTRUCTION (Phá hoại dữ liệu)
 # Bao gồm: Mass Delete, Old Data, Large Dump, Audit Log Manipulation, Hidden View / Rename
 # ============================================================================================================================================================
-def check_data_destruction(df, rule_config):
+def check_data_destruction(df, rule_config, signature_matches=None):
     """Nhóm 4: Data Destruction"""
     anomalies = {}
+    if signature_matches is None:
+        signature_matches = match_signatures(df, rule_config)
     thresholds = rule_config.get('thresholds', {})
     signatures = rule_config.get('signatures', {})
     
@@ -887,7 +964,7 @@ def check_data_destruction(df, rule_config):
     
     # Rule 26. Old Data Modification (Sửa dữ liệu cũ)
     idx_old_data = []
-    old_data_access = df[df['query'].str.contains("2019|2020|2021", regex=True, na=False)]
+    old_data_access = df[signature_matches['old_data']]
     idx_old_data.extend(old_data_access.index.tolist())
     if idx_old_data: anomalies['Old Data Modification'] = list(set(idx_old_data))
 
@@ -896,10 +973,9 @@ def check_data_destruction(df, rule_config):
     idx_dump = []
     large_dump_tables = signatures.get('large_dump_tables', [])
     if large_dump_tables:
-        pattern_dump = "|".join(re.escape(k) for k in large_dump_tables)
         # Điều kiện: Query chứa tên bảng quan trọng VÀ trả về > 1000 dòng
         dump_logs = df[
-            (df['query'].str.contains(pattern_dump, case=False, na=False)) &
+            (signature_matches['large_dump']) &
             (df['rows_returned'] > 1000)
         ]
         idx_dump.extend(dump_logs.index.tolist())
@@ -908,10 +984,9 @@ def check_data_destruction(df, rule_config):
     # Rule 28. Audit Log Manipulation
     # Logic: Update/Delete trên bảng log/audit/history
     idx_audit = []
-    # Regex tìm tên bảng chứa chữ log, audit, history
-    audit_tables_pattern = r'(?:general_log|audit_log|slow_log|history)'
+    # Tên bảng chứa chữ log, audit, history (mẫu 'audit_tables' trong signature matcher)
     audit_manipulation = df[
-        (df['query'].str.contains(audit_tables_pattern, regex=True, case=False, na=False)) &
+        (signature_matches['audit_tables']) &
         (df['event_name'].isin(['statement/sql/delete', 'statement/sql/update', 'statement/sql/truncate']))
     ]
     idx_audit.extend(audit_manipulation.index.tolist())
@@ -921,7 +996,7 @@ def check_data_destruction(df, rule_config):
     # Logic: Đổi tên bảng hoặc tạo View
     idx_obfuscation = []
     # Tìm lệnh RENAME TABLE hoặc CREATE VIEW
-    obfuscation_cmds = df[df['query'].str.contains(r'RENAME\s+TABLE|CREATE\s+VIEW', regex=True, case=False, na=False)]
+    obfuscation_cmds = df[signature_matches['obfuscation']]
     idx_obfuscation.extend(obfuscation_cmds.index.tolist())
     if idx_obfuscation: anomalies['Hidden View / Rename'] = list(set(idx_obfuscation))
     
@@ -930,106 +1005,191 @@ def check_data_destruction(df, rule_config):
 # ==============================================================================
 # 5. RULE 30: MULTI-TABLE ACCESS 
 # ==============================================================================
-def check_multi_table_anomalies(df, rule_config):
+_RE_MULTI_TABLE_FALLBACK = re.compile(
+    r'(?:\bFROM\b|\bJOIN\b|\bUPDATE\b|\bINTO\b)\s+(?!\()([`\'"]?\w+[`\'"]?(?:\.[`\'"]?\w+[`\'"]?)?)',
+    re.IGNORECASE)
+
+
+def _extract_tables_list(q):
+    """Danh sách bảng cho Rule 30: SQLGlot (tên bảng trần), fallback Regex."""
+    if not isinstance(q, str) or not q.strip(): return ()
+
+    # 1. Ưu tiên SQLGlot (kết quả parse-once từ cache chung)
+    if SQLGLOT_AVAILABLE:
+        try:
+            tables = get_tables_with_sqlglot(q)
+            if tables: return tuple(tables)
+        except Exception: pass
+
+    # 2. Fallback Regex
+    try:
+        return tuple(m.replace('`', '').replace("'", "").replace('"', "").lower()
+                     for m in _RE_MULTI_TABLE_FALLBACK.findall(q))
+    except Exception:
+        return ()
+
+
+def extract_table_lists(queries: pd.Series) -> pd.Series:
+    """Tuple bảng cho từng dòng; mỗi query khác nhau chỉ trích xuất một lần."""
+    if queries.empty:
+        return pd.Series([], index=queries.index, dtype=object)
+    codes, uniques = pd.factorize(queries, use_na_sentinel=False)
+    per_unique = np.empty(len(uniques), dtype=object)
+    per_unique[:] = [_extract_tables_list(q) for q in uniques]
+    return pd.Series(per_unique[codes], index=queries.index, dtype=object)
+
+
+def time_windows(timestamps: pd.Series, window_min) -> pd.Series:
+    """Mốc đầu cửa sổ `window_min` phút của từng timestamp (giữ nguyên timezone)."""
+    return pd.to_datetime(timestamps, errors='coerce').dt.floor(f'{window_min}min')
+
+
+def explode_tables(df, table_lists: pd.Series, window_min) -> pd.DataFrame:
+    """
+    Một dòng cho mỗi (index log, user, window, table). Window = timestamp.floor(window_min),
+    gốc cố định (epoch) nên các batch khác nhau cắt cửa sổ giống nhau.
+    """
+    frame = pd.DataFrame({
+        'user': df['user'],
+        'window': time_windows(df['timestamp'], window_min),
+        'table': table_lists.reindex(df.index),
+    })
+    return frame.explode('table').dropna(subset=['table'])
+
+
+class MultiTableWindowState:
+    """
+    Tập bảng (user, window) đã thấy ở các batch trước, để cửa sổ nằm vắt qua
+    ranh giới batch vẫn được đếm đủ. Chỉ giữ các cửa sổ còn mở.
+    """
+
+    def __init__(self):
+        self._seen = pd.DataFrame(columns=['user', 'window', 'table'])
+        self._lock = threading.Lock()
+
+    def distinct_counts(self, exploded: pd.DataFrame, window_min) -> pd.Series:
+        """Số bảng khác nhau theo (user, window), gộp cả state cũ; cập nhật state."""
+        current = exploded[['user', 'window', 'table']].drop_duplicates()
+        with self._lock:
+            combined = current if self._seen.empty else pd.concat([self._seen, current], ignore_index=True)
+            counts = combined.groupby(['user', 'window'], observed=True)['table'].nunique()
+            if not current.empty:
+                # Cửa sổ cũ hơn cửa sổ mới nhất (trừ một cửa sổ cho log đến trễ) đã đóng
+                horizon = current['window'].max() - pd.Timedelta(minutes=window_min)
+                self._seen = combined[combined['window'] >= horizon].drop_duplicates()
+        return counts
+
+    def clear(self):
+        with self._lock:
+            self._seen = self._seen.iloc[0:0]
+
+
+_multi_table_windows = MultiTableWindowState()
+
+
+def check_multi_table_anomalies(df, rule_config, signature_matches=None, table_lists=None):
     """
     Rule 30: Multi-table Access
+    table_lists: Series tuple bảng (index theo df) đã trích xuất sẵn; None thì tự trích xuất.
     """
-    anomalies = []
     thresholds = rule_config.get('thresholds', {})
     
     # Lấy tham số
     window_min = thresholds.get('multi_table_window_minutes', 4)
     min_tables = thresholds.get('multi_table_min_count', 3)
-    
-    def extract_tables_list(q):
-        if not isinstance(q, str) or not q.strip(): return []
-        
-        # 1. Ưu tiên SQLGlot
-        if SQLGLOT_AVAILABLE:
-            try:
-                tables = get_tables_with_sqlglot(q)
-                if tables: return tables
-            except: pass
 
-        # 2. Fallback Regex
-        try:
-            pattern = r'(?:\bFROM\b|\bJOIN\b|\bUPDATE\b|\bINTO\b)\s+(?!\()([`\'"]?\w+[`\'"]?(?:\.[`\'"]?\w+[`\'"]?)?)'
-            matches = re.findall(pattern, q, re.IGNORECASE)
-            clean_tables = []
-            for m in matches:
-                clean_name = m.replace('`', '').replace("'", "").replace('"', "").lower()
-                clean_tables.append(clean_name)
-            return clean_tables
-        except:
-            return []
-
-    target_events = ['SELECT', 'SHOW', 'DESCRIBE']
-    mask = df['query'].str.contains('|'.join(target_events), case=False, na=False)
-    df_target = df[mask].copy()
+    if signature_matches is None:
+        signature_matches = match_signatures(df, rule_config)
+    mask = signature_matches['multi_table_target']
+    df_target = df[mask]
     
     if df_target.empty: return {} # <-- SỬA: Trả về dict rỗng thay vì list rỗng
 
-    df_target['accessed_tables_list'] = df_target['query'].apply(extract_tables_list)
-    df_target = df_target[df_target['accessed_tables_list'].map(len) > 0]
-    df_target = df_target.sort_values('timestamp')
-    
-    grouped = df_target.groupby(['user', pd.Grouper(key='timestamp', freq=f'{window_min}Min')], observed=False)
+    if table_lists is None:
+        table_lists = extract_table_lists(df_target['query'])
 
-    for (user, time_window), group in grouped:
-        unique_tables_in_window = set()
-        for tbl_list in group['accessed_tables_list']:
-            unique_tables_in_window.update(tbl_list)
-            
-        if len(unique_tables_in_window) > min_tables:
-            anomalies.extend(group.index.tolist())
+    # explode + nunique thay cho vòng lặp Python trên từng group
+    exploded = explode_tables(df_target, table_lists, window_min)
+    if exploded.empty: return {}
+    counts = _multi_table_windows.distinct_counts(exploded, window_min)
 
-    # --- [QUAN TRỌNG] SỬA ĐOẠN RETURN TẠI ĐÂY ---
-    if anomalies:
-        # Trả về Dictionary: { 'Tên Rule': [Danh sách Index] }
-        return {'Multi-Table Access': list(set(anomalies))}
-    
-    return {}
+    hot = counts[counts > min_tables].index
+    if hot.empty: return {}
+    keys = pd.MultiIndex.from_arrays([exploded['user'], exploded['window']])
+    anomalies = exploded.index[keys.isin(hot)].unique()
+
+    # Trả về Dictionary: { 'Tên Rule': [Danh sách Index] }
+    return {'Multi-Table Access': anomalies.tolist()}
 
 # ==============================================================================
 # 5. RULE 31: BEHAVIORAL PROFILE
 # ==============================================================================
+def _profile_user_hours(df_logs):
+    """Trả về (users, hours) của các dòng có user + timestamp hợp lệ, kèm index gốc."""
+    if 'user' not in df_logs.columns or 'timestamp' not in df_logs.columns:
+        return None
+    users = df_logs['user']
+    hours = pd.to_datetime(df_logs['timestamp'], errors='coerce').dt.hour
+    valid = users.notna() & (users.astype(str) != '') & hours.notna()
+    if not valid.any():
+        return None
+    return pd.DataFrame({'user': users[valid].astype(str), 'hour': hours[valid].astype(int)})
+
+
 def update_behavior_redis(redis_client, df_logs):
     """
     Học thói quen: Cập nhật tần suất hoạt động của User theo giờ vào Redis.
-    Sử dụng Pipeline để tăng tốc độ ghi.
+    Gộp trước bằng groupby: một HINCRBY cho mỗi (user, giờ) và một EXPIRE cho mỗi user,
+    tất cả gửi trong một pipeline.
     """
     if df_logs.empty or redis_client is None:
         return
 
     try:
-        pipe = redis_client.pipeline()
-        
-        # Chỉ quan tâm các cột cần thiết
-        for _, row in df_logs.iterrows():
-            user = row.get('user')
-            timestamp = row.get('timestamp')
-            
-            if user and timestamp:
-                # Key: uba:profile:thanh.nguyen
-                key = f"{REDIS_PROFILE_KEY_PREFIX}{user}"
-                
-                # Field: Giờ (0-23)
-                hour = str(timestamp.hour)
-                
-                # Tăng biến đếm số lần xuất hiện tại giờ này thêm 1
-                pipe.hincrby(key, hour, 1)
-                
-                # Gia hạn thời gian sống cho Key (nếu cần)
-                if PROFILE_TTL_SECONDS:
-                    pipe.expire(key, PROFILE_TTL_SECONDS)
-        
+        user_hours = _profile_user_hours(df_logs)
+        if user_hours is None:
+            return
+        counts = user_hours.groupby(['user', 'hour']).size()
+
+        pipe = redis_client.pipeline(transaction=False)
+        # Key: uba:profile:thanh.nguyen | Field: Giờ (0-23) | Tăng theo số lần xuất hiện trong batch
+        for (user, hour), count in counts.items():
+            pipe.hincrby(f"{REDIS_PROFILE_KEY_PREFIX}{user}", str(hour), int(count))
+        # Gia hạn thời gian sống cho Key (mỗi user một lần)
+        if PROFILE_TTL_SECONDS:
+            for user in counts.index.unique(level='user'):
+                pipe.expire(f"{REDIS_PROFILE_KEY_PREFIX}{user}", PROFILE_TTL_SECONDS)
+
         # Thực thi hàng loạt lệnh
         pipe.execute()
-        logging.info(f"Updated behavior profiles for {len(df_logs)} logs.")
+        logging.info(f"Updated behavior profiles for {len(df_logs)} logs "
+                     f"({len(counts)} user-hour counters).")
         
     except Exception as e:
         logging.error(f"Error updating Redis profile: {e}")
-        
+
+
+def fetch_behavior_profiles(redis_client, users) -> pd.DataFrame:
+    """
+    Lấy histogram giờ của nhiều user trong MỘT pipeline (HGETALL mỗi user).
+    Trả về DataFrame index = user, cột = giờ 0..23, giá trị = số lần đã xuất hiện.
+    """
+    users = list(users)
+    pipe = redis_client.pipeline(transaction=False)
+    for user in users:
+        pipe.hgetall(f"{REDIS_PROFILE_KEY_PREFIX}{user}")
+    histograms = pipe.execute()
+
+    profile = np.zeros((len(users), 24), dtype='int64')
+    for i, hist in enumerate(histograms):
+        for hour, count in (hist or {}).items():
+            try:
+                profile[i, int(hour)] = int(count)
+            except (ValueError, TypeError, IndexError):
+                continue
+    return pd.DataFrame(profile, index=pd.Index(users, name='user'), columns=range(24))
+
+
 def check_behavior_redis(redis_client, df_logs, min_threshold=5):
     """
     Kiểm tra bất thường: So sánh log hiện tại với lịch sử trong Redis.
@@ -1041,27 +1201,18 @@ def check_behavior_redis(redis_client, df_logs, min_threshold=5):
         return anomalies_indices
 
     try:
-        for idx, row in df_logs.iterrows():
-            user = row.get('user')
-            timestamp = row.get('timestamp')
-            
-            if user and timestamp:
-                key = f"{REDIS_PROFILE_KEY_PREFIX}{user}"
-                hour = str(timestamp.hour)
-                
-                # Lấy số lần đã xuất hiện
-                count_bytes = redis_client.hget(key, hour)
-                
-                count = 0
-                if count_bytes:
-                    try:
-                        count = int(count_bytes)
-                    except:
-                        count = 0
-                
-                # LOGIC PHÁT HIỆN: Dùng tham số min_threshold truyền vào
-                if count < min_threshold:
-                    anomalies_indices.append(idx)
+        user_hours = _profile_user_hours(df_logs)
+        if user_hours is None:
+            return anomalies_indices
+
+        codes, uniq_users = pd.factorize(user_hours['user'])
+        profile = fetch_behavior_profiles(redis_client, uniq_users).to_numpy()
+
+        # Lookup vector hóa: số lần đã xuất hiện của (user, giờ) từng dòng
+        counts = profile[codes, user_hours['hour'].to_numpy()]
+
+        # LOGIC PHÁT HIỆN: Dùng tham số min_threshold truyền vào
+        anomalies_indices = user_hours.index[counts < min_threshold].tolist()
 
     except Exception as e:
         logging.error(f"Error checking Redis profile: {e}")
@@ -0,0 +1,193 @@
+# engine/write_behind.py
+"""
+================================================================================
+WRITE-BEHIND SINK (DETECTION -> PERSISTENCE)
+================================================================================
+Tách bước ghi DB ra khỏi vòng lặp realtime engine: kết quả phát hiện của mỗi
+batch được đưa vào một hàng đợi có giới hạn, một writer thread gom kết quả của
+nhiều batch, flush theo số dòng hoặc theo thời gian, và CHỈ ACK các message
+Redis sau khi dữ liệu của chúng đã commit thành công (at-least-once).
+
+Nhờ vậy việc phát hiện trên batch N+1 chạy song song với việc ghi batch N.
+Khi hàng đợi đầy, submit() sẽ chặn (backpressure) thay vì tích tụ bộ nhớ.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# --- Cấu hình ---
+# Số batch tối đa đang chờ ghi (backpressure khi đầy)
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "8"))
+# Flush khi số dòng all_logs gom được >= ngưỡng ...
+WRITE_BEHIND_FLUSH_ROWS = int(os.getenv("WRITE_BEHIND_FLUSH_ROWS", "20000"))
+# ... hoặc khi batch cũ nhất đã chờ quá N giây
+WRITE_BEHIND_FLUSH_INTERVAL_SEC = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SEC", "2"))
+# Số lần thử ghi lại trước khi bỏ qua (message không được ACK -> sẽ được xử lý lại)
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+
+AckIds = List[Tuple[str, str]]
+
+
+def merge_results(results_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Gộp kết quả của nhiều batch: nối các DataFrame cùng khóa (các khóa khác lấy giá trị cuối)."""
+    merged: Dict[str, Any] = {}
+    frames: Dict[str, List[pd.DataFrame]] = {}
+    for results in results_list:
+        for key, value in results.items():
+            if isinstance(value, pd.DataFrame):
+                if not value.empty:
+                    frames.setdefault(key, []).append(value)
+            else:
+                merged[key] = value
+    for key, dfs in frames.items():
+        # Bản sao nông: writer có thể gán lại cột (timestamp) mà không ảnh hưởng luồng alert
+        merged[key] = dfs[0].copy(deep=False) if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+    return merged
+
+
+class WriteBehindSink:
+    """
+    Hàng đợi ghi bất đồng bộ với một writer thread.
+    - save_fn(results) -> bool: ghi kết quả (True = đã commit). Phải nguyên tử (all-or-nothing):
+      batch lỗi được thử lại nguyên vẹn, rồi được redeliver nếu vẫn lỗi.
+    - ack_fn(ack_ids): ACK các message Redis sau khi ghi thành công.
+    - fail_fn(ack_ids): (tùy chọn) báo các message bị bỏ lại chưa ACK vì ghi lỗi hết số lần thử.
+    - in_flight_ids(): các message đang được sink giữ (đã submit / đang chờ submit, chưa ACK
+      hoặc bỏ qua), để PendingReclaimer không nhận lại chúng.
+    """
+
+    def __init__(self, save_fn: Callable[[Dict[str, Any]], bool], ack_fn: Callable[[AckIds], None],
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING,
+                 flush_rows: int = WRITE_BEHIND_FLUSH_ROWS,
+                 flush_interval_sec: float = WRITE_BEHIND_FLUSH_INTERVAL_SEC,
+                 max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+                 fail_fn: Optional[Callable[[AckIds], None]] = None):
+        self.save_fn = save_fn
+        self.ack_fn = ack_fn
+        self.fail_fn = fail_fn
+        self.flush_rows = flush_rows
+        self.flush_interval_sec = flush_interval_sec
+        self.max_retries = max_retries
+        self._queue: "queue.Queue[Optional[Tuple[Dict[str, Any], AckIds, float]]]" = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._in_flight: Set[Tuple[str, str]] = set()
+        self._in_flight_lock = threading.Lock()
+        self.stats = {"batches": 0, "flushes": 0, "rows": 0, "acked": 0, "failed_flushes": 0}
+
+    # ------------------------------------------------------------------
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="WriteBehindSink", daemon=True)
+            self._thread.start()
+            logger.info(f"Write-behind sink started (flush_rows={self.flush_rows}, "
+                        f"flush_interval={self.flush_interval_sec}s, max_pending={self._queue.maxsize}).")
+        return self
+
+    def submit(self, results: Dict[str, Any], ack_ids: AckIds, timeout: Optional[float] = None):
+        """Đưa kết quả của một batch vào hàng đợi (chặn khi hàng đợi đầy)."""
+        # Ghi nhận trước khi put: batch đang chờ chỗ trong hàng đợi cũng là "đang giữ"
+        self._hold(ack_ids)
+        try:
+            self._queue.put((results, ack_ids, time.time()), timeout=timeout)
+        except queue.Full:
+            self._release(ack_ids)
+            raise
+
+    def in_flight_ids(self) -> Set[Tuple[str, str]]:
+        with self._in_flight_lock:
+            return set(self._in_flight)
+
+    def _hold(self, ack_ids: AckIds):
+        with self._in_flight_lock:
+            self._in_flight.update(ack_ids)
+
+    def _release(self, ack_ids: AckIds):
+        with self._in_flight_lock:
+            self._in_flight.difference_update(ack_ids)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Dừng writer thread sau khi flush hết dữ liệu đang chờ."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=timeout)
+        logger.info(f"Write-behind sink stopped. Stats: {self.stats}")
+
+    # ------------------------------------------------------------------
+    def _run(self):
+        buffer: List[Tuple[Dict[str, Any], AckIds, float]] = []
+        buffered_rows = 0
+        stop_requested = False
+
+        while True:
+            # Chờ tới hạn flush của batch cũ nhất (hoặc chờ batch mới nếu buffer rỗng)
+            if buffer:
+                wait = max(0.0, buffer[0][2] + self.flush_interval_sec - time.time())
+            else:
+                wait = None
+            try:
+                item = self._queue.get(timeout=wait) if not stop_requested else self._queue.get_nowait()
+                if item is None:
+                    stop_requested = True
+                else:
+                    buffer.append(item)
+                    all_logs = item[0].get("all_logs")
+                    buffered_rows += len(all_logs) if isinstance(all_logs, pd.DataFrame) else 0
+                    self.stats["batches"] += 1
+            except queue.Empty:
+                pass
+
+            due = bool(buffer) and (
+                buffered_rows >= self.flush_rows
+                or time.time() - buffer[0][2] >= self.flush_interval_sec
+                or stop_requested
+            )
+            if due:
+                self._flush(buffer, buffered_rows)
+                buffer, buffered_rows = [], 0
+
+            if stop_requested and not buffer and self._queue.empty():
+                return
+
+    def _flush(self, buffer, buffered_rows: int):
+        merged = merge_results([results for results, _, _ in buffer])
+        ack_ids = [ack for _, acks, _ in buffer for ack in acks]
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if self.save_fn(merged) is not False:
+                    break
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}", exc_info=True)
+            logger.warning(f"Write-behind flush failed (attempt {attempt}/{self.max_retries}).")
+            if attempt < self.max_retries:
+                time.sleep(min(2 ** attempt, 10))
+        else:
+            # Không ACK: message vẫn nằm trong PEL và sẽ được xử lý lại
+            self.stats["failed_flushes"] += 1
+            logger.error(f"Write-behind: giving up on {len(buffer)} batches ({buffered_rows} rows); "
+                         f"{len(ack_ids)} messages left un-ACKed for redelivery.")
+            self._release(ack_ids)
+            if self.fail_fn is not None:
+                self.fail_fn(ack_ids)
+            return
+
+        self.stats["flushes"] += 1
+        self.stats["rows"] += buffered_rows
+        try:
+            self.ack_fn(ack_ids)
+            self.stats["acked"] += len(ack_ids)
+        except Exception as e:
+            logger.error(f"Write-behind: ACK failed after commit ({e}); messages may be redelivered.")
+        self._release(ack_ids)
@@ -14,6 +14,8 @@ except:
     print("Lỗi: Không tìm thấy config.py"); 
     sys.exit(1)
 
+from engine import redis_pool
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt="%H:%M:%S")
 
 # --- CẤU HÌNH ---
@@ -146,7 +148,7 @@ def process_logs():
     # Kết nối Redis an toàn (Soft connect)
     redis_client = None
     try:
-        redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+        redis_client = redis_pool.get_redis()
         redis_client.ping()
         logging.info("✅ Redis Connected")
     except:
@@ -340,13 +342,12 @@ def process_logs():
                             redis_status = "✅"
                         except Exception as e:
                             logging.error(f"Redis Push Failed: {e}")
-                            # Thử kết nối lại cho lần sau
-                            try: redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
-                            except: pass
+                            # Bỏ kết nối hỏng trong pool, lần sau dùng kết nối mới
+                            redis_pool.reset_pool()
+                            redis_client = redis_pool.get_redis()
                     else:
                         # Thử kết nối lại cho lần sau
-                        try: redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
-                        except: pass
+                        redis_client = redis_pool.get_redis()
 
                     # BƯỚC C: Cập nhật State (Chỉ khi CSV đã ghi thành công)
                     last_ts = batch_max
@@ -0,0 +1,9 @@
+# tests/conftest.py
+import os
+import sys
+
+# Engine modules import both `engine.x` and top-level `utils` (engine/ được thêm vào sys.path khi chạy)
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (PROJECT_ROOT, os.path.join(PROJECT_ROOT, "engine")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,31 @@
+# tests/test_api_cors.py
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("jose")
+pytest.importorskip("passlib")
+
+from fastapi.testclient import TestClient
+
+from backend_api.main_api import app
+
+ORIGIN = "http://localhost:5173"
+
+
+def _exposed(response):
+    return {h.strip().lower() for h in response.headers.get("access-control-expose-headers", "").split(",")}
+
+
+def test_next_cursor_header_readable_cross_origin():
+    # Frontend (origin khác) chỉ đọc được header tùy chỉnh nếu nó nằm trong Access-Control-Expose-Headers
+    response = TestClient(app).get("/api/anomalies/", headers={"Origin": ORIGIN})
+    assert response.headers.get("access-control-allow-origin") in ("*", ORIGIN)
+    assert "x-next-cursor" in _exposed(response)
+
+
+def test_preflight_allows_cursor_query():
+    response = TestClient(app).options("/api/anomalies/?cursor=abc", headers={
+        "Origin": ORIGIN, "Access-Control-Request-Method": "GET",
+        "Access-Control-Request-Headers": "authorization",
+    })
+    assert response.status_code == 200
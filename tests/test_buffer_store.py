@@ -0,0 +1,71 @@
+# tests/test_buffer_store.py
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from engine.buffer_store import TrainingBufferStore
+
+
+def test_int_column_widened_to_float(tmp_path):
+    store = TrainingBufferStore(str(tmp_path))
+    store.append(pd.DataFrame({"a": [1, 2], "u": ["x", "y"]}), capacity=100)
+    # Ring buffer đã promote int -> float64: batch sau mang giá trị lẻ
+    store.append(pd.DataFrame({"a": [1.5, np.nan], "u": ["z", None]}), capacity=100)
+    store.append(pd.DataFrame({"a": [3], "u": ["w"]}), capacity=100)
+
+    assert store.schema.field("a").type == pa.float64()
+    df = store.load(100)
+    assert df["a"].tolist()[:3] == [1.0, 2.0, 1.5]
+    assert np.isnan(df["a"].iloc[3]) and df["a"].iloc[4] == 3.0
+    assert df["u"].tolist() == ["x", "y", "z", None, "w"]
+    # Segment cũ đã được ghi lại theo schema mới
+    for path in store.segments():
+        with pa.memory_map(path, "r") as source:
+            assert pa.ipc.open_file(source).schema.field("a").type == pa.float64()
+
+
+def test_incompatible_column_widened_to_string_after_restart(tmp_path):
+    store = TrainingBufferStore(str(tmp_path))
+    store.append(pd.DataFrame({"a": [1.25, 2.0]}), capacity=100)
+
+    # Tiến trình mới: schema được đọc lại từ segment cuối
+    store = TrainingBufferStore(str(tmp_path))
+    store.append(pd.DataFrame({"a": ["abc", None]}), capacity=100)
+
+    assert store.schema.field("a").type == pa.string()
+    assert store.load(100)["a"].tolist() == ["1.25", "2", "abc", None]
+
+
+def test_numeric_nan_keeps_int_type(tmp_path):
+    store = TrainingBufferStore(str(tmp_path))
+    store.append(pd.DataFrame({"a": [1, 2]}), capacity=100)
+    store.append(pd.DataFrame({"a": [3.0, np.nan]}), capacity=100)
+
+    assert store.schema.field("a").type == pa.int64()
+    assert store.load(100)["a"].tolist()[:3] == [1, 2, 3]
+
+
+def test_interrupted_compaction_does_not_duplicate_rows(tmp_path, monkeypatch):
+    import engine.buffer_store as buffer_store
+
+    monkeypatch.setattr(buffer_store, "BUFFER_STORE_COMPACT_FACTOR", 1.0)
+    real_remove = os.remove
+
+    def crash(path):  # Segment gộp đã ghi xong nhưng chưa xóa được segment cũ
+        raise OSError("simulated crash")
+
+    store = TrainingBufferStore(str(tmp_path))
+    store.append(pd.DataFrame({"a": range(0, 30)}), capacity=40)
+    monkeypatch.setattr(buffer_store.os, "remove", crash)
+    store.append(pd.DataFrame({"a": range(30, 60)}), capacity=40)
+    # [0,30) chồng một phần, [30,60) bị che hoàn toàn bởi segment gộp [20,60)
+    assert len(store.segments()) == 3
+
+    monkeypatch.setattr(buffer_store.os, "remove", real_remove)
+    store = TrainingBufferStore(str(tmp_path))
+    assert store.load(100)["a"].tolist() == list(range(60))
+    assert len(store.segments()) == 2
+    store.append(pd.DataFrame({"a": range(60, 65)}), capacity=40)
+    assert store.load(40)["a"].tolist() == list(range(25, 65))
@@ -0,0 +1,30 @@
+# tests/test_engine_supervisor.py
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from engine import engine_supervisor as sup
+
+
+def test_messages_routed_before_worker_start_are_delivered():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    source = "uba:logs:test"
+    sup.ensure_partition_groups(client, [source], 2)
+    client.xgroup_create(source, sup.REDIS_GROUP_ROUTER, id="0", mkstream=True)
+    for i in range(6):
+        client.xadd(source, {"data": json.dumps({"user": f"u{i}"})})
+
+    # Router chuyển + ACK trước khi worker nào kịp gọi ensure_consumer_group
+    msgs = client.xreadgroup(sup.REDIS_GROUP_ROUTER, "router", {source: ">"})
+    assert sup.route_messages(client, msgs, num_partitions=2) == 6
+
+    # Worker khởi động muộn (kể cả với start_id "$" mặc định): group đã có -> no-op, vẫn đọc đủ
+    delivered = 0
+    for partition in range(2):
+        stream = sup.partition_stream(source, partition)
+        sup.redis_pool.ensure_consumer_group(client, stream, sup.REDIS_GROUP_ENGINE)
+        for _, entries in client.xreadgroup(sup.REDIS_GROUP_ENGINE, "w", {stream: ">"}) or []:
+            delivered += len(entries)
+    assert delivered == 6
@@ -0,0 +1,103 @@
+# tests/test_feature_state.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.feature_state import RollingWindowStore, UserBaselineStore
+
+T0 = pd.Timestamp("2026-01-01 10:00")
+
+
+def _batch(minutes, rows):
+    return pd.DataFrame({
+        "user": ["a"] * len(minutes),
+        "timestamp": [T0 + pd.Timedelta(minutes=m) for m in minutes],
+        "has_error": [0] * len(minutes),
+        "rows_returned": rows,
+        "query_length": [10] * len(minutes),
+    })
+
+
+def _reference(df):
+    # rolling('5min') của pandas trên toàn bộ lịch sử đã sắp theo thời gian
+    s = df.set_index("timestamp").sort_index()["rows_returned"].astype("float64")
+    return s.rolling("5min").sum()
+
+
+# grace=0: event phút 0 đã bị cắt khỏi buffer nên thiếu trong cửa sổ của event trễ
+@pytest.mark.parametrize("grace, expected_rows", [("2min", 8.0), ("0s", 7.0)])
+def test_late_event_within_grace_keeps_history(grace, expected_rows):
+    store = RollingWindowStore(window="5min", grace=grace)
+    store.update(_batch([0, 2, 4, 6], [1, 2, 3, 4]))
+    # Event trễ 2.5 phút so với event mới nhất (phút 6)
+    out = store.update(_batch([3.5], [5]))
+    assert out["total_rows_5m"].iloc[0] == expected_rows
+
+    full = pd.concat([_batch([0, 2, 4, 6], [1, 2, 3, 4]), _batch([3.5], [5])])
+    if grace != "0s":
+        assert out["total_rows_5m"].iloc[0] == _reference(full).loc[T0 + pd.Timedelta(minutes=3.5)]
+
+
+def test_state_shared_through_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    RollingWindowStore(window="5min", redis_client=client).update(_batch([0, 1], [1, 2]))
+    # Instance mới (VD sau restart / worker khác) đọc lại ring buffer từ Redis
+    out = RollingWindowStore(window="5min", redis_client=client).update(_batch([2], [4]))
+    assert out["query_count_5m"].iloc[0] == 3.0
+    assert out["total_rows_5m"].iloc[0] == 7.0
+
+
+def test_redis_state_matches_memory_and_is_trimmed():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    memory = RollingWindowStore(window="5min")
+    for start in range(0, 20, 2):
+        batch = _batch([start + m / 4 for m in range(8)], list(range(8)))
+        expected = memory.update(batch)
+        # Instance mới mỗi batch: lịch sử chỉ có thể đến từ Redis (ZADD phần mới + ZREMRANGEBYSCORE)
+        got = RollingWindowStore(window="5min", redis_client=client).update(batch)
+        pd.testing.assert_frame_equal(got, expected)
+    ts, _ = memory._tails["a"]
+    # Redis cắt theo ms nên có thể giữ thêm event nằm đúng mốc cắt; không tăng theo số batch
+    assert len(ts) <= client.zcard("uba:window:a") <= len(ts) + 1 < 80
+
+
+def test_idle_users_evicted_from_memory():
+    store = RollingWindowStore(window="5min", grace="1min")
+    store.EVICT_INTERVAL_SEC = 0
+    store.update(_batch([0, 1], [1, 1]))
+    later = _batch([20], [1])
+    later["user"] = "b"
+    store.update(later)
+    assert list(store._tails) == ["b"]
+
+
+def test_heavy_user_count_not_capped():
+    store = RollingWindowStore(window="5min")
+    n = 60000
+    batch = _batch(list(np.linspace(0, 1, n)), [1] * n)
+    assert store.update(batch)["query_count_5m"].iloc[-1] == n
+    assert store.update(_batch([1.5], [1]))["query_count_5m"].iloc[0] == n + 1
+
+
+def test_baseline_matches_full_history(tmp_path):
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "baseline.parquet")
+    store = UserBaselineStore(metrics=["rows_returned"], min_count=1, checkpoint_path=path)
+    seen = []
+    for _ in range(5):
+        batch = pd.DataFrame({"user": rng.choice(["a", "b", "c", "d"], 50),
+                              "rows_returned": rng.integers(0, 100, 50).astype("float64")})
+        store.update_and_score(batch)
+        seen.append(batch)
+    history = pd.concat(seen).groupby("user")["rows_returned"]
+    stats = store.stats.loc[history.mean().index]
+    np.testing.assert_allclose(stats["rows_returned__n"], history.count())
+    np.testing.assert_allclose(stats["rows_returned__mean"], history.mean())
+    np.testing.assert_allclose(stats["rows_returned__m2"], history.var(ddof=0) * history.count())
+
+    # Khôi phục từ checkpoint -> cùng baseline
+    store.save_checkpoint(force=True)
+    pd.testing.assert_frame_equal(UserBaselineStore(metrics=["rows_returned"], checkpoint_path=path).stats,
+                                  store.stats)
@@ -0,0 +1,68 @@
+# tests/test_features_parity.py
+"""Parity: extract_query_features_batch (vector hóa) phải khớp extract_query_features (từng dòng)."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.features import compare_with_reference
+
+QUERIES = [
+    "SELECT * FROM users WHERE id = 1",
+    "select u.name, o.total from users u join orders o on u.id = o.user_id -- report",
+    "SELECT * FROM a UNION SELECT password FROM mysql.user /* x */",
+    "DROP TABLE audit_log",
+    "UPDATE accounts SET balance = 0x41 WHERE 1=1 # hex",
+    "INSERT INTO events VALUES ('Nguyễn Văn A', 'đăng nhập')",
+    "SELECT SLEEP(5), BENCHMARK(1000000, MD5('a'))",
+    "SHOW GRANTS",
+    "",
+    "   ",
+    None,
+    np.nan,
+    "SELECT " + ", ".join(f"c{i}" for i in range(300)) + " FROM wide",
+]
+TIMESTAMPS = ["2026-01-01 03:15:00", "2026-03-07T23:59:59+07:00", "not a date", None, "2026-06-15 12:00:00"]
+NUMERIC_NOISE = [0, 5, "7", "", "abc", None, np.nan, np.inf, 1e12, -1, 3.7]
+# Bản tham chiếu gọi float() trực tiếp trên execution_time_ms: chỉ giá trị số / thiếu
+EXEC_TIME_NOISE = [0, 1.5, "2.5", None, np.nan, np.inf, 1e6]
+
+
+def _frame(n: int = 200, seed: int = 7) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    pick = lambda values: [values[i] for i in rng.integers(0, len(values), n)]
+    return pd.DataFrame({
+        "user": pick(["alice", "bob", None]),
+        "query": pick(QUERIES),
+        "timestamp": pick(TIMESTAMPS),
+        "rows_returned": pick(NUMERIC_NOISE),
+        "rows_affected": pick(NUMERIC_NOISE),
+        "execution_time_ms": pick(EXEC_TIME_NOISE),
+        "no_index_used": pick(NUMERIC_NOISE),
+        "error_code": pick([0, 1045, None, "1146"]),
+        "error_count": pick([0, 1, None]),
+        "has_error": pick([0, 1, None]),
+        "error_message": pick(["", "Access denied for user", None, "Table doesn't exist"]),
+        "query_length": pick([np.nan, 10, None]),
+        "query_entropy": pick([np.nan, 3.5, None]),
+    })
+
+
+def test_parity_mixed_object_columns():
+    assert compare_with_reference(_frame()) == {}
+
+
+@pytest.mark.parametrize("timestamps", [
+    pd.to_datetime(["2026-01-01 03:00", None, "2026-01-02 22:30"]),
+    pd.to_datetime(["2026-01-01 03:00", None, "2026-01-02 22:30"]).tz_localize("UTC"),
+    pd.Series([pd.Timestamp("2026-01-01 03:00", tz="UTC"), pd.NaT, None], dtype=object),
+    pd.Series([None, None, None], dtype=object),
+])
+def test_parity_timestamp_variants(timestamps):
+    df = _frame(3)
+    df["timestamp"] = timestamps
+    assert compare_with_reference(df) == {}
+
+
+def test_parity_missing_optional_columns():
+    df = _frame(50)[["user", "query"]]
+    assert compare_with_reference(df) == {}
@@ -0,0 +1,62 @@
+# tests/test_lgb_scorer_parity.py
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("lightgbm")
+
+from engine import lgb_scorer
+from engine.lgb_scorer import CompiledLGBScorer, predict_pandas, score_batch, synthetic_model
+
+
+@pytest.fixture(scope="module")
+def model():
+    return synthetic_model(n_train=5000)
+
+
+def _assert_parity(bundle, batch):
+    scorer = CompiledLGBScorer(bundle.model, bundle.features, bundle.cat_mapping)
+    native = scorer.predict(batch)
+    expected = predict_pandas(bundle, batch)
+    assert native.shape == expected.shape == (len(batch),)
+    np.testing.assert_allclose(native, expected, rtol=0, atol=1e-12)
+
+
+def test_parity_on_training_distribution(model):
+    bundle, make_frame = model
+    _assert_parity(bundle, make_frame(2000))
+
+
+def test_parity_with_unseen_categories(model):
+    bundle, make_frame = model
+    batch = make_frame(500)
+    # 'user' không có 'unknown' -> mã của category đầu tiên; 'command_type' có 'unknown'
+    batch.loc[:49, "user"] = "never_seen_user"
+    batch.loc[50:99, "command_type"] = "GRANT"
+    batch.loc[100:119, "database"] = None
+    batch.loc[120:139, "client_ip"] = np.nan
+    batch["command_type"] = batch["command_type"].astype(object)
+    batch.loc[140:149, "command_type"] = 7
+    _assert_parity(bundle, batch)
+
+
+def test_parity_with_missing_and_dirty_columns(model):
+    bundle, make_frame = model
+    batch = make_frame(500).drop(columns=["database", "num_3", "num_17"])
+    batch["num_0"] = batch["num_0"].astype(object)
+    batch.loc[:9, "num_0"] = "not a number"
+    batch.loc[10:19, "num_1"] = np.nan
+    batch["extra_column"] = 1
+    _assert_parity(bundle, batch)
+
+
+def test_score_batch_uses_native_path(model, monkeypatch):
+    bundle, make_frame = model
+    batch = make_frame(300)
+    batch.loc[:9, "user"] = "never_seen_user"
+    monkeypatch.setattr(lgb_scorer, "LGB_PARITY_CHECK_ROWS", 100)
+    lgb_scorer._scorer_cache.clear()
+    scores = score_batch(bundle, batch)
+    scorer = lgb_scorer.get_compiled_scorer(bundle)
+    assert scorer is not None and scorer.verified and not scorer.disabled
+    np.testing.assert_allclose(scores, predict_pandas(bundle, batch), rtol=0, atol=1e-12)
@@ -0,0 +1,97 @@
+# tests/test_pending_reclaimer.py
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from engine.redis_pool import PendingReclaimer
+from engine.write_behind import WriteBehindSink
+
+STREAM, GROUP = "uba:logs:test", "uba_engine"
+
+
+@pytest.fixture
+def client():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    client.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    return client
+
+
+def _deliver(client, n):
+    ids = [client.xadd(STREAM, {"data": str(i)}) for i in range(n)]
+    client.xreadgroup(GROUP, "engine", {STREAM: ">"})
+    _idle()
+    return ids
+
+
+def _idle():
+    # min_idle_ms=0 vẫn đòi idle > 0 (theo ms) kể từ lần giao gần nhất
+    time.sleep(0.01)
+
+
+def _times_delivered(client):
+    return {p["message_id"]: p["times_delivered"]
+            for p in client.xpending_range(STREAM, GROUP, min="-", max="+", count=100)}
+
+
+def test_in_flight_messages_are_not_reclaimed(client):
+    ids = _deliver(client, 3)
+    held = {(STREAM, ids[0]), (STREAM, ids[1])}
+    reclaimer = PendingReclaimer([STREAM], GROUP, "engine", min_idle_ms=0, in_flight=lambda: held)
+
+    assert reclaimer.reclaim_once(client) == 1
+    assert [msg_id for _, entries in reclaimer.drain() for msg_id, _ in entries] == [ids[2]]
+    delivered = _times_delivered(client)
+    assert delivered[ids[0]] == delivered[ids[1]] == 1 and delivered[ids[2]] == 2
+
+
+def test_pass_skipped_until_drained(client):
+    _deliver(client, 2)
+    reclaimer = PendingReclaimer([STREAM], GROUP, "engine", min_idle_ms=0)
+    assert reclaimer.reclaim_once(client) == 2
+    # Vòng lặp engine chưa drain (đang bị chặn): không đưa cùng id vào hàng đợi lần nữa
+    assert reclaimer.reclaim_once(client) == 0
+    assert sum(len(entries) for _, entries in reclaimer.drain()) == 2
+    _idle()
+    assert reclaimer.reclaim_once(client) == 2
+
+
+def test_persistence_failures_are_not_dead_lettered(client):
+    ids = _deliver(client, 2)
+    reclaimer = PendingReclaimer([STREAM], GROUP, "engine", min_idle_ms=0, max_deliveries=2)
+    reclaimer.mark_persistence_failed([(STREAM, ids[0])])
+    for _ in range(4):
+        _idle()
+        reclaimer.reclaim_once(client)
+        reclaimer.drain()
+
+    dead = client.xrange(f"{STREAM}:dead")
+    assert [fields["dead_source_id"] for _, fields in dead] == [ids[1]]
+    assert list(_times_delivered(client)) == [ids[0]]
+
+    reclaimer.mark_persisted([(STREAM, ids[0])])
+    _idle()
+    reclaimer.reclaim_once(client)
+    assert client.xlen(f"{STREAM}:dead") == 2
+
+
+def test_write_behind_sink_tracks_in_flight_ids():
+    release = threading.Event()
+    saved, failed = [], []
+
+    def save(results):
+        release.wait(5)
+        return results["ok"]
+
+    sink = WriteBehindSink(save, saved.extend, flush_interval_sec=0, max_retries=1,
+                           fail_fn=failed.extend).start()
+    sink.submit({"ok": True}, [(STREAM, "1-0")])
+    sink.submit({"ok": False}, [(STREAM, "2-0")])
+    assert sink.in_flight_ids() == {(STREAM, "1-0"), (STREAM, "2-0")}
+    release.set()
+    sink.stop(timeout=5)
+
+    assert sink.in_flight_ids() == set()
+    assert saved == [(STREAM, "1-0")] and failed == [(STREAM, "2-0")]
@@ -0,0 +1,28 @@
+# tests/test_stream_decoder.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.stream_decoder import records_to_frame
+
+
+@pytest.mark.parametrize("values", [
+    [1.7, 2],            # số lẻ trong cột int: giữ float64, không cắt thành 1
+    [None, 1064],        # error_code thiếu -> float64 + NaN
+    ["5", 6],            # chuỗi số: giữ nguyên như pandas, không ép kiểu
+    [1, 2],
+])
+def test_int_column_matches_legacy_dataframe(values):
+    records = [{"rows_examined": v} for v in values]
+    pd.testing.assert_frame_equal(records_to_frame(records), pd.DataFrame(records))
+
+
+def test_integral_floats_cast_to_int():
+    df = records_to_frame([{"rows_examined": 1.0}, {"rows_examined": 2}])
+    assert df["rows_examined"].dtype == np.int64
+    assert df["rows_examined"].tolist() == [1, 2]
+
+
+def test_float_column_is_float64():
+    df = records_to_frame([{"execution_time_ms": 1}, {"execution_time_ms": None}])
+    assert df["execution_time_ms"].dtype == np.float64